@@ -0,0 +1,45 @@
+"""Count new TCP connections while reading many small slices.
+
+Before pooled sessions, every request built a new `requests.Session` and
+opened a new connection. With the pool, all slices reuse one keep-alive
+connection per host.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from dapclient.client import open_url
+from dapclient.net import clear_session_pool
+from tests.local_server import Dap4App, LocalServer
+
+
+def main(n_slices=1000):
+    app = Dap4App(
+        {
+            "time": (("time",), np.arange(100, dtype="i4")),
+            "lon": (("lon",), np.arange(360.0)),
+            "sst": (
+                ("time", "lon"),
+                np.random.default_rng(0).random((100, 360), dtype="f4"),
+            ),
+        }
+    )
+    clear_session_pool()
+    with LocalServer(app) as server:
+        ds = open_url(server.url + "/data.nc", protocol="dap4")
+        start = time.perf_counter()
+        for i in range(n_slices):
+            ds["sst"][i % 100, 0:10].data
+        elapsed = time.perf_counter() - start
+        print(f"slices:          {n_slices}")
+        print(f"requests:        {server.requests}")
+        print(f"new connections: {server.connections}")
+        print(f"elapsed:         {elapsed:.2f}s ({1e3 * elapsed / n_slices:.2f} ms/slice)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--n-slices", type=int, default=1000)
+    main(parser.parse_args().n_slices)
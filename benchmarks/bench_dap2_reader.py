@@ -0,0 +1,65 @@
+"""Unpack a large DAP2 `.dods` response.
+
+`tests/data/test.01.dods` (nine variables of every simple type, strings
+included) is scaled up into a sequence of many records, and unpacked with
+`unpack_dap2_data`. `legacy` is the previous reader, which copied the rest of
+the payload on every read, so that its cost grows with the square of the
+size of the response. `BufferReader` reads views of the payload at an offset,
+and its cost is linear: the time per record stays flat as the response grows.
+"""
+
+import argparse
+import os
+import time
+
+from dapclient.handlers.dap import _split_dods, unpack_dap2_data
+from dapclient.lib import BufferReader
+from dapclient.parsers.dds import dds_to_dataset
+from tests.local_server import scale_dods
+
+TEST_01 = os.path.join(os.path.dirname(__file__), "../tests/data/test.01.dods")
+
+
+class LegacyReader(object):
+    """The previous `old_BytesReader`."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n):
+        out = self.data[:n]
+        self.data = self.data[n:]
+        return out
+
+
+def unpack(dds, data, reader):
+    dataset = dds_to_dataset(dds)
+    return unpack_dap2_data(reader(data), dataset)[0]
+
+
+def main(sizes=(1000, 4000, 16000)):
+    with open(TEST_01, "rb") as f:
+        dods = f.read()
+    print(f"{'records':>8} {'bytes':>10} {'legacy':>10} {'BufferReader':>13}")
+    for n in sizes:
+        dds, data = _split_dods(scale_dods(dods, n))
+        dds, data = dds.decode("ascii"), bytes(data)
+        times = []
+        for reader in (LegacyReader, BufferReader):
+            start = time.perf_counter()
+            records = unpack(dds, data, reader)
+            times.append(time.perf_counter() - start)
+            assert len(records.stream) == n
+        print(
+            f"{n:>8} {len(data):>10} {times[0]:>9.3f}s {times[1]:>12.3f}s"
+            f"  ({times[0] / times[1]:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n", "--sizes", type=int, nargs="+", default=[1000, 4000, 16000]
+    )
+    args = parser.parse_args()
+    main(args.sizes)
@@ -0,0 +1,85 @@
+"""Unpack a DAP2 sequence of a million numeric records.
+
+`records` is `unpack_sequence`, which reads one record at a time from a
+`StreamReader`, as iterating over a `SequenceProxy` does. `batches` is
+`unpack_sequence_batches` (`SequenceProxy.iter_batches`), which checks the
+markers of all the complete records of a chunk at once and casts them into
+a structured array in a single call. Both are fed from memory in 1 MiB
+pieces.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from dapclient.handlers.dap import (
+    CHUNK_SIZE,
+    unpack_sequence,
+    unpack_sequence_batches,
+)
+from dapclient.lib import StreamReader
+from dapclient.parsers.dds import dds_to_dataset
+from tests.local_server import END_OF_SEQUENCE, START_OF_INSTANCE
+
+
+def response(n):
+    """Return the template and the XDR payload of a sequence of `n` records."""
+    dds = """Dataset {
+    Sequence {
+        Int32 id;
+        Float64 time;
+        Float32 depth;
+        Float32 temp;
+        Int16 qc;
+    } argo;
+} data;"""
+    template = dds_to_dataset(dds)["argo"]
+    wire = np.zeros(
+        n,
+        dtype=[
+            ("marker", "V4"),
+            ("id", ">i4"),
+            ("time", ">f8"),
+            ("depth", ">f4"),
+            ("temp", ">f4"),
+            ("qc", ">i4"),
+        ],
+    )
+    wire["marker"] = START_OF_INSTANCE
+    wire["id"] = np.arange(n)
+    wire["time"] = np.arange(n) * 60.0
+    wire["depth"] = np.arange(n) % 2000
+    wire["temp"] = 10.0
+    return template, wire.tobytes() + END_OF_SEQUENCE
+
+
+def pieces(data):
+    view = memoryview(data)
+    return (view[i : i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE))
+
+
+def main(count=1_000_000):
+    template, data = response(count)
+    print(f"{count} records, {len(data) / 2**20:.1f} MiB")
+
+    start = time.perf_counter()
+    records = list(unpack_sequence(StreamReader(pieces(data)), template))
+    t0 = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batches = list(unpack_sequence_batches(pieces(data), template))
+    t1 = time.perf_counter() - start
+
+    batch = np.concatenate(batches)
+    assert len(records) == len(batch) == count
+    assert records[-1]["id"] == batch["id"][-1] == count - 1
+    print(f"records  {t0:8.3f}s")
+    print(f"batches  {t1:8.3f}s  ({t0 / t1:.0f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.count)
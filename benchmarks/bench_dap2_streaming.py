@@ -0,0 +1,74 @@
+"""Peak memory of unpacking a large DAP2 `.dods` response.
+
+`buffered` is the previous path: the whole response is read into memory
+(`r.content`), split at the `Data:` line and unpacked with
+`unpack_dap2_data`, which then casts the big-endian arrays. `streaming` feeds
+the response to `DAP2StreamDecoder` in 1 MiB pieces, as `iter_content` would,
+copying the payload straight into arrays preallocated from the DDS and
+swapping their bytes in place. Peak memory is the python heap traced by
+`tracemalloc`, on top of the response itself.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from dapclient.handlers.dap import (
+    CHUNK_SIZE,
+    DAP2StreamDecoder,
+    _split_dods,
+    unpack_dap2_data,
+)
+from dapclient.lib import BufferReader
+from dapclient.parsers.dds import dds_to_dataset
+from tests.local_server import Dap2App
+
+
+def buffered(body):
+    content = bytes(body)  # `r.content`
+    dds, data = _split_dods(content)
+    dataset = dds_to_dataset(dds.decode("ascii"))
+    return [
+        np.asarray(array).astype(array.dtype.newbyteorder("="))
+        for array in unpack_dap2_data(BufferReader(data), dataset)
+    ]
+
+
+def streaming(body):
+    decoder = DAP2StreamDecoder(lambda dds: dds_to_dataset(dds.decode("ascii")))
+    view = memoryview(body)
+    for i in range(0, len(view), CHUNK_SIZE):
+        decoder.feed(view[i : i + CHUNK_SIZE])
+    decoder.close()
+    return decoder.data
+
+
+def main(size_mb=256):
+    n = int(size_mb * 2**20 / 4 / 720 / 360)
+    app = Dap2App(
+        {
+            "time": (("time",), np.arange(n, dtype="i4")),
+            "sst": (("time", "lat", "lon"), np.ones((n, 360, 720), dtype="f4")),
+        }
+    )
+    body = app.dods()
+    print(f"response: {len(body) / 2**20:.0f} MiB")
+    for label, func in [("buffered", buffered), ("streaming", streaming)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        data = func(body)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert data[1].dtype.isnative and data[1][-1, -1, -1] == 1
+        del data
+        print(f"{label:<10} {elapsed:6.2f}s  peak {peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--size-mb", type=int, default=256)
+    args = parser.parse_args()
+    main(args.size_mb)
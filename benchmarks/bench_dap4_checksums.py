@@ -0,0 +1,49 @@
+"""Cost of verifying the CRC32 checksums of a DAP4 response while decoding it.
+
+Each response is decoded with the streaming decoder, with and without
+`verify_checksums=True`, and the CRC32 throughput reported by
+`UNPACKDAP4DATA.checksum_throughput` is printed.
+"""
+
+import argparse
+import time
+
+import requests
+
+from benchmarks.bench_dap4_decoder import _Response, responses
+from dapclient.handlers.dap import UNPACKDAP4DATA
+
+
+def decode(body, verify):
+    r = requests.Response()
+    r.iter_content = _Response(body).iter_content
+    return UNPACKDAP4DATA(r, verify_checksums=verify)
+
+
+def timed(body, verify, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        unpacked = decode(body, verify)
+    return (time.perf_counter() - start) / repeat, unpacked
+
+
+def main(repeat=20, size_mb=64):
+    print(f"{'response':<60} {'bytes':>9} {'plain':>9} {'verified':>9} {'crc32':>11}")
+    for name, body in responses(size_mb):
+        n = max(1, repeat // 10) if len(body) > 2**20 else repeat
+        t0, _ = timed(body, False, n)
+        t1, unpacked = timed(body, True, n)
+        throughput = unpacked.checksum_throughput
+        print(
+            f"{name[:58]:<60} {len(body):>9} "
+            f"{1e3 * t0:>7.2f}ms {1e3 * t1:>7.2f}ms "
+            + (f"{throughput:>6.0f} MB/s" if throughput else f"{'n/a':>11}")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    parser.add_argument("-s", "--size-mb", type=int, default=64)
+    args = parser.parse_args()
+    main(args.repeat, args.size_mb)
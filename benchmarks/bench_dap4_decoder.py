@@ -0,0 +1,158 @@
+"""Compare the streaming DAP4 decoder with the previous tempfile based path.
+
+The previous path wrote the response to a temporary file, joined all chunks in
+a `bytearray` (`stream2bytearray`) and sliced every variable out of it
+(`decode_variable`). The streaming decoder copies each chunk straight into
+arrays preallocated from the DMR. Both are fed from memory in 64 KiB pieces,
+as `iter_content` would. Peak memory is the python heap traced by
+`tracemalloc`, on top of the response itself.
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import requests
+
+from dapclient.handlers.dap import UNPACKDAP4DATA, decode_chunktype, decode_variable
+from dapclient.lib import BytesReader, walk
+from dapclient.model import BaseType
+from dapclient.parsers.dmr import dmr_to_dataset
+from tests.local_server import Dap4App
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data", "daps")
+PIECE = 2**16
+
+
+class _Response:
+    """Minimal stand-in for a streamed `requests.Response`."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), PIECE):
+            yield self.body[i : i + PIECE]
+
+
+def stream2bytearray(data):
+    """The previous join of all the chunks of a response, kept for comparison.
+
+    Computes the buffer size of the (binary) data form dap response.
+    data is sent in chunks, with encoding in between. The encoding is
+    sent in packs of 4 bytes, which tells info about endianness, chunk type
+    and chunk size, and whether it is last chunk or not. Data inbetween chunks
+    is numeric (array) data in binary form that needs to be turn into native
+    numpy array data of size =  len(buffer). That last bit is done outside the
+    scope of this function.
+    """
+
+    # Precompute chunk positions
+    chunk_positions = []
+    offset = data.data.tell()  # current position in the stream
+    last = False
+    while not last:
+        # Read the chunk header
+        chunk_header = np.frombuffer(data.slice(offset=offset, n=4), dtype=">u4")[0]
+        chunk_size = chunk_header & 0x00FFFFFF
+        chunk_type = (chunk_header >> 24) & 0xFF
+        last, _, _ = decode_chunktype(chunk_type)
+        chunk_positions.append((offset + 4, chunk_size))
+        offset += 4 + chunk_size
+        if last:
+            break
+    # Process chunks serially (used to be parallelized- no penalty when serialized).
+    results = []
+    for offset, length in chunk_positions:
+        data.data.seek(offset)
+        results.append(data.data.read(length))
+
+    buffer = bytearray()
+    # Combine results
+    for chunk_data in results:
+        buffer.extend(chunk_data)
+    return buffer
+
+
+def legacy(body):
+    with tempfile.TemporaryFile() as tmp:
+        for chunk in _Response(body).iter_content(PIECE):
+            tmp.write(chunk)
+        tmp.seek(0)
+        raw = BytesReader(tmp)
+        header = int.from_bytes(raw.read(4), "big")
+        dmr = raw.read(header & 0x00FFFFFF).decode("ascii", "replace")
+        _, _, endian = decode_chunktype((header >> 24) & 0xFF)
+        dataset = dmr_to_dataset(dmr)
+        buffer = stream2bytearray(raw)
+        start = 0
+        out = {}
+        for variable in walk(dataset, BaseType):
+            data, stop = decode_variable(buffer, start, variable, endian)
+            out[variable.id] = np.asarray(data)
+            start = stop + 4
+    return out
+
+
+def streaming(body):
+    r = requests.Response()
+    r.iter_content = _Response(body).iter_content
+    dataset = UNPACKDAP4DATA(r).dataset
+    return {var.id: np.asarray(var.data) for var in walk(dataset, BaseType)}
+
+
+def measure(func, body, repeat):
+    tracemalloc.start()
+    func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(body)
+    return (time.perf_counter() - start) / repeat, peak
+
+
+def responses(size_mb):
+    for path in sorted(glob.glob(os.path.join(DATA, "*.dap"))):
+        with open(path, "rb") as f:
+            yield os.path.basename(path), f.read()
+    if size_mb:
+        n = int(size_mb * 2**20 / 4 / 1000)
+        app = Dap4App(
+            {
+                "time": (("time",), np.arange(n, dtype="i4")),
+                "x": (("x",), np.arange(1000.0)),
+                "v": (("time", "x"), np.ones((n, 1000), dtype="f4")),
+            }
+        )
+        yield f"synthetic ({size_mb} MiB)", app.data()
+
+
+def main(repeat=20, size_mb=64):
+    print(f"{'response':<60} {'bytes':>9} {'legacy':>16} {'streaming':>16}")
+    for name, body in responses(size_mb):
+        expected = legacy(body)
+        result = streaming(body)
+        for key, value in expected.items():
+            np.testing.assert_array_equal(result[key], value)
+        if len(body) > 2**20:
+            repeat = max(1, repeat // 10)
+        t0, m0 = measure(legacy, body, repeat)
+        t1, m1 = measure(streaming, body, repeat)
+        print(
+            f"{name[:58]:<60} {len(body):>9} "
+            f"{1e3 * t0:>7.2f}ms {m0 / 1024:>6.0f}K "
+            f"{1e3 * t1:>7.2f}ms {m1 / 1024:>6.0f}K"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    parser.add_argument("-s", "--size-mb", type=int, default=64)
+    args = parser.parse_args()
+    main(args.repeat, args.size_mb)
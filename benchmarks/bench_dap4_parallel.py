@@ -0,0 +1,59 @@
+"""Finish decoding the variables of a big-endian DAP4 response on a thread pool.
+
+A response with several large variables is decoded as `iter_content` would
+deliver it, converting every variable to the native byte order. With
+`decode_workers`, each variable is converted (and its checksum verified) on a
+thread pool as soon as its bytes are in, while the following variables are
+still being copied. The conversion casts blocks of each array in place, which
+releases the GIL, so the gain grows with the number of cores.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import requests
+
+from benchmarks.bench_dap4_decoder import _Response
+from dapclient.handlers.dap import UNPACKDAP4DATA
+from tests.local_server import Dap4App
+
+
+def decode(body, **kwargs):
+    r = requests.Response()
+    r.iter_content = _Response(body).iter_content
+    return UNPACKDAP4DATA(r, **kwargs).dataset
+
+
+def main(size_mb=256, nvars=8, repeat=3):
+    n = int(size_mb * 2**20 / nvars / 8 / 1000)
+    variables = {"x": (("x",), np.arange(1000.0)), "t": (("t",), np.arange(n))}
+    for i in range(nvars):
+        variables[f"v{i}"] = (("t", "x"), np.full((n, 1000), i, dtype="f8"))
+    body = Dap4App(variables, little_endian=False).data()
+    print(f"{len(body) / 2**20:.0f} MiB, {nvars} variables, {os.cpu_count()} cores")
+
+    for label, kwargs in [
+        ("response byte order", {}),
+        ("native", {"native_byteorder": True}),
+        ("native + crc32", {"native_byteorder": True, "verify_checksums": True}),
+    ]:
+        for workers in (None, 2, 4, 8):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                dataset = decode(body, decode_workers=workers, **kwargs)
+            elapsed = (time.perf_counter() - start) / repeat
+            assert np.asarray(dataset["v1"].data)[0, 0] == 1
+            print(f"{label:<20} workers={str(workers):<5} {1e3 * elapsed:8.1f}ms")
+            if not kwargs:
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--size-mb", type=int, default=256)
+    parser.add_argument("-n", "--nvars", type=int, default=8)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.size_mb, args.nvars, args.repeat)
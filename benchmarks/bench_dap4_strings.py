@@ -0,0 +1,93 @@
+"""Decode a DAP4 String variable holding a million time stamps.
+
+`legacy` is the previous element-by-element decoder: one
+`decode_utf8_string_array` call and one small numpy array per string, stacked
+at the end. `bulk` is `decode_variable`, which scans the length prefixes in
+one pass and fills the result with a single masked assignment. `streaming`
+decodes the whole `.dap` response with `UNPACKDAP4DATA`, as `open_url` does.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import requests
+
+from benchmarks.bench_dap4_decoder import _Response
+from dapclient.handlers.dap import UNPACKDAP4DATA, decode_variable
+from dapclient.model import BaseType
+from tests.local_server import Dap4App
+
+
+def decode_utf8_string_array(buffer, start=0):
+    """The previous decoder of a single DAP4 string, kept for comparison."""
+    offset = start
+    strings = []
+
+    # 1. Read 8-byte little-endian length
+    length_bytes = buffer[offset : offset + 8]
+    strlen = int.from_bytes(length_bytes, byteorder="little")
+    offset += 8
+
+    # 2. Read the UTF-8 string
+    str_bytes = buffer[offset : offset + strlen]
+    offset += strlen
+
+    # 3. Decode the bytes to Python string (UTF-8)
+    decoded_str = str_bytes.decode("utf-8")
+    strings.append(decoded_str)
+
+    return strings, offset
+
+
+def legacy(buffer, variable):
+    DATA = []
+    stop = 0
+    for i in range(int(np.prod(variable.shape))):
+        string, stop = decode_utf8_string_array(buffer, start=stop)
+        DATA.append(np.array(string).astype("S"))
+    return np.array(DATA).reshape(variable.shape)
+
+
+def bulk(buffer, variable):
+    return decode_variable(buffer, 0, variable, "<")[0]
+
+
+def streaming(body):
+    r = requests.Response()
+    r.iter_content = _Response(body).iter_content
+    return UNPACKDAP4DATA(r).dataset["time"].data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(count=1_000_000):
+    times = np.array(
+        ["2024-01-01T00:00:%06d" % i for i in range(count)], dtype=object
+    )
+    buffer = b"".join(
+        len(item).to_bytes(8, "little") + item.encode() for item in times
+    )
+    variable = BaseType("time", dtype=np.dtype("S"), shape=(count,))
+    body = Dap4App({"time": (("time",), times)}).data()
+
+    t0, expected = timed(legacy, buffer, variable)
+    t1, result = timed(bulk, buffer, variable)
+    t2, streamed = timed(streaming, body)
+    np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(streamed, expected)
+    print(f"{count} strings, {len(buffer) / 2**20:.1f} MiB")
+    print(f"legacy     {t0:8.3f}s")
+    print(f"bulk       {t1:8.3f}s  ({t0 / t1:.0f}x)")
+    print(f"streaming  {t2:8.3f}s  (whole response)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.count)
@@ -0,0 +1,72 @@
+"""Peak memory and file size of streaming a DAP4 response into netCDF.
+
+`whole` buffers each variable completely before writing it, without chunking
+or compression (the previous behavior). `slabs` writes each variable as it is
+decoded, one slab aligned with the chunks of the variable at a time, with the
+chunk sizes and deflate level advertised by the DMR. Peak memory is the python
+heap traced by `tracemalloc`, on top of the response itself.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import requests
+
+import dapclient.handlers.dap
+from benchmarks.bench_dap4_decoder import _Response
+from dapclient.handlers.dap import UNPACKDAP4DATA
+from tests.local_server import Dap4App
+
+
+def write(body, output_path, **kwargs):
+    r = requests.Response()
+    r.iter_content = _Response(body).iter_content
+    UNPACKDAP4DATA(r, output_path=output_path, **kwargs)
+    return os.path.getsize(os.path.join(output_path, "data.nc4"))
+
+
+def main(size_mb=256):
+    n = int(size_mb * 2**20 / 4 / 720 / 360)
+    # smooth, compressible field
+    field = np.sin(np.linspace(0, 20, 720 * 360)).reshape(360, 720)
+    values = np.broadcast_to(field.astype("f4"), (n, 360, 720))
+    app = Dap4App(
+        {
+            "time": (("time",), np.arange(n, dtype="i4")),
+            "lat": (("lat",), np.linspace(-90, 90, 360)),
+            "lon": (("lon",), np.linspace(-180, 180, 720)),
+            "sst": (("time", "lat", "lon"), values),
+        },
+        attributes={"sst": {"_ChunkSizes": [1, 360, 720], "_DeflateLevel": 4}},
+    )
+    body = app.data()
+    print(f"response: {len(body) / 2**20:.0f} MiB")
+    slab_size = dapclient.handlers.dap.SLAB_SIZE
+    for label, kwargs, slab in [
+        ("whole", {"encoding": {"sst": {"chunksizes": None, "zlib": False}}}, 2**62),
+        ("slabs", {}, slab_size),
+    ]:
+        dapclient.handlers.dap.SLAB_SIZE = slab
+        with tempfile.TemporaryDirectory() as tmp:
+            tracemalloc.start()
+            start = time.perf_counter()
+            size = write(body, tmp, **kwargs)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print(
+            f"{label:<6} {elapsed:6.2f}s  peak {peak / 2**20:7.1f} MiB  "
+            f"file {size / 2**20:7.1f} MiB"
+        )
+    dapclient.handlers.dap.SLAB_SIZE = slab_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--size-mb", type=int, default=256)
+    args = parser.parse_args()
+    main(args.size_mb)
@@ -0,0 +1,68 @@
+"""Time a loop over the time steps of a remote variable, with and without
+reading ahead.
+
+The local server waits `latency` seconds before answering each request, as a
+remote server would. Without reading ahead, every step of the loop waits for
+a round trip. With `var.prefetch(depth)`, the next steps are downloaded on a
+thread pool while the loop works on the current one, as a single hyperslab
+with `merge`.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from dapclient.client import open_url
+from tests.local_server import Dap4App, LocalServer
+
+
+def delayed(app, latency):
+    def application(environ, start_response):
+        if environ["PATH_INFO"].endswith(".dap"):
+            time.sleep(latency)
+        return app(environ, start_response)
+
+    return application
+
+
+def main(nt=100, latency=0.05, work=0.02, depth=8):
+    app = Dap4App(
+        {
+            "time": (("time",), np.arange(nt, dtype="i4")),
+            "lat": (("lat",), np.linspace(-90, 90, 180)),
+            "lon": (("lon",), np.linspace(-180, 180, 360)),
+            "sst": (("time", "lat", "lon"), np.ones((nt, 180, 360), dtype="f4")),
+        }
+    )
+    with LocalServer(delayed(app, latency)) as server:
+        for label, kwargs in [
+            ("sequential", None),
+            ("prefetch", {"depth": depth, "merge": False}),
+            ("prefetch + merge", {"depth": depth}),
+        ]:
+            dataset = open_url(server.url + "/data.nc", protocol="dap4")
+            sst = dataset["sst"]
+            prefetcher = sst.prefetch(**kwargs) if kwargs else None
+            requests = server.requests
+            start = time.perf_counter()
+            for t in range(nt):
+                np.asarray(sst[t, :, :])
+                # the analysis of the step
+                time.sleep(work)
+            elapsed = time.perf_counter() - start
+            hits = f"  hit rate {prefetcher.hit_rate:.2f}" if prefetcher else ""
+            print(
+                f"{label:<18} {elapsed:6.2f}s  "
+                f"{server.requests - requests:4d} requests{hits}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--nt", type=int, default=100)
+    parser.add_argument("-l", "--latency", type=float, default=0.05)
+    parser.add_argument("-w", "--work", type=float, default=0.02)
+    parser.add_argument("-d", "--depth", type=int, default=8)
+    args = parser.parse_args()
+    main(args.nt, args.latency, args.work, args.depth)
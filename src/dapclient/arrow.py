@@ -0,0 +1,87 @@
+"""Export sequences to Apache Arrow record batches and Parquet files.
+
+Requires `pyarrow`. The records are converted one batch at a time, as
+`SequenceType.iter_batches` yields them: remote sequences are streamed from
+the server, and neither the whole response nor a list of its records is ever
+held in memory. Numeric columns are handed to Arrow as numpy arrays; strings
+become `string` columns, and nested sequences `list<struct>` columns.
+"""
+
+import numpy
+import pyarrow
+import pyarrow.parquet
+
+from dapclient.handlers.lib import IterData
+from dapclient.lib import SEQUENCE_BATCH_ROWS
+from dapclient.model import SequenceType
+
+
+def arrow_type(template):
+    """Return the Arrow type of the values of `template`."""
+    if isinstance(template, SequenceType):
+        return pyarrow.list_(
+            pyarrow.struct(
+                [(child.name, arrow_type(child)) for child in template.children()]
+            )
+        )
+    if template.dtype.char in "SU":
+        return pyarrow.string()
+    return pyarrow.from_numpy_dtype(template.dtype.newbyteorder("="))
+
+
+def arrow_schema(sequence):
+    """Return the Arrow schema of the record batches of `sequence`."""
+    return pyarrow.schema(
+        [(child.name, arrow_type(child)) for child in sequence.children()]
+    )
+
+
+def _python(value, template):
+    """Convert the value of an object column into what Arrow expects."""
+    if isinstance(value, IterData):
+        children = list(template.children())
+        return [
+            {
+                child.name: _python(item, child)
+                for child, item in zip(children, record)
+            }
+            for record in value.stream
+        ]
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def record_batch(batch, schema, sequence):
+    """Convert a structured array of records into an Arrow `RecordBatch`."""
+    arrays = []
+    for field, child in zip(schema, sequence.children()):
+        column = batch[field.name]
+        if column.dtype.kind in "OSU":
+            values = [_python(value, child) for value in column]
+            arrays.append(pyarrow.array(values, type=field.type))
+        else:
+            arrays.append(pyarrow.array(numpy.ascontiguousarray(column)))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def record_batches(sequence, batch_rows=SEQUENCE_BATCH_ROWS):
+    """Yield the records of `sequence` as Arrow record batches."""
+    schema = arrow_schema(sequence)
+    for batch in sequence.iter_batches(batch_rows):
+        yield record_batch(batch, schema, sequence)
+
+
+def write_parquet(sequence, path, batch_rows=SEQUENCE_BATCH_ROWS, **kwargs):
+    """Write the records of `sequence` to a Parquet file, a batch at a time.
+
+    Extra keyword arguments are passed to `pyarrow.parquet.ParquetWriter`,
+    e.g. `compression="zstd"`. Each batch is written as a row group.
+    """
+    schema = arrow_schema(sequence)
+    with pyarrow.parquet.ParquetWriter(path, schema, **kwargs) as writer:
+        for batch in record_batches(sequence, batch_rows):
+            writer.write_batch(batch)
+    return path
@@ -0,0 +1,283 @@
+"""Caches of decoded arrays: persistent on disk, and in memory.
+
+Unlike the HTTP cache of `requests_cache`, which keeps raw responses that are
+decoded again on every access and grows without bound, `ArrayCache` keeps the
+decoded values of each hyperslab requested from a variable, as a gzipped
+`.npy` file. Files are named after the SHA-256 of the dataset URL, the
+variable, the hyperslab and a hash of the DMR describing the dataset, so that
+values are never served for a dataset that changed on the server.
+
+Files are written under a temporary name and renamed into place, and a hit
+refreshes the modification time of its file, so several processes can share
+the same directory. When the files exceed `maxsize` bytes, the least recently
+used are removed.
+
+    >>> dataset = open_url(url, array_cache=True)  # doctest: +SKIP
+
+`HyperslabCache` keeps decoded hyperslabs in memory for the life of a
+dataset, and answers any hyperslab contained in one it holds.
+"""
+
+import collections
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import warnings
+from pathlib import Path
+
+import numpy
+
+from dapclient.net import cache_home
+
+# bytes of compressed arrays kept on disk by default
+ARRAY_CACHE_SIZE = 10 * 2**30
+SUFFIX = ".npy.gz"
+# bytes of decoded hyperslabs kept in memory by `HyperslabCache`
+HYPERSLAB_CACHE_SIZE = 256 * 2**20
+
+
+def array_cache_path():
+    """Default directory of the array cache."""
+    return os.path.join(cache_home(), "arrays")
+
+
+def metadata_hash(text):
+    """Return the SHA-256 of a metadata document (e.g. a DMR), as hex."""
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    return hashlib.sha256(text).hexdigest()
+
+
+class ArrayCache(object):
+    """Decoded arrays persisted on disk, evicted LRU under a byte budget.
+
+    Parameters:
+    -----------
+        path: str | os.PathLike | None
+            directory holding the arrays, see `array_cache_path`.
+        maxsize: int
+            bytes of compressed arrays kept on disk.
+        compresslevel: int
+            gzip compression level of the files.
+    """
+
+    def __init__(self, path=None, maxsize=ARRAY_CACHE_SIZE, compresslevel=1):
+        self.path = Path(array_cache_path() if path is None else path)
+        self.maxsize = maxsize
+        self.compresslevel = compresslevel
+        self.hits = 0
+        self.misses = 0
+        # bytes on disk, from the last scan and the writes since
+        self._nbytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, variable, ranges, metadata_hash=None):
+        """Return the key of the hyperslab `ranges` (one `range` per dimension)."""
+        ranges = [[r.start, r.stop, r.step] for r in ranges]
+        text = json.dumps([url, variable, ranges, metadata_hash])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _file(self, key):
+        return self.path / key[:2] / (key + SUFFIX)
+
+    def get(self, key):
+        """Return the array stored under `key`, or None."""
+        path = self._file(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            data = numpy.lib.format.read_array(
+                io.BytesIO(gzip.decompress(blob)), allow_pickle=False
+            )
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, EOFError):
+            # a truncated or corrupted file
+            _remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store `data` under `key`. Arrays of objects are not cached."""
+        data = numpy.asarray(data)
+        if data.dtype.hasobject:
+            return
+        buffer = io.BytesIO()
+        numpy.lib.format.write_array(buffer, data, allow_pickle=False)
+        blob = gzip.compress(buffer.getvalue(), compresslevel=self.compresslevel)
+        if len(blob) > self.maxsize:
+            return
+        path = self._file(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(blob)
+                os.replace(tmp, path)
+            except BaseException:
+                _remove(tmp)
+                raise
+        except OSError as e:
+            # the cache is only a cache
+            warnings.warn(f"Could not cache array: {e}")
+            return
+        with self._lock:
+            if self._nbytes is None:
+                self._nbytes = self.nbytes
+            else:
+                self._nbytes += len(blob)
+            if self._nbytes > self.maxsize:
+                self._evict(self.maxsize)
+
+    def _entries(self):
+        entries = []
+        for path in self.path.glob("*/*" + SUFFIX):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    @property
+    def nbytes(self):
+        """Bytes of the arrays on disk, from all processes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, maxsize):
+        entries = sorted(self._entries())
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if nbytes <= maxsize:
+                break
+            _remove(path)
+            nbytes -= size
+        self._nbytes = nbytes
+        return nbytes
+
+    def evict(self, maxsize=None):
+        """Remove the least recently used arrays, down to `maxsize` bytes."""
+        with self._lock:
+            return self._evict(self.maxsize if maxsize is None else maxsize)
+
+    def clear(self):
+        """Remove all the arrays."""
+        self.evict(0)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class HyperslabCache(object):
+    """In-memory LRU cache of decoded hyperslabs, within a byte budget.
+
+    Entries are keyed by the variable (see `BaseProxyDap4`: its base url,
+    id, the hash of the DMR and the session), and by the hyperslab they hold,
+    normalized to one `range` per dimension. A request
+    is answered from any cached hyperslab of the same variable that contains
+    all of its indices, by slicing it with numpy: once `var[:]` is loaded,
+    every later slice of `var` is local.
+
+    Arrays are copied in and out of the cache, so that the caller may modify
+    what it gets. Memory-mapped arrays and arrays larger than the budget are
+    not cached. The DAP4 checksum of a hyperslab can be stored with it, and
+    is returned when exactly the same hyperslab is requested again.
+
+    Enabled with `open_url(url, hyperslab_cache=True)`, one per dataset, or
+    by passing the same instance to several calls.
+    """
+
+    def __init__(self, maxsize=HYPERSLAB_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(index, shape):
+        """Return `index` (a tuple of slices) as a tuple of `range`s."""
+        return tuple(range(*s.indices(n)) for s, n in zip(index, shape))
+
+    @staticmethod
+    def _local(request, cached):
+        """Return the slices of `cached` holding `request`, or None."""
+        out = []
+        for r, c in zip(request, cached):
+            if not len(r):
+                return None
+            if r[0] not in c or r[-1] not in c:
+                return None
+            step = 1
+            if len(r) > 1:
+                if r.step % c.step:
+                    return None
+                step = r.step // c.step
+            start = c.index(r[0])
+            out.append(slice(start, start + (len(r) - 1) * step + 1, step))
+        return tuple(out)
+
+    def get(self, key, ranges):
+        """Return the hyperslab `ranges` of the variable `key`, and its checksum.
+
+        Returns `(None, None)` when no cached hyperslab holds it, and a None
+        checksum unless the same hyperslab was stored.
+        """
+        with self._lock:
+            for (entry_key, cached), (data, checksum) in reversed(
+                self._entries.items()
+            ):
+                if entry_key != key or len(cached) != len(ranges):
+                    continue
+                local = self._local(ranges, cached)
+                if local is not None:
+                    self._entries.move_to_end((entry_key, cached))
+                    self.hits += 1
+                    if cached != ranges:
+                        checksum = None
+                    return data[local].copy(), checksum
+            self.misses += 1
+        return None, None
+
+    def put(self, key, ranges, data, checksum=None):
+        """Store a copy of the hyperslab `ranges` of the variable `key`."""
+        data = numpy.asanyarray(data)
+        if (
+            isinstance(data, numpy.memmap)
+            or data.nbytes > self.maxsize
+            or data.shape != tuple(len(r) for r in ranges)
+        ):
+            return
+        data = data.copy()
+        with self._lock:
+            old = self._entries.pop((key, ranges), None)
+            if old is not None:
+                self.nbytes -= old[0].nbytes
+            self._entries[key, ranges] = (data, checksum)
+            self.nbytes += data.nbytes
+            while self.nbytes > self.maxsize:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
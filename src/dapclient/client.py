@@ -44,8 +44,12 @@ a lazy mechanism for function call, supporting any function. Eg, to call the
 
 """
 
+import asyncio
+import base64
+import copy
 import datetime as dt
 import hashlib
+import json
 import multiprocessing as mp
 import os
 import re
@@ -54,12 +58,11 @@ import time
 import warnings
 from collections import Counter
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
-from io import BytesIO, open
+from io import open
 from os.path import commonprefix
 from pathlib import Path
 from typing import Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Union
 from urllib.parse import parse_qs, parse_qsl, unquote, urlencode, urlsplit, urlunsplit
-from xml.etree import ElementTree as ET
 
 import numpy as np
 import requests
@@ -70,20 +73,44 @@ from requests.exceptions import (
 from requests.utils import urlparse
 from requests_cache import CachedSession
 
+from dapclient.exceptions import ChecksumError
 from dapclient.handlers.dap import (
+    CHECKSUM_RETRIES,
     UNPACKDAP4DATA,
+    AsyncDAPHandler,
+    ConcatProxy,
     DAPHandler,
-    StreamReader,
+    _split_dods,
     unpack_dap2_data,
 )
-from dapclient.lib import DEFAULT_TIMEOUT, Failure, _is_retryable, encode, tqdm, walk
+from dapclient.lib import (
+    DEFAULT_TIMEOUT,
+    GRANULE_WORKERS,
+    BufferReader,
+    Failure,
+    _is_retryable,
+    encode,
+    tqdm,
+    walk,
+)
 from dapclient.model import BaseType, BatchPromise, DapType
-from dapclient.net import GET, create_session, extract_session_state, get_session
+from dapclient.net import (
+    DEFAULT_ASYNC_CONCURRENCY,
+    GET,
+    create_session,
+    evict_cached_response,
+    extract_session_state,
+    get_async_client,
+    get_session,
+    server_capabilities,
+)
 from dapclient.parsers.das import add_attributes, parse_das
 from dapclient.parsers.dds import dds_to_dataset
 from dapclient.parsers.dmr import DMRParser, dmr_to_dataset
+from dapclient.sinks import Sink, locked
 
 VARPATH_RE = re.compile(r"^\s*/([^[]+)\s*\[")
+MANIFEST_NAME = "dapclient_manifest.jsonl"
 
 SliceTuple = Union[
     tuple[int, int],
@@ -107,6 +134,10 @@ def open_url(
     session_kwargs=None,
     cache_kwargs=None,
     get_kwargs=None,
+    verify_checksums=False,
+    array_cache=None,
+    dmr=None,
+    hyperslab_cache=None,
 ):
     """
     Open a remote OPeNDAP URL, or a local (wsgi) application returning a dapclient
@@ -138,8 +169,9 @@ def open_url(
         option to specify the protocol is to use replace the url scheme (http, https)
         with 'dap2' or 'dap4'.
     batch: bool (Default: False)
-        Flag that indicates download multiple arrays with single dap response. Only
-        compatible with DAP4 protocol.
+        Flag that indicates download multiple arrays with single dap response:
+        a `.dap` response in DAP4, and a `.dods` response projecting all of
+        them in DAP2.
     use_cache : bool (Default: False)
         Whether to use the cache or not in the requests.
     session_kwargs: dict | None
@@ -150,6 +182,25 @@ def open_url(
         use_cache is True. See `dapclient.net.GET`.
     get_kwargs: dict | None
         additional keyword arguments passed to `requests.get`.
+    verify_checksums: bool (Default: False)
+        Only for DAP4. Compute the CRC32 of each variable while its response
+        streams in, and compare it with the checksum sent by the server. A
+        corrupted response is evicted from the cache and downloaded again, and
+        `dapclient.exceptions.ChecksumError` is raised if it keeps failing.
+    array_cache: dapclient.cache.ArrayCache | str | bool | None (Default: None)
+        Only for DAP4. Keep the decoded values of every hyperslab downloaded
+        in a persistent cache on disk, shared between processes, and read them
+        from there when the same hyperslab of the same dataset is requested
+        again. `True` uses the default location (`~/.cache/dapclient/arrays`),
+        a path a directory of your choice.
+    dmr: str | None (Default: None)
+        Only for DAP4. The DMR of the dataset, when it is already known (e.g.
+        from a `CubeManifest`). It is then not downloaded.
+    hyperslab_cache: dapclient.cache.HyperslabCache | bool | None (Default: None)
+        Only for DAP4. Keep the hyperslabs decoded from this dataset in memory,
+        and slice later requests from them when they hold all the values
+        requested. `True` creates a cache for this dataset; a `HyperslabCache`
+        may be shared between datasets.
 
 
     Returns:
@@ -174,15 +225,19 @@ def open_url(
         user_charset=user_charset,
         protocol=protocol,
         get_kwargs=get_kwargs,
+        verify_checksums=verify_checksums,
+        array_cache=array_cache,
+        metadata=None if dmr is None else {"dmr": dmr},
+        hyperslab_cache=hyperslab_cache,
     )
     dataset = handler.dataset
     dataset._session = session
 
     if batch:
-        if handler.protocol == "dap2" or application:
+        if application:
             raise RuntimeError(
                 "Multi-variable download within single response "
-                "is currently only supported in DAP4."
+                "is not supported for local applications."
             )
 
         dataset.enable_batch_mode()
@@ -193,6 +248,465 @@ def open_url(
     return dataset
 
 
+async def open_url_async(
+    url,
+    application=None,
+    session=None,
+    output_grid=False,
+    flat=True,
+    timeout=DEFAULT_TIMEOUT,
+    verify=True,
+    checksums=True,
+    user_charset="ascii",
+    protocol=None,
+    session_kwargs=None,
+    max_concurrency=DEFAULT_ASYNC_CONCURRENCY,
+    verify_checksums=False,
+):
+    """
+    Asynchronous counterpart of `open_url`. Requires the optional dependency
+    `httpx`.
+
+    Metadata is downloaded with `httpx.AsyncClient`, and every variable of the
+    returned dataset can be sliced without blocking the event loop::
+
+        >>> dataset = await open_url_async(url, protocol="dap4")  # doctest: +SKIP
+        >>> sst = await dataset["sst"].aget[0:10, :]  # doctest: +SKIP
+
+    Regular (blocking) indexing remains available.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the dataset.
+    application: a WSGI application object | None
+        When set, we are dealing with a local application. Requests are then
+        made from a worker thread.
+    session : requests.Session
+        A requests session object. Its headers and cookies (e.g. for
+        authentication) are copied into the async client.
+    max_concurrency : int (Default: 256)
+        Maximum number of requests in flight at once within the event loop,
+        for the given session. Only applies when the first dataset for that
+        session is opened.
+
+    See `open_url` for the remaining parameters.
+
+    Returns:
+        dapclient.model.dataset
+    """
+    if not session:
+        session = create_session(session_kwargs=session_kwargs)
+    if not application:
+        get_async_client(session, verify=verify, max_concurrency=max_concurrency)
+
+    # off the event loop: the protocol may be read from the capability registry
+    handler = await asyncio.to_thread(
+        AsyncDAPHandler,
+        url,
+        application,
+        session,
+        output_grid=output_grid,
+        flat=flat,
+        timeout=timeout,
+        verify=verify,
+        checksums=checksums,
+        user_charset=user_charset,
+        protocol=protocol,
+        verify_checksums=verify_checksums,
+    )
+    dataset = await handler.open()
+    dataset._session = session
+
+    # attach server-side functions
+    dataset.functions = Functions(url, application, session, timeout=timeout)
+
+    return dataset
+
+
+def open_mfdataset(
+    urls=None,
+    concat_dim=None,
+    session=None,
+    workers=GRANULE_WORKERS,
+    manifest=None,
+    **kwargs,
+):
+    """Open a collection of DAP4 granules as a single dataset.
+
+    The granules must share their variables and dimensions, except for the
+    length of `concat_dim`. The metadata of all granules is downloaded
+    concurrently, and the variables of the first granule that have the
+    dimension `concat_dim` are replaced by the concatenation of that variable
+    across all granules (see `dapclient.handlers.dap.ConcatProxy`). No data is
+    downloaded until the variables are sliced::
+
+        >>> dataset = open_mfdataset(urls, concat_dim="time")  # doctest: +SKIP
+        >>> sst = dataset["sst"][40:50, :, :]  # doctest: +SKIP
+
+    Only the granules holding time steps 40 to 49 are then requested.
+
+    With a `manifest`, written by `consolidate_metadata` or
+    `CubeManifest.write`, the datacube is opened without any request::
+
+        >>> dataset = open_mfdataset(manifest="cube.json")  # doctest: +SKIP
+
+    Parameters
+    ----------
+    urls : list
+        The URLs of the granules, in the order of `concat_dim`.
+    concat_dim : str
+        The name of the dimension along which the granules are concatenated.
+    session : requests.Session | None
+        The session shared by all the requests.
+    workers : int
+        The number of granules requested at once.
+    manifest : str | os.PathLike | CubeManifest | None
+        A manifest of the datacube. `urls` and `concat_dim` are then read from
+        it.
+
+    The remaining keyword arguments are passed to `open_url`.
+
+    Returns:
+        dapclient.model.DatasetType
+    """
+    if session is None:
+        session = create_session(
+            use_cache=kwargs.pop("use_cache", False),
+            session_kwargs=kwargs.pop("session_kwargs", None),
+            cache_kwargs=kwargs.pop("cache_kwargs", None),
+        )
+    if manifest is not None:
+        if not isinstance(manifest, CubeManifest):
+            manifest = CubeManifest.read(manifest)
+        return manifest.open(session=session, workers=workers, **kwargs)
+
+    if isinstance(urls, str) or not all(isinstance(url, str) for url in urls or []):
+        raise TypeError("`urls` must be a list of string urls")
+    if not urls:
+        raise ValueError("`urls` is empty")
+    if concat_dim is None:
+        raise ValueError("`concat_dim` is required without a `manifest`")
+
+    def open_granule(url):
+        return open_url(url, session=session, protocol="dap4", **kwargs)
+
+    with ThreadPoolExecutor(min(workers, len(urls))) as pool:
+        datasets = list(pool.map(open_granule, urls))
+    return concat_datasets(datasets, concat_dim, urls, workers)
+
+
+def concat_datasets(datasets, concat_dim, urls=None, workers=GRANULE_WORKERS):
+    """Concatenate the remote variables of `datasets` along `concat_dim`.
+
+    The first dataset is returned, with the data of its variables that have
+    the dimension `concat_dim` replaced by a `ConcatProxy`.
+    """
+    urls = urls or [getattr(dataset, "name", "") for dataset in datasets]
+    concat_dim = concat_dim.lstrip("/")
+    dataset = datasets[0]
+    if concat_dim not in dataset.dimensions:
+        raise ValueError(f"`{concat_dim}` is not a dimension of {urls[0]}")
+    reference = {k: v for k, v in dataset.dimensions.items() if k != concat_dim}
+    for url, other in zip(urls[1:], datasets[1:]):
+        dimensions = {k: v for k, v in other.dimensions.items() if k != concat_dim}
+        if concat_dim not in other.dimensions or dimensions != reference:
+            raise ValueError(
+                f"The dimensions of {url} differ from those of {urls[0]}: "
+                f"{other.dimensions} != {dataset.dimensions}"
+            )
+
+    for var in walk(dataset, BaseType):
+        dims = [dim.lstrip("/") for dim in var.dims or []]
+        if concat_dim not in dims:
+            continue
+        axis = dims.index(concat_dim)
+        proxies = []
+        for url, other in zip(urls, datasets):
+            try:
+                proxy = other[var.id].data
+            except KeyError:
+                raise ValueError(f"`{var.id}` is missing from {url}") from None
+            if proxy.dtype != var.dtype:
+                raise ValueError(
+                    f"The type of `{var.id}` in {url} differs from that of {urls[0]}"
+                )
+            proxies.append(proxy)
+        var.data = ConcatProxy(proxies, axis, workers)
+    dataset.dimensions[concat_dim] = sum(
+        other.dimensions[concat_dim] for other in datasets
+    )
+    return dataset
+
+
+def _granule_base_url(url):
+    """The base url of the proxies of a DAP4 granule: no query, and `dap4://`
+    replaced by `https://`."""
+    scheme, netloc, path, _, _, fragment = urlparse(url)
+    if scheme in ("dap2", "dap4"):
+        scheme = "https"
+    if path.endswith(".dmr"):
+        path = path[: -len(".dmr")]
+    return urlunsplit((scheme, netloc, path, "", fragment))
+
+
+def _encode_array(data):
+    data = np.ascontiguousarray(data)
+    return {
+        "dtype": data.dtype.str,
+        "shape": list(data.shape),
+        "data": base64.b64encode(data.tobytes()).decode("ascii"),
+    }
+
+
+def _decode_array(value):
+    data = np.frombuffer(base64.b64decode(value["data"]), dtype=value["dtype"])
+    return data.reshape(value["shape"]).copy()
+
+
+def _dimension_urls(base_url, sizes, batch=True):
+    """The urls of `consolidate_metadata` for the dimensions `sizes`: a single
+    request with `batch`, one per dimension otherwise."""
+    check = "&dap4.checksum=true"
+    if batch:
+        ce = "%3B".join(
+            dim + "%5B0%3A1%3A" + str(size - 1) + "%5D" for dim, size in sizes.items()
+        )
+        return [base_url + ".dap?dap4.ce=" + ce + check]
+    return [
+        base_url + ".dap?dap4.ce=/" + dim + "[0:1:" + str(size - 1) + "]" + check
+        for dim, size in sizes.items()
+    ]
+
+
+def _fetch_values(url, names, session):
+    """The values of the variables `names` in the DAP4 response of `url`."""
+    r = GET(url, session=session)
+    pyds = UNPACKDAP4DATA(r, checksums=True).dataset
+    return {name: np.asarray(pyds[name][:].data) for name in names}
+
+
+def _fetch_concat_values(urls, concat_dim, session, workers=GRANULE_WORKERS):
+    def values(url):
+        return _fetch_values(url, [concat_dim], session)[concat_dim]
+
+    with ThreadPoolExecutor(min(workers, len(urls))) as pool:
+        return list(pool.map(values, urls))
+
+
+class CubeManifest:
+    """
+    Everything needed to open a datacube of DAP4 granules without a request.
+
+    A manifest holds the DMR of the first granule, the values of the
+    dimensions shared by all granules, the values of `concat_dim` in each
+    granule and the urls of the granules. It is written as a single JSON
+    file, with the arrays base64 encoded, that can be shipped next to the
+    code reading the datacube (e.g. to many workers)::
+
+        >>> CubeManifest.from_urls(urls, "time").write("cube.json")  # doctest: +SKIP
+        >>> dataset = open_mfdataset(manifest="cube.json")  # doctest: +SKIP
+    """
+
+    version = 1
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        concat_dim: str,
+        dmr: str,
+        dimensions: Mapping[str, np.ndarray],
+        concat_values: Sequence[np.ndarray],
+    ):
+        if len(urls) != len(concat_values):
+            raise ValueError("There must be values of `concat_dim` for each url")
+        self.urls = list(urls)
+        self.concat_dim = concat_dim.lstrip("/")
+        self.dmr = dmr
+        self.dimensions = dict(dimensions)
+        self.concat_values = [np.asarray(values) for values in concat_values]
+
+    @classmethod
+    def from_urls(
+        cls,
+        urls: Sequence[str],
+        concat_dim: str,
+        session=None,
+        workers: int = GRANULE_WORKERS,
+        concat_urls: Optional[Sequence[str]] = None,
+        batch: bool = True,
+    ) -> "CubeManifest":
+        """Download the manifest of the datacube of `urls`.
+
+        This takes the DMR of the first granule, the shared dimensions (in
+        one request with `batch`, one per dimension otherwise), and one
+        request per granule for its values of `concat_dim` (from
+        `concat_urls` when given). The shared dimensions are requested with
+        the urls of `consolidate_metadata` for the same `batch`, so all of
+        them are served from the cache of `session` after it.
+        """
+        if session is None:
+            session = create_session()
+        concat_dim = concat_dim.lstrip("/")
+        base_urls = [_granule_base_url(url) for url in urls]
+        dmr = GET(base_urls[0] + ".dmr", session=session).text
+        dataset = open_url(base_urls[0], session=session, protocol="dap4", dmr=dmr)
+        if concat_dim not in dataset.dimensions:
+            raise ValueError(f"`{concat_dim}` is not a dimension of {urls[0]}")
+
+        variables = dataset.variables()
+        sizes = {
+            name: dataset.dimensions[name]
+            for name in sorted(dataset.dimensions)
+            if name != concat_dim and name in variables
+        }
+        dimensions = {}
+        if sizes:
+            urls_names = zip(
+                _dimension_urls(base_urls[0], sizes, batch),
+                [list(sizes)] if batch else [[name] for name in sizes],
+            )
+            for url, names in urls_names:
+                dimensions.update(_fetch_values(url, names, session))
+        if concat_urls is None:
+            concat_urls = [
+                url + ".dap?dap4.ce=/" + concat_dim + "&dap4.checksum=true"
+                for url in base_urls
+            ]
+        concat_values = _fetch_concat_values(concat_urls, concat_dim, session, workers)
+        return cls(urls, concat_dim, dmr, dimensions, concat_values)
+
+    def append(
+        self,
+        urls: Sequence[str],
+        session=None,
+        workers: int = GRANULE_WORKERS,
+    ) -> List[str]:
+        """Add the granules of `urls` that are not in the manifest yet.
+
+        Only the DMRs and the values of `concat_dim` of the new granules are
+        downloaded. Their dimensions, other than `concat_dim`, must be those
+        of the manifest. Return the urls added.
+        """
+        known = set(self.urls)
+        urls = [url for url in dict.fromkeys(urls) if url not in known]
+        if not urls:
+            return []
+        if session is None:
+            session = create_session()
+        base_urls = [_granule_base_url(url) for url in urls]
+        reference = dmr_to_dataset(self.dmr).dimensions
+        reference = {k: v for k, v in reference.items() if k != self.concat_dim}
+
+        def dimensions(url):
+            dmr = GET(url + ".dmr", session=session).text
+            return dmr_to_dataset(dmr).dimensions
+
+        with ThreadPoolExecutor(min(workers, len(urls))) as pool:
+            granules = list(pool.map(dimensions, base_urls))
+        for url, dims in zip(urls, granules):
+            other = {k: v for k, v in dims.items() if k != self.concat_dim}
+            if self.concat_dim not in dims or other != reference:
+                raise ValueError(
+                    f"The dimensions of {url} differ from those of the datacube: "
+                    f"{dims} != {reference}"
+                )
+        # the urls of `consolidate_metadata`, to share its cache keys
+        concat_urls = [
+            url
+            + ".dap?dap4.ce=/"
+            + self.concat_dim
+            + "%5B0:1:"
+            + str(dims[self.concat_dim] - 1)
+            + "%5D&dap4.checksum=true"
+            for url, dims in zip(base_urls, granules)
+        ]
+        self.concat_values += _fetch_concat_values(
+            concat_urls, self.concat_dim, session, workers
+        )
+        self.urls += urls
+        return urls
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "urls": self.urls,
+            "concat_dim": self.concat_dim,
+            "dmr": self.dmr,
+            "dimensions": {
+                name: _encode_array(data) for name, data in self.dimensions.items()
+            },
+            "concat_values": [_encode_array(data) for data in self.concat_values],
+        }
+
+    @classmethod
+    def from_dict(cls, manifest: dict) -> "CubeManifest":
+        if manifest.get("version") != cls.version:
+            raise ValueError(
+                f"Unsupported manifest version: {manifest.get('version')}"
+            )
+        return cls(
+            manifest["urls"],
+            manifest["concat_dim"],
+            manifest["dmr"],
+            {
+                name: _decode_array(value)
+                for name, value in manifest["dimensions"].items()
+            },
+            [_decode_array(value) for value in manifest["concat_values"]],
+        )
+
+    def write(self, path: Union[str, Path]) -> Path:
+        """Write the manifest to `path`, replacing it atomically."""
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> "CubeManifest":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def open(self, session=None, workers: int = GRANULE_WORKERS, **kwargs):
+        """Return the datacube, as `open_mfdataset`, without any request.
+
+        The keyword arguments are passed to `open_url`.
+        """
+        dataset = open_url(
+            _granule_base_url(self.urls[0]),
+            session=session,
+            protocol="dap4",
+            dmr=self.dmr,
+            **kwargs,
+        )
+        base_urls = [_granule_base_url(url) for url in self.urls]
+        sizes = [len(values) for values in self.concat_values]
+        for var in walk(dataset, BaseType):
+            name = var.id.lstrip("/")
+            if name == self.concat_dim:
+                var.data = np.concatenate(self.concat_values)
+                continue
+            if name in self.dimensions:
+                var.data = self.dimensions[name]
+                continue
+            dims = [dim.lstrip("/") for dim in var.dims or []]
+            if self.concat_dim not in dims:
+                continue
+            axis = dims.index(self.concat_dim)
+            proxies = []
+            for url, size in zip(base_urls, sizes):
+                proxy = copy.copy(var.data)
+                proxy.baseurl = url
+                proxy.shape = proxy.shape[:axis] + (size,) + proxy.shape[axis + 1 :]
+                proxies.append(proxy)
+            var.data = ConcatProxy(proxies, axis, workers)
+        dataset.dimensions[self.concat_dim] = sum(sizes)
+        return dataset
+
+
 def consolidate_metadata(
     urls,
     session,
@@ -203,6 +717,8 @@ def consolidate_metadata(
     checksums=True,
     batch=True,
     ncores=None,
+    manifest=None,
+    append=False,
 ):
     """Consolidates the metadata of a collection of OPeNDAP DAP4 URLs belonging to
     data cube, i.e. urls share identical variables and dimensions. This is done
@@ -250,12 +766,28 @@ def consolidate_metadata(
     ncores: None | Int = None
         number of cores to use when parallelizing downloading dap responses. If
         ncores >= max_ncores (max cores computed internally), max_cores is chosen.
+    manifest: str | os.PathLike | None = None
+        When set, a `CubeManifest` of the datacube is written to this path,
+        from the cached responses. `open_mfdataset(manifest=...)` then opens
+        the datacube without any request. Requires a single `concat_dim`.
+    append: bool, optional (default=False)
+        Extend the datacube of an existing `manifest` with the `urls` that are
+        not in it yet, e.g. the granules of a daily product published since
+        the last consolidation. Only their DMRs and `concat_dim` values are
+        downloaded, and their dimensions are checked against those of the
+        manifest. `urls` may hold only the new granules. The other dimensions
+        of all granules then share the cache key of the first granule's, which
+        is requested once when `session` does not hold it yet.
     """
     if not isinstance(session, CachedSession):
         warnings.warn("session must be a requests_cache.CachedSession")
         return None
+    if append:
+        return _consolidate_append(urls, session, manifest, concat_dim, verbose)
     if not isinstance(urls, list) or len(urls) == 1:
         raise TypeError("urls must be a list of `len` >= 2. Try again!")
+    if manifest is not None and (not concat_dim or not isinstance(concat_dim, str)):
+        raise ValueError("A `manifest` requires a single `concat_dim`")
 
     # check elements in urls are strings
     if not all(isinstance(url, str) for url in urls):
@@ -356,34 +888,17 @@ def consolidate_metadata(
     named_dims = set.difference(dims, new_dims)
     dims = sorted(list(new_dims))
 
-    if batch:
-        constrains_dims = [
-            dim + "%5B0%3A1%3A" + str(results[0].dimensions[dim] - 1) + "%5D"
-            for dim in dims
-            if dim != concat_dim
-        ]
-        if len(constrains_dims) > 0:
-            new_urls = [
-                base_url + ".dap?dap4.ce=" + "%3B".join(constrains_dims) + _check
-            ]
-        else:
-            new_urls = []
-    else:
+    if not batch:
         warnings.warn(
             "Use of `batch` will be deprecated and will be removed in the future."
             " `batch=True` will be the default behavior in the next release.",
             DeprecationWarning,
         )
-        new_urls = [
-            base_url
-            + ".dap?dap4.ce=/"
-            + dim
-            + "[0:1:"
-            + str(results[0].dimensions[dim] - 1)
-            + "]"
-            + _check
-            for dim in dims
-        ]
+    new_urls = []
+    if dims:
+        # also the urls of `CubeManifest.from_urls`
+        sizes = {dim: results[0].dimensions[dim] for dim in dims}
+        new_urls = _dimension_urls(base_url, sizes, batch)
     dim_ces = set(
         [
             ";".join(
@@ -459,6 +974,48 @@ def consolidate_metadata(
         session_state = extract_session_state(session)
         max_workers = min(len(new_urls), 32)
         _ = download_all_urls(session_state, new_urls, ncores=max_workers)
+    if manifest is not None:
+        CubeManifest.from_urls(
+            urls, concat_dim[0], session, concat_urls=concat_dim_urls, batch=batch
+        ).write(manifest)
+    return None
+
+
+def _consolidate_append(urls, session, manifest, concat_dim=None, verbose=False):
+    """Add the new `urls` to the datacube consolidated in `manifest`."""
+    if manifest is None or not os.path.exists(manifest):
+        raise ValueError("`append` requires the `manifest` of a consolidated datacube")
+    if not all(isinstance(url, str) for url in urls):
+        raise TypeError("`urls` must be a list of string urls")
+    cube = CubeManifest.read(manifest)
+    if concat_dim and concat_dim != cube.concat_dim:
+        raise ValueError(
+            f"`concat_dim` must be `{cube.concat_dim}`, as in the manifest"
+        )
+    try:
+        new_urls = cube.append(urls, session)
+    except ValueError as e:
+        warnings.warn(f"{e}. Please check the URLs and try again.")
+        return None
+    if verbose:
+        print(f"appended {len(new_urls)} granules to the datacube")
+    if not new_urls:
+        return None
+    # the shared dimensions of every granule under a single cache key, built
+    # from the manifest, and cached once (unless already) from the first one
+    base_urls = [_granule_base_url(url) for url in cube.urls]
+    session.settings.key_fn = make_key_fn(
+        collapse_vars=cube.dimensions,
+        ignored_parameters=getattr(session.settings.key_fn, "_ignored_parameters", ()),
+        concat_dim=cube.concat_dim,
+        url_list=base_urls,
+    )
+    sizes = {name: len(values) for name, values in cube.dimensions.items()}
+    if sizes:
+        for url in _dimension_urls(base_urls[0], sizes, batch=False):
+            GET(url, session=session)
+    session.headers["consolidated"] = "True"
+    cube.write(manifest)
     return None
 
 
@@ -562,19 +1119,28 @@ def open_dmr_file(file_path):
     return dataset
 
 
-def open_dap_file(file_path):
+def open_dap_file(file_path, memmap=False, verify_checksums=False):
     """Open a file downloaded from a `.dap` (dap4) response.
 
     Parameters
     ----------
     file_path : str
         The path to the file.
+    memmap : bool, optional (default=False)
+        If `True`, only the metadata and the chunk headers are read, and
+        variables are memory-mapped views of the file, so that variables
+        larger than memory can be paged through.
+    verify_checksums : bool, optional (default=False)
+        If `True`, the CRC32 of every variable is compared with the checksum
+        stored in the file, and `ChecksumError` is raised on a mismatch.
     """
     """Open a file downloaded from a `.dap` (dap4) response, returning a
     dataset.
     """
     with open(file_path, "rb") as f:
-        return UNPACKDAP4DATA(f).dataset
+        return UNPACKDAP4DATA(
+            f, memmap=memmap, verify_checksums=verify_checksums
+        ).dataset
 
 
 def open_dods_file(file_path, das_path=None):
@@ -645,11 +1211,10 @@ def open_dods_url(
     """
     r = GET(url, application, session, timeout=timeout)
 
-    dds, data = r.body.split(b"\nData:\n", 1)
+    dds, data = _split_dods(r.body)
     dds = dds.decode(r.content_encoding or "ascii")
     dataset = dds_to_dataset(dds)
-    stream = StreamReader(BytesIO(data))
-    dataset.data = unpack_dap2_data(stream, dataset)
+    dataset.data = unpack_dap2_data(BufferReader(data), dataset)
 
     if metadata:
         scheme, netloc, path, query, fragment = urlsplit(url)
@@ -1682,13 +2247,28 @@ def create_key(
     return hashlib.sha256(key_material).hexdigest()
 
 
-def _init_worker(session_state, output_path, keep_variables, dim_slices, dmrVersion):
+def _init_worker(
+    session_state,
+    output_path,
+    keep_variables,
+    dim_slices,
+    dmrVersion,
+    verify_checksums=False,
+    encoding=None,
+    sink=None,
+    manifest=None,
+):
     global _G_SESSION_STATE, _G_OUTPUT_PATH, _G_KEEP_VARS, _G_DIM_SLICES, _G_DMR_VERSION
+    global _G_VERIFY_CHECKSUMS, _G_ENCODING, _G_SINK, _G_MANIFEST
     _G_SESSION_STATE = session_state
     _G_OUTPUT_PATH = str(output_path)  # keep pickling simple
     _G_KEEP_VARS = keep_variables
     _G_DIM_SLICES = dim_slices
     _G_DMR_VERSION = dmrVersion
+    _G_VERIFY_CHECKSUMS = verify_checksums
+    _G_ENCODING = encoding
+    _G_SINK = sink
+    _G_MANIFEST = manifest
 
 
 def _stream_worker(url):
@@ -1700,9 +2280,144 @@ def _stream_worker(url):
         keep_variables=_G_KEEP_VARS,
         dim_slices=_G_DIM_SLICES,
         dmrVersion=_G_DMR_VERSION,
+        verify_checksums=_G_VERIFY_CHECKSUMS,
+        encoding=_G_ENCODING,
+        sink=_G_SINK,
+        manifest=_G_MANIFEST,
     )
 
 
+class DownloadManifest:
+    """
+    Record of the granules downloaded by `to_netcdf` into a directory.
+
+    Each line of `MANIFEST_NAME` in the directory is a JSON object with the
+    url and constraint expression of a granule, its status (`started`,
+    `complete` or `failed`), and once complete the file it was written to,
+    its size in bytes, modification time and sha256 checksum. Lines are
+    appended (under a lock file, by the worker processes) and the last one of
+    a granule wins. With `to_netcdf(..., resume=True)`, complete granules
+    whose file still has the recorded size and modification time are not
+    downloaded again; the checksums are only compared with `verify_files`.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.path = self.directory / MANIFEST_NAME
+
+    @staticmethod
+    def key(url: str, dap_url: str) -> Tuple[str, str]:
+        """(url, constraint expression) identifying a granule."""
+        ce = dict(parse_qsl(urlsplit(dap_url).query)).get("dap4.ce", "")
+        return url, ce
+
+    def record(
+        self,
+        url: str,
+        dap_url: str,
+        status: str,
+        path: Optional[Union[str, Path]] = None,
+        error: Optional[str] = None,
+    ) -> dict:
+        """Append the `status` of the granule `url` to the manifest."""
+        entry = dict(zip(("url", "ce"), self.key(url, dap_url)))
+        entry["status"] = status
+        entry["time"] = dt.datetime.now(dt.timezone.utc).isoformat()
+        if path is not None:
+            path = Path(path)
+            entry["path"] = os.path.relpath(path, self.directory)
+            stat = path.stat()
+            entry["bytes"] = stat.st_size
+            entry["mtime"] = stat.st_mtime_ns
+            entry["checksum"] = "sha256:" + _file_sha256(path)
+        if error is not None:
+            entry["error"] = error
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with locked(self.path):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def entries(self) -> dict:
+        """The latest entry of each granule, by `key`."""
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # line cut short by a crash
+                entries[entry["url"], entry["ce"]] = entry
+        return entries
+
+    def is_complete(self, entry: Optional[dict], verify: bool = False) -> bool:
+        """Whether `entry` is complete, with its file unchanged since.
+
+        The size and modification time of the file are compared with those
+        recorded, and with `verify` (or for entries without a modification
+        time) its checksum too, which reads the whole file.
+        """
+        if entry is None or entry["status"] != "complete":
+            return False
+        if "path" not in entry:
+            return True  # written to a sink
+        path = self.directory / entry["path"]
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry["bytes"]:
+            return False
+        if "mtime" in entry and stat.st_mtime_ns != entry["mtime"]:
+            return False
+        if verify or "mtime" not in entry:
+            return "sha256:" + _file_sha256(path) == entry["checksum"]
+        return True
+
+    def pending(
+        self,
+        urls: Sequence[str],
+        keep_variables: Optional[Sequence[str]] = None,
+        dim_slices: Optional[
+            Union[Mapping[str, SliceTuple], Sequence[Mapping[str, SliceTuple]]]
+        ] = None,
+        verify: bool = False,
+    ) -> Tuple[List[str], Optional[Sequence]]:
+        """The urls (and their dim_slices) that are not complete yet.
+
+        See `is_complete` for `verify`.
+        """
+        entries = self.entries()
+        per_url = dim_slices is not None and not isinstance(dim_slices, Mapping)
+        keep = []
+        for i, url in enumerate(urls):
+            slices = dim_slices[i] if per_url else dim_slices
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                entry = entries.get(self.key(*_dap_url(url, keep_variables, slices)))
+            if self.is_complete(entry, verify):
+                continue
+            if entry is not None and entry["status"] == "complete":
+                warnings.warn(
+                    f"{entry['path']} does not match the manifest, "
+                    f"downloading {url} again"
+                )
+            keep.append(i)
+        if per_url:
+            dim_slices = [dim_slices[i] for i in keep]
+        return [urls[i] for i in keep], dim_slices
+
+
+def _file_sha256(path: Union[str, Path]) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
 def stream(
     url: str,
     session_state: Optional[dict] = None,
@@ -1710,29 +2425,74 @@ def stream(
     keep_variables: Optional[Sequence[str]] = None,
     dim_slices: Optional[Mapping[str, SliceTuple]] = None,
     dmrVersion: Optional[Union[str, None]] = None,
+    verify_checksums: bool = False,
+    encoding: Optional[Mapping[str, dict]] = None,
+    sink: Optional[Sink] = None,
+    manifest: Optional[DownloadManifest] = None,
 ) -> str:
     """
     Downloads a dap response and stores it to a local directory. When keep variables
     or dim_slices are passed, a constrained dap response is downloaded.
-    """
 
-    dap_url = url.split("?")[0] + ".dap"
-    ce = "?dap4.ce="
+    With `verify_checksums=True` the CRC32 of each variable is verified while
+    the response streams into the netCDF file. A corrupted (possibly cached)
+    response is evicted from the cache and downloaded again.
 
-    # session could be a request session object of a session state dict? dual use
-    # means that it could
-    if not session_state:
-        session = create_session()
-    else:
-        session = get_session(session_state)
+    `encoding` sets the chunking and compression of the netCDF variables, see
+    `UNPACKDAP4DATA`. By default they follow the `_ChunkSizes`,
+    `_DeflateLevel` and `_Shuffle` attributes of the remote variables.
+
+    With `sink` (e.g. `ZarrSink` or `NpySink` from `dapclient.sinks`), the
+    variables are written to it instead of a netCDF file in `output_path`.
+
+    The progress of the download is recorded in `manifest`, if given.
+    """
+
+    # one session per thread, so that consecutive streams from the same host
+    # reuse open connections.
+    session = get_session(session_state)
 
-    if output_path is None:
+    if output_path is None and sink is None:
         warnings.warn(
             "No location was provided. The file will be stored "
             "in the current directory by default"
         )
         output_path = Path(".")
 
+    url, dap_url = _dap_url(url, keep_variables, dim_slices)
+    if manifest is not None:
+        manifest.record(url, dap_url, "started")
+    try:
+        unpacked = _stream_response(
+            session,
+            dap_url,
+            output_path=output_path,
+            dmrVersion=dmrVersion,
+            verify_checksums=verify_checksums,
+            encoding=encoding,
+            sink=sink,
+        )
+    except BaseException as e:
+        if manifest is not None:
+            manifest.record(url, dap_url, "failed", error=f"{type(e).__name__}: {e}")
+        raise
+    if manifest is not None:
+        manifest.record(url, dap_url, "complete", path=unpacked.netcdf_path)
+    return url
+
+
+def _dap_url(
+    url: str,
+    keep_variables: Optional[Sequence[str]] = None,
+    dim_slices: Optional[Mapping[str, SliceTuple]] = None,
+) -> Tuple[str, str]:
+    """
+    The url and the `.dap` url (with its constraint expression) downloaded by
+    `stream`.
+    """
+    dap_url = url.split("?")[0] + ".dap"
+    ce = "?dap4.ce="
+
     if urlparse(url).query:
         if keep_variables:
             _ce = urlparse(url).query.replace("dap4.ce=", "").split(";")
@@ -1787,12 +2547,20 @@ def stream(
         dap_url += "&dap4.checksum=true"
     else:
         dap_url += "?dap4.checksum=true"
-    with session.get(dap_url, stream=True, timeout=(10, 120)) as r:
-        r.raise_for_status()
-        UNPACKDAP4DATA(
-            r=r, checksums=True, output_path=output_path, dmrVersion=dmrVersion
-        )
-    return url
+    return url, dap_url
+
+
+def _stream_response(session, dap_url, **kwargs) -> UNPACKDAP4DATA:
+    """Download `dap_url` into its destination, retrying corrupted responses."""
+    for attempt in range(CHECKSUM_RETRIES + 1):
+        with session.get(dap_url, stream=True, timeout=(10, 120)) as r:
+            r.raise_for_status()
+            try:
+                return UNPACKDAP4DATA(r=r, checksums=True, **kwargs)
+            except ChecksumError:
+                if attempt == CHECKSUM_RETRIES:
+                    raise
+                evict_cached_response(session, dap_url)
 
 
 def _run_process_batch(
@@ -1807,6 +2575,10 @@ def _run_process_batch(
     dmrVersion: Union[str, None] = None,
     *,
     desc: Optional[str] = None,
+    verify_checksums: bool = False,
+    encoding: Optional[Mapping[str, dict]] = None,
+    sink: Optional[Sink] = None,
+    manifest: Optional[DownloadManifest] = None,
 ) -> List[Tuple[str, BaseException]]:
     """
     Run stream() for each URL in a process pool. Return list of (url, exception)
@@ -1841,6 +2613,10 @@ def _run_process_batch(
                 keep_variables,
                 ds,
                 dmrVersion,
+                verify_checksums,
+                encoding,
+                sink,
+                manifest,
             ): url
             for url, ds in zip(urls, dim_slices_list)
         }
@@ -1875,6 +2651,10 @@ def _download_with_retries_process(
     max_workers_first: int = 32,
     max_workers_retry: int = 8,
     backoff_seconds: float = 10.0,
+    verify_checksums: bool = False,
+    encoding: Optional[Mapping[str, dict]] = None,
+    sink: Optional[Sink] = None,
+    manifest: Optional[DownloadManifest] = None,
 ) -> None:
     """
     Attempt downloads; retry only retryable failures up to max_attempts.
@@ -1897,6 +2677,10 @@ def _download_with_retries_process(
             dim_slices=dim_slices,
             dmrVersion=dmrVersion,
             max_workers=workers,
+            verify_checksums=verify_checksums,
+            encoding=encoding,
+            sink=sink,
+            manifest=manifest,
         )
 
         if not batch_failures:
@@ -1946,6 +2730,11 @@ def to_netcdf(
     dim_slices: Optional[
         Union[Mapping[str, SliceTuple], Sequence[Mapping[str, SliceTuple]]]
     ] = None,
+    verify_checksums: bool = False,
+    encoding: Optional[Mapping[str, dict]] = None,
+    sink: Optional[Sink] = None,
+    resume: bool = False,
+    verify_files: bool = False,
 ) -> None:
     """
     Downloads multiple dap4 responses in parallel, and stores them to a local directory.
@@ -1956,33 +2745,54 @@ def to_netcdf(
 
     If data is behind authentication (e.g EDL), make sure to provide session with auth
     or have a .netrc with proper credentials correctly in place.
+
+    Set `verify_checksums=True` to verify the CRC32 of every variable as it is
+    written. This matters most when `session` caches responses, since a
+    corrupted cached response would otherwise be written silently every time.
+
+    Variables are written slab by slab as they are decoded, with the chunking
+    and compression given per variable in `encoding` (keyword arguments of
+    `netCDF4.Dataset.createVariable`, e.g. `{"sst": {"zlib": True,
+    "complevel": 4}}`), or else taken from the `_ChunkSizes`, `_DeflateLevel`
+    and `_Shuffle` attributes of the remote variables.
+
+    Pass a `sink` from `dapclient.sinks` to write elsewhere than netCDF. The
+    responses are then written concurrently into a single store, e.g.
+    `ZarrSink("cube.zarr", concat_dim="time")` appends every granule to one
+    Zarr cube along `time` instead of producing a file per granule.
+
+    Every granule is recorded in a manifest in `output_path` (see
+    `DownloadManifest`): its constraint expression, status, and the size,
+    modification time and checksum of its file. With `resume=True`, the
+    granules that the manifest records as complete, and whose files have not
+    changed since, are skipped, so that an interrupted download restarts
+    where it stopped. Add `verify_files=True` to also compare the checksums of
+    these files, at the cost of reading all of them.
     """
+    if isinstance(urls, str):
+        urls = [urls]
+    manifest = DownloadManifest(
+        output_path if output_path is not None else getattr(sink, "path", ".")
+    )
+    if resume:
+        total = len(urls)
+        urls, dim_slices = manifest.pending(
+            urls, keep_variables, dim_slices, verify=verify_files
+        )
+        if len(urls) < total:
+            print(f"Skipping {total - len(urls)} granules already downloaded")
+        if not urls:
+            return []
+
     if session:
         session_state = extract_session_state(session)
     else:
         session_state = None
-        session = create_session()  # needed to check hyrax version
 
-    # check if cloud opendap url
+    # check if response comes from hyrax, and its build number. The server is
+    # probed at most once a day, see `dapclient.net.server_capabilities`.
     url = urls[0] if isinstance(urls, list) else urls
-    # check if response come sfrom hyrax, and its build number
-    dmrVersion = None
-    rv = session.get(url.split("?")[0] + ".ver")  # hyrax specific!
-    dmr_ver = rv.content.decode()
-    try:
-        root = ET.fromstring(dmr_ver)
-        ver = root.find("Hyrax").attrib.get("version")
-        ver_parts = ver.split("-")[0].split(".")  # major release only
-        # e.g. turns 1.17.1 into float value of 1.171
-        version = float(".".join(ver_parts[:-1]) + ver_parts[-1])
-        build_number = float(ver.split("-")[1])  # get build only
-        if version == 1.171 and build_number > 500:
-            # see https://github.com/pydap/pydap/issues/656
-            # enforce always 2.0 - some servers may indicate 1.0
-            dmrVersion = "2.0"
-    except ET.ParseError:
-        # server is not a Hyrax!
-        dmrVersion = None  # infers from dap response
+    dmrVersion = server_capabilities(url, session)["dmr_version"]
     if len(urls) == 1 or isinstance(urls, str):
         if isinstance(urls, list):
             urls = urls[0]
@@ -1994,6 +2804,10 @@ def to_netcdf(
                 keep_variables,
                 dim_slices,
                 dmrVersion=dmrVersion,
+                verify_checksums=verify_checksums,
+                encoding=encoding,
+                sink=sink,
+                manifest=manifest,
             )
         ]
 
@@ -2017,6 +2831,10 @@ def to_netcdf(
         max_workers_first=max_workers,
         max_workers_retry=8,
         backoff_seconds=10.0,
+        verify_checksums=verify_checksums,
+        encoding=encoding,
+        sink=sink,
+        manifest=manifest,
     )
 
 
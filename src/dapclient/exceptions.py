@@ -25,6 +25,10 @@ class ServerError(DapError):
     """Generic error with the server."""
 
 
+class ChecksumError(DapError):
+    """Exception raised when the CRC32 checksum of a DAP4 variable does not match."""
+
+
 class ConstraintExpressionError(ServerError):
     """Exception raised when an invalid constraint expression is given."""
 
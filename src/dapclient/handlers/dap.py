@@ -6,20 +6,30 @@ dataset to the internal model.
 
 """
 
+import asyncio
+import collections
 import copy
+import functools
 import gzip
 import io
 
 # handlers should be set by the application
 # http://docs.python.org/2/howto/logging.html#configuring-logging-for-a-library
 import logging
+import os
 import pprint
 import re
+import struct
 import sys
 import tempfile
+import threading
+import time
 import warnings
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BufferedReader, BytesIO
-from itertools import chain
+from itertools import chain, islice
 from pathlib import Path
 
 import numpy
@@ -28,19 +38,24 @@ import requests_cache
 from requests.utils import urlparse, urlunparse
 from webob.response import Response as webob_Response
 
+from dapclient.cache import ArrayCache, HyperslabCache, metadata_hash
+from dapclient.exceptions import ChecksumError, ServerError
 from dapclient.handlers.lib import BaseHandler, ConstraintExpression, IterData
 from dapclient.lib import (
     DAP2_ARRAY_LENGTH_NUMPY_TYPE,
     DEFAULT_TIMEOUT,
+    END_OF_SEQUENCE,
+    GRANULE_WORKERS,
+    PREFETCH_DEPTH,
+    SEQUENCE_BATCH_ROWS,
     START_OF_SEQUENCE,
-    BytesReader,
+    BufferReader,
     StreamReader,
     _quote,
     combine_slices,
     encode,
     fix_slice,
     hyperslab,
-    old_BytesReader,
     unquote,
     walk,
 )
@@ -50,10 +65,16 @@ from dapclient.model import (
     DatasetType,
     GridType,
     GroupType,
+    SelfClearingArray,
     SequenceType,
     StructureType,
 )
-from dapclient.net import GET
+from dapclient.net import (
+    GET,
+    aGET,
+    evict_cached_response,
+    get_capability_registry,
+)
 from dapclient.parsers import parse_ce
 from dapclient.parsers.das import add_attributes, parse_das
 from dapclient.parsers.dds import dds_to_dataset
@@ -80,6 +101,17 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 BLOCKSIZE = 512
+CHUNK_SIZE = 1048576
+DATA_MARKER = b"\nData:\n"  # separates the DDS from the XDR data in `.dods`
+CHECKSUM_SIZE = 4
+# times a response failing CRC32 verification is downloaded again
+CHECKSUM_RETRIES = 2
+# length prefix of DAP4 strings
+_UINT64_LE = struct.Struct("<Q")
+# elements cast at once when converting to the native byte order
+BYTESWAP_BLOCK = 2**16
+# bytes of a variable buffered before they are written to a netCDF file
+SLAB_SIZE = 16 * 2**20
 
 
 class DAPHandler(BaseHandler):
@@ -98,6 +130,10 @@ class DAPHandler(BaseHandler):
         user_charset="ascii",
         protocol=None,
         get_kwargs=None,
+        verify_checksums=False,
+        array_cache=None,
+        metadata=None,
+        hyperslab_cache=None,
     ):
 
         self.application = application
@@ -107,8 +143,18 @@ class DAPHandler(BaseHandler):
         self.timeout = timeout
         self.verify = verify
         self.checksums = checksums
+        self.verify_checksums = verify_checksums
         self.user_charset = user_charset
         self.get_kwargs = get_kwargs or {}
+        if array_cache is True:
+            array_cache = ArrayCache()
+        elif isinstance(array_cache, (str, os.PathLike)):
+            array_cache = ArrayCache(array_cache)
+        self.array_cache = array_cache
+        if hyperslab_cache is True:
+            hyperslab_cache = HyperslabCache()
+        self.hyperslab_cache = hyperslab_cache
+        self.dmr_hash = None
         self.url = url
         # urlparse returns an additional var compared to
         # urlsplit: `param`. Will toss it.
@@ -140,7 +186,7 @@ class DAPHandler(BaseHandler):
             self.fragment,
         )
         self.base_url = urlunparse(arg)
-        self.make_dataset()
+        self.make_dataset(metadata)
         self.add_proxies()
 
     def determine_protocol(self):
@@ -160,6 +206,11 @@ class DAPHandler(BaseHandler):
                 )
         if self.query[:4] == "dap4":
             return "dap4"
+        # never probed here: only a server already known (e.g. from
+        # `to_netcdf`, see `dapclient.net.server_capabilities`) is trusted
+        capabilities = get_capability_registry().get(self.url)
+        if not self.query and capabilities and capabilities["dap4"]:
+            return "dap4"
         else:
             warnings.warn(
                 "PyDAP was unable to determine the DAP protocol defaulting "
@@ -171,86 +222,60 @@ class DAPHandler(BaseHandler):
             )
             return "dap2"
 
-    def make_dataset(
-        self,
-    ):
+    def make_dataset(self, metadata=None):
+        metadata = metadata or {}
         if self.protocol == "dap4":
-            self.dataset_from_dap4()
+            self.dataset_from_dap4(metadata.get("dmr"))
         else:
-            self.dataset_from_dap2()
-            self.attach_das()
+            self.dataset_from_dap2(metadata.get("dds"))
+            self.attach_das(metadata.get("das"))
 
-    def dataset_from_dap4(self):
-        if not self.path.endswith(".dmr"):
-            path = self.path + ".dmr"
+    def metadata_urls(self):
+        """Return the urls of the metadata responses, keyed by their kind."""
+        if self.protocol == "dap4":
+            if not self.path.endswith(".dmr"):
+                path = self.path + ".dmr"
+            else:
+                path = self.path
+            parts = {"dmr": (path, _quote(self.query))}
         else:
-            path = self.path
-        dmr_url = urlunparse(
-            (
-                self.scheme,
-                self.netloc,
-                path,
-                "",
-                _quote(self.query),
-                self.fragment,
+            parts = {
+                "dds": (self.path + ".dds", _quote(self.query)),
+                "das": (self.path + ".das", self.query),
+            }
+        return {
+            kind: urlunparse(
+                (self.scheme, self.netloc, path, "", query, self.fragment)
             )
-        )
-        r = GET(
-            dmr_url,
-            self.application,
-            self.session,
-            timeout=self.timeout,
-            verify=self.verify,
-            get_kwargs=self.get_kwargs,
-        )
-        dmr = safe_charset_text(r, self.user_charset)
-        self.dataset = dmr_to_dataset(dmr, self.flat)
+            for kind, (path, query) in parts.items()
+        }
 
-    def dataset_from_dap2(self):
-        # escape for certain characters
-        dds_url = urlunparse(
-            (
-                self.scheme,
-                self.netloc,
-                self.path + ".dds",
-                "",
-                _quote(self.query),
-                self.fragment,
-            )
-        )
+    def _get_metadata(self, kind):
         r = GET(
-            dds_url,
+            self.metadata_urls()[kind],
             self.application,
             self.session,
             timeout=self.timeout,
             verify=self.verify,
             get_kwargs=self.get_kwargs,
         )
+        return safe_charset_text(r, self.user_charset)
+
+    def dataset_from_dap4(self, dmr=None):
+        if dmr is None:
+            dmr = self._get_metadata("dmr")
+        self.dmr_hash = metadata_hash(dmr)
+        self.dataset = dmr_to_dataset(dmr, self.flat)
 
-        dds = safe_charset_text(r, self.user_charset)
+    def dataset_from_dap2(self, dds=None):
+        if dds is None:
+            dds = self._get_metadata("dds")
         self.dataset = dds_to_dataset(dds)
 
-    def attach_das(self):
+    def attach_das(self, das=None):
         # Also pull the DAS and add additional attributes
-        das_url = urlunparse(
-            (
-                self.scheme,
-                self.netloc,
-                self.path + ".das",
-                "",
-                self.query,
-                self.fragment,
-            )
-        )
-        r = GET(
-            das_url,
-            self.application,
-            self.session,
-            timeout=self.timeout,
-            verify=self.verify,
-            get_kwargs=self.get_kwargs,
-        )
-        das = safe_charset_text(r, self.user_charset)
+        if das is None:
+            das = self._get_metadata("das")
         add_attributes(self.dataset, parse_das(das))
 
     def add_proxies(self):
@@ -291,6 +316,10 @@ class DAPHandler(BaseHandler):
                 verify=self.verify,
                 checksums=self.checksums,
                 get_kwargs={**self.get_kwargs, "stream": True},
+                verify_checksums=self.verify_checksums,
+                array_cache=self.array_cache,
+                dmr_hash=self.dmr_hash,
+                hyperslab_cache=self.hyperslab_cache,
             )
 
         for var in walk(self.dataset, SequenceType):
@@ -340,6 +369,9 @@ class DAPHandler(BaseHandler):
                 verify=self.verify,
                 get_kwargs={**self.get_kwargs, "stream": True},
             )
+        # variables reach their dataset in batch mode, ids are left as in the DDS
+        for var in walk(self.dataset):
+            var.dataset = self.dataset
 
         # apply projections
         for var in self.projection:
@@ -362,6 +394,50 @@ class DAPHandler(BaseHandler):
             var.set_output_grid(self.output_grid)
 
 
+class AsyncDAPHandler(DAPHandler):
+    """Build a dataset from a DAP base URL without blocking the event loop.
+
+    Creating the handler does not touch the network, but without `protocol`
+    it reads the capability registry (see `determine_protocol`), so that
+    `open_url_async` creates it on a worker thread. The metadata responses
+    are downloaded with `httpx.AsyncClient` by awaiting `open`:
+
+        >>> handler = AsyncDAPHandler(url, protocol="dap4")  # doctest: +SKIP
+        >>> dataset = await handler.open()  # doctest: +SKIP
+    """
+
+    def make_dataset(self, metadata=None):
+        if metadata is not None:
+            super().make_dataset(metadata)
+
+    def add_proxies(self):
+        if getattr(self, "dataset", None) is not None:
+            super().add_proxies()
+
+    async def _get_metadata_async(self, url):
+        if self.application:
+            # local WSGI applications are not reachable through httpx
+            r = await asyncio.to_thread(
+                GET, url, self.application, self.session, self.timeout, self.verify
+            )
+        else:
+            r = await aGET(
+                url, session=self.session, timeout=self.timeout, verify=self.verify
+            )
+        return safe_charset_text(r, self.user_charset)
+
+    async def open(self):
+        # the DDS and DAS of DAP2 are downloaded concurrently
+        urls = self.metadata_urls()
+        texts = await asyncio.gather(
+            *(self._get_metadata_async(url) for url in urls.values())
+        )
+        metadata = dict(zip(urls, texts))
+        self.make_dataset(metadata)
+        self.add_proxies()
+        return self.dataset
+
+
 def get_charset(r, user_charset):
     charset = r.charset
     if not charset:
@@ -382,24 +458,162 @@ def safe_charset_text(r, user_charset):
     return r.text
 
 
-def safe_dds_and_data(r, user_charset):
-    """
-    Takes the raw response of a dap2 request and splits it into the dds and data.
-    If the response is gzipped, it is decompressed first.
+def _split_dods(raw):
+    """Split a `.dods` response into the DDS and a view of the XDR data."""
+    i = raw.index(DATA_MARKER)
+    return raw[:i], memoryview(raw)[i + len(DATA_MARKER) :]
+
+
+class Prefetcher(object):
+    """Read ahead the hyperslabs of a loop stepping along one axis.
+
+    When the last three hyperslabs requested from a variable have the same
+    shape and only move along one axis, by the same stride, the next `depth`
+    hyperslabs of the loop are downloaded on a thread pool, so that they are
+    local when the loop gets there:
+
+        >>> prefetcher = var.prefetch(depth=8)  # doctest: +SKIP
+        >>> for t in range(nt):  # doctest: +SKIP
+        ...     step = var[t, :, :]
+        >>> prefetcher.hit_rate  # doctest: +SKIP
+
+    With `merge`, the slabs read ahead are downloaded as a single hyperslab
+    when they are adjacent or evenly spaced along the axis. A new batch is
+    read ahead when less than half of the next `depth` slabs are pending.
     """
-    dds, data = None, None  # initialize
-    if isinstance(r, webob_Response):
-        if r.content_encoding == "gzip":
-            raw = gzip.GzipFile(fileobj=BytesIO(r.body)).read()
+
+    def __init__(self, depth=PREFETCH_DEPTH, merge=True, workers=2):
+        self.depth = depth
+        self.merge = merge
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._history = collections.deque(maxlen=3)
+        self._entries = collections.OrderedDict()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        """Fraction of the requests answered with data read ahead."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, ranges):
+        """Return the hyperslab `ranges` and its checksum, if it was read ahead.
+
+        Waits for the download when it is still in flight. Returns
+        `(None, None)` when the hyperslab was not read ahead.
+        """
+        with self._lock:
+            for cached, future in reversed(self._entries.items()):
+                if len(cached) == len(ranges):
+                    local = HyperslabCache._local(ranges, cached)
+                    if local is not None:
+                        break
+            else:
+                self.misses += 1
+                return None, None
+        try:
+            data, checksum = future.result()
+        except Exception as e:
+            logger.warning("Reading ahead %s failed: %s" % (cached, e))
+            with self._lock:
+                self._entries.pop(cached, None)
+                self.misses += 1
+            return None, None
+        with self._lock:
+            self.hits += 1
+        if cached != ranges:
+            checksum = None
+        return data[local].copy(), checksum
+
+    def _stride(self):
+        """Return the axis and stride of the last requests, or None."""
+        if len(self._history) < 3:
+            return None
+        first, second, third = self._history
+        strides = set()
+        for a, b in ((first, second), (second, third)):
+            moved = [axis for axis, (r, s) in enumerate(zip(a, b)) if r != s]
+            if len(moved) != 1:
+                return None
+            axis = moved[0]
+            r, s = a[axis], b[axis]
+            if len(r) != len(s) or not len(r) or r.step != s.step:
+                return None
+            strides.add((axis, s.start - r.start))
+        if len(strides) != 1:
+            return None
+        return strides.pop()
+
+    def _pending(self, ranges):
+        return any(
+            len(cached) == len(ranges)
+            and HyperslabCache._local(ranges, cached) is not None
+            for cached in self._entries
+        )
+
+    def observe(self, proxy, ranges):
+        """Record a request of `proxy`, reading ahead when a stride shows up."""
+        if not ranges:
+            return
+        with self._lock:
+            self._history.append(ranges)
+            stride = self._stride()
+            if stride is None:
+                return
+            axis, delta = stride
+            last = ranges[axis]
+            n = proxy.shape[axis]
+            ahead = []
+            for i in range(1, self.depth + 1):
+                start = last.start + i * delta
+                stop = start + (len(last) - 1) * last.step + 1
+                if start < 0 or stop > n:
+                    break
+                slab = range(start, stop, last.step)
+                ahead.append(ranges[:axis] + (slab,) + ranges[axis + 1 :])
+            pending = [slab for slab in ahead if self._pending(slab)]
+            if not ahead or 2 * len(pending) >= len(ahead):
+                return
+            slabs = [slab for slab in ahead if slab not in pending]
+            for slab in self._merged(slabs, axis, last, delta):
+                self._schedule(proxy, slab)
+
+    def _merged(self, slabs, axis, last, delta):
+        """Return `slabs` as a single hyperslab when possible."""
+        if not self.merge or len(slabs) < 2:
+            return slabs
+        if len(last) == 1:
+            step = abs(delta)
+        elif abs(delta) == len(last) * last.step:
+            step = last.step
         else:
-            raw = r.body
-        _dds, data = raw.split(b"\nData:\n", 1)
-        dds = _dds.decode(get_charset(r, user_charset))
-    elif isinstance(r, requests.Response):
-        raw = r.content
-        _dds, data = raw.split(b"\nData:\n", 1)
-        dds = _dds.decode(user_charset)
-    return dds, data
+            return slabs
+        starts = [slab[axis].start for slab in slabs]
+        if max(starts) - min(starts) != (len(starts) - 1) * abs(delta):
+            # not evenly spaced anymore, some were already pending
+            return slabs
+        merged = range(min(starts), max(slab[axis][-1] for slab in slabs) + 1, step)
+        return [slabs[0][:axis] + (merged,) + slabs[0][axis + 1 :]]
+
+    def _schedule(self, proxy, ranges):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        self._entries[ranges] = self._executor.submit(proxy._fetch_ranges, ranges)
+        # keep the slabs being read, and the ones just read
+        while len(self._entries) > 2 * self.depth:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        """Stop reading ahead, and drop the slabs read ahead."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._entries.clear()
+            self._history.clear()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 class BaseProxyDap2(object):
@@ -434,29 +648,32 @@ class BaseProxyDap2(object):
         self.verify = verify
         self.user_charset = user_charset
         self.get_kwargs = get_kwargs or {}
+        self.ce = None
 
     def __repr__(self):
         return "BaseProxy(%s)" % ", ".join(
             map(repr, [self.baseurl, self.id, self.dtype, self.shape, self.slice])
         )
 
-    def __getitem__(self, index):
-        # build download url
+    def __getitem__(self, index, build_only=False):
+        if build_only:
+            # In batch mode: just store the projection, don't fetch
+            self.ce = self.projection(index)
+            return self
 
+        return self._download(self.build_url(index))[self.id].data
+
+    def grid(self, name, index):
+        """Download a hyperslab of the Grid `name` holding this array.
+
+        The array and all the maps of the Grid are decoded from a single
+        `.dods` response, and returned as the `GridType` of the response.
+        """
         index = combine_slices(self.slice, fix_slice(index, self.shape))
-        scheme, netloc, path, params, query, fragment = urlparse(self.baseurl)
-        url = urlunparse(
-            (
-                scheme,
-                netloc,
-                path + ".dods",
-                "",
-                self.id + hyperslab(index) + "&" + _quote(query),
-                fragment,
-            )
-        ).rstrip("&")
+        return self._download(self.projection_url(name + hyperslab(index)))[name]
 
-        # download and unpack data
+    def _download(self, url):
+        """Download and unpack a `.dods` response into a dataset."""
         logger.info("Fetching URL: %s" % url)
         r = GET(
             url,
@@ -464,15 +681,81 @@ class BaseProxyDap2(object):
             self.session,
             timeout=self.timeout,
             verify=self.verify,
-            get_kwargs=self.get_kwargs,
+            get_kwargs={"stream": True, **self.get_kwargs},
         )
+        try:
+            return self.unpack_dataset(r)
+        finally:
+            if isinstance(r, requests.Response):
+                r.close()
+
+    async def aget(self, index):
+        """Download `index` without blocking the event loop.
+
+        Returns the decoded variable. See `BaseType.aget`.
+        """
+        url = self.build_url(index)
+        logger.info("Fetching URL: %s" % url)
+        if self.application:
+            # local WSGI applications are not reachable through httpx
+            r = await asyncio.to_thread(
+                GET, url, self.application, self.session, self.timeout, self.verify
+            )
+        else:
+            r = await aGET(
+                url, session=self.session, timeout=self.timeout, verify=self.verify
+            )
+        return await asyncio.to_thread(self.unpack, r)
+
+    def build_url(self, index):
+        """Return the DAP2 url for a hyperslab of the variable."""
+        return self.projection_url(self.projection(index))
+
+    def projection(self, index):
+        """Return the DAP2 projection of a hyperslab of the variable."""
+        index = combine_slices(self.slice, fix_slice(index, self.shape))
+        return self.id + hyperslab(index)
 
-        dds, data = safe_dds_and_data(r, self.user_charset)
+    def projection_url(self, projection):
+        """Return the DAP2 url of `projection`, which may list several variables."""
+        scheme, netloc, path, params, query, fragment = urlparse(self.baseurl)
+        return urlunparse(
+            (
+                scheme,
+                netloc,
+                path + ".dods",
+                "",
+                projection + "&" + _quote(query),
+                fragment,
+            )
+        ).rstrip("&")
 
-        # Parse received dataset:
-        dataset = dds_to_dataset(dds)
-        dataset.data = unpack_dap2_data(old_BytesReader(data), dataset)
-        return dataset[self.id].data
+    def unpack(self, r):
+        """Decode a `.dods` response into the requested variable, as it streams in."""
+        return self.unpack_dataset(r)[self.id]
+
+    def unpack_dataset(self, r):
+        """Decode a `.dods` response into a dataset, as it streams in."""
+        if isinstance(r, webob_Response):
+            charset = get_charset(r, self.user_charset)
+            chunks = r.app_iter
+        elif isinstance(r, requests.Response):
+            charset = self.user_charset
+            chunks = r.iter_content(CHUNK_SIZE)
+        else:
+            charset = self.user_charset
+            chunks = r.iter_bytes(CHUNK_SIZE)
+        decoder = DAP2StreamDecoder(
+            lambda dds: dds_to_dataset(dds.decode(charset)),
+            gzip=getattr(r, "content_encoding", None) == "gzip",
+        )
+        for chunk in chunks:
+            if chunk:  # filter out keep-alive chunks
+                decoder.feed(chunk)
+        decoder.close()
+        dataset = decoder.dataset
+        dataset.data = decoder.data
+        return dataset
 
     def __len__(self):
         return self.shape[0]
@@ -501,6 +784,9 @@ class BaseProxyDap2(object):
 
 
 class BaseProxyDap4(BaseProxyDap2):
+    # reads ahead the hyperslabs of loops, see `BaseType.prefetch`
+    prefetcher = None
+
     def __init__(
         self,
         baseurl,
@@ -515,6 +801,10 @@ class BaseProxyDap4(BaseProxyDap2):
         checksums=False,
         user_charset="ascii",
         get_kwargs=None,
+        verify_checksums=False,
+        array_cache=None,
+        dmr_hash=None,
+        hyperslab_cache=None,
     ):
         self.baseurl = baseurl
         self.id = id
@@ -526,8 +816,16 @@ class BaseProxyDap4(BaseProxyDap2):
         self.timeout = timeout
         self.verify = verify
         self.checksums = checksums
+        self.verify_checksums = verify_checksums
         self.user_charset = user_charset
         self.get_kwargs = get_kwargs or {}
+        self.array_cache = array_cache
+        self.dmr_hash = dmr_hash
+        # decoded hyperslabs are reused from here, when not None
+        self.hyperslab_cache = hyperslab_cache
+        # the last hyperslab was sliced from a cached one, without the
+        # checksum of the server
+        self.checksum_missing = False
         self.ce = None
 
     def __repr__(self):
@@ -546,24 +844,39 @@ class BaseProxyDap4(BaseProxyDap2):
 
     def __getitem__(self, index, build_only=False):
         # build download url
-        index = combine_slices(self.slice, fix_slice(index, self.shape))
-
-        scheme, netloc, path, _, query, fragment = urlparse(self.baseurl)
-        if self.id.startswith("/"):
-            self.ce = "dap4.ce=" + self.id + hyperslab(index)
-        else:
-            self.ce = "dap4.ce=/" + self.id + hyperslab(index)
+        self.ce, url = self._build_ce_and_url(index)
 
         if build_only:
             # In batch mode: just store CE, don't fetch
             return self
-        url = urlunparse((scheme, netloc, path + ".dap", "", self.ce, fragment)).rstrip(
-            "&"
+
+        cache = self.hyperslab_cache
+        # hyperslabs of another session, or of a dataset since changed on the
+        # server, are never reused
+        key = (self.baseurl, self.id, self.dmr_hash, id(self.session))
+        ranges = HyperslabCache.normalize(
+            combine_slices(self.slice, fix_slice(index, self.shape)), self.shape
         )
-        if self.checksums:
-            url += "&dap4.checksum=true"
-        else:
-            url += "&dap4.checksum=false"
+        prefetcher = self.prefetcher
+        if prefetcher is not None:
+            data, checksum = prefetcher.get(ranges)
+            prefetcher.observe(self, ranges)
+            if data is not None:
+                return self._cached(data, checksum)
+        if cache is not None:
+            data, checksum = cache.get(key, ranges)
+            if data is not None:
+                return self._cached(data, checksum)
+        if self.array_cache is not None:
+            array_key = self.array_cache.key(
+                self.baseurl, self.id, ranges, self.dmr_hash
+            )
+            data = self.array_cache.get(array_key)
+            if data is not None:
+                if cache is not None:
+                    cache.put(key, ranges, data)
+                return self._cached(data)
+
         # download and unpack data
         logger.info("Fetching URL: %s" % url)
 
@@ -575,23 +888,192 @@ class BaseProxyDap4(BaseProxyDap2):
             _vars += [] if concat_dim is None else concat_dim
             if self.id not in _vars and "debug" not in self.session.cache.cache_name:
                 cache_kwargs = {"skip": True}
-        r = GET(
-            url,
-            self.application,
-            self.session,
-            timeout=self.timeout,
-            verify=self.verify,
-            get_kwargs=self.get_kwargs,
-            cache_kwargs=cache_kwargs,
-        )
-
-        dataset = UNPACKDAP4DATA(r, self.checksums, self.user_charset).dataset
-        self._data = dataset[self.id]._data
+        for attempt in range(CHECKSUM_RETRIES + 1):
+            r = GET(
+                url,
+                self.application,
+                self.session,
+                timeout=self.timeout,
+                verify=self.verify,
+                get_kwargs=self.get_kwargs,
+                cache_kwargs=cache_kwargs,
+            )
+            try:
+                variable = self.unpack(r)
+                break
+            except ChecksumError as e:
+                if attempt == CHECKSUM_RETRIES:
+                    raise
+                logger.warning("%s. Downloading %s again." % (e, url))
+                # do not let a corrupted response be served from the cache
+                evict_cached_response(self.session, url)
+        self._data = variable._data
+        self.checksum_missing = False
         if self.checksums:
-            self.checksums = dataset[self.id].attributes["_DAP4_Checksum_CRC32"]
+            self.checksums = variable.attributes["_DAP4_Checksum_CRC32"]
+        if cache is not None:
+            data = self._data
+            if isinstance(data, SelfClearingArray):
+                data = data.peek()
+            checksum = variable.attributes.get("_DAP4_Checksum_CRC32")
+            cache.put(key, ranges, data, checksum)
+        if self.array_cache is not None:
+            data = self._data
+            if isinstance(data, SelfClearingArray):
+                data = data.peek()
+            self.array_cache.put(array_key, data)
+
+        return self._data
 
+    def _fetch_ranges(self, ranges):
+        """Download the hyperslab `ranges`, bypassing the caches."""
+        proxy = copy.copy(self)
+        proxy.slice = tuple(slice(None) for s in self.shape)
+        proxy.prefetcher = proxy.hyperslab_cache = proxy.array_cache = None
+        index = tuple(slice(r.start, r.stop, r.step) for r in ranges)
+        data = proxy[index]
+        if isinstance(data, SelfClearingArray):
+            data = data.peek()
+        elif isinstance(data, DapDecodedArray):
+            data = data.array
+        return numpy.asarray(data), proxy.checksums if self.checksums else None
+
+    def _cached(self, data, checksum=None):
+        """Return cached values as `__getitem__` returns downloaded ones.
+
+        `checksum` is the one of the server, when `data` is exactly a
+        hyperslab it returned. Otherwise no checksum is reported.
+        """
+        self.checksum_missing = checksum is None
+        if self.checksums and checksum is not None:
+            self.checksums = checksum
+        if data.dtype.kind == "S":
+            self._data = data
+        else:
+            self._data = DapDecodedArray(data)
         return self._data
 
+    def build_url(self, index):
+        """Return the DAP4 url for a hyperslab of the variable."""
+        return self._build_ce_and_url(index)[1]
+
+    def _build_ce_and_url(self, index):
+        index = combine_slices(self.slice, fix_slice(index, self.shape))
+
+        scheme, netloc, path, _, query, fragment = urlparse(self.baseurl)
+        if self.id.startswith("/"):
+            ce = "dap4.ce=" + self.id + hyperslab(index)
+        else:
+            ce = "dap4.ce=/" + self.id + hyperslab(index)
+
+        url = urlunparse((scheme, netloc, path + ".dap", "", ce, fragment)).rstrip(
+            "&"
+        )
+        if self.checksums or self.verify_checksums:
+            url += "&dap4.checksum=true"
+        else:
+            url += "&dap4.checksum=false"
+        return ce, url
+
+    def unpack(self, r):
+        """Decode a `.dap` response into the requested variable."""
+        dataset = UNPACKDAP4DATA(
+            r,
+            self.checksums,
+            self.user_charset,
+            verify_checksums=self.verify_checksums,
+        ).dataset
+        return dataset[self.id]
+
+
+class ConcatProxy(object):
+    """A variable of several granules, concatenated along one axis.
+
+    Each of `proxies` holds the variable in one granule, as a `BaseProxyDap4`.
+    A slice is split at the boundaries of the granules: only the granules it
+    touches are requested, concurrently, and their values are written into
+    one preallocated array. See `dapclient.client.open_mfdataset`.
+    """
+
+    def __init__(self, proxies, axis, workers=GRANULE_WORKERS):
+        self.proxies = list(proxies)
+        self.axis = axis
+        self.workers = workers
+        self.dtype = self.proxies[0].dtype
+        lengths = [proxy.shape[axis] for proxy in self.proxies]
+        # index of the first element of each granule along `axis`
+        self.offsets = [0]
+        for length in lengths:
+            self.offsets.append(self.offsets[-1] + length)
+        shape = list(self.proxies[0].shape)
+        shape[axis] = self.offsets[-1]
+        self.shape = tuple(shape)
+
+    def __repr__(self):
+        return "ConcatProxy(%s)" % ", ".join(
+            map(repr, [self.proxies[0].id, self.dtype, self.shape, len(self.proxies)])
+        )
+
+    def parts(self, index):
+        """Split `index` into the slices of the granules it touches.
+
+        Return a list of `(granule, local index, output index)`, and the
+        shape of the output.
+        """
+        ranges = HyperslabCache.normalize(
+            combine_slices(
+                tuple(slice(None) for s in self.shape), fix_slice(index, self.shape)
+            ),
+            self.shape,
+        )
+        out = []
+        r = ranges[self.axis]
+        for i, proxy in enumerate(self.proxies):
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            # positions in `r` of the first and past the last element in the granule
+            first = min(len(r), max(0, -((r.start - start) // r.step)))
+            last = min(len(r), max(0, -((r.start - stop) // r.step)))
+            if first >= last:
+                continue
+            local = [slice(q.start, q.stop, q.step) for q in ranges]
+            local[self.axis] = slice(r[first] - start, r[last - 1] - start + 1, r.step)
+            position = [slice(None)] * len(ranges)
+            position[self.axis] = slice(first, last)
+            out.append((i, tuple(local), tuple(position)))
+        return out, tuple(len(q) for q in ranges)
+
+    def _fetch(self, granule, index):
+        # a copy, since proxies keep the state of their last request
+        data = copy.copy(self.proxies[granule])[index]
+        if isinstance(data, SelfClearingArray):
+            data = data.peek()
+        elif isinstance(data, DapDecodedArray):
+            data = data.array
+        return numpy.asarray(data)
+
+    def __getitem__(self, index):
+        parts, shape = self.parts(index)
+        if len(parts) == 1:
+            granule, local, _ = parts[0]
+            return self._fetch(granule, local)
+
+        out = numpy.empty(shape, self.dtype)
+
+        def fetch(part):
+            granule, local, position = part
+            out[position] = self._fetch(granule, local)
+
+        if parts:
+            with ThreadPoolExecutor(min(self.workers, len(parts))) as pool:
+                list(pool.map(fetch, parts))
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
 
 class SequenceProxy(object):
     """A proxy for remote sequences.
@@ -641,13 +1123,19 @@ class SequenceProxy(object):
 
     def __copy__(self):
         """Return a lightweight copy of the object."""
-        return self.__class__(
+        out = self.__class__(
             self.baseurl,
             self.template,
             self.selection[:],
             self.slice[:],
             self.application,
+            self.session,
+            self.timeout,
+            self.verify,
+            self.get_kwargs,
         )
+        out.sub_children = self.sub_children
+        return out
 
     def __getitem__(self, key):
         """Return a new object representing a subset of the data."""
@@ -660,6 +1148,8 @@ class SequenceProxy(object):
         # return a new object with requested columns
         elif isinstance(key, list):
             out.sub_children = True
+            # the template is shared with the original proxy
+            out.template = copy.copy(out.template)
             out.template._visible_keys = key
 
         # return a copy with the added constraints
@@ -700,8 +1190,8 @@ class SequenceProxy(object):
             id_ = self.template.id
         return id_
 
-    def __iter__(self):
-        # download and unpack data
+    def _data_chunks(self, chunk_size=1):
+        """Download the data, returning an iterator over its XDR payload."""
         r = GET(
             self.url,
             self.application,
@@ -716,7 +1206,7 @@ class SequenceProxy(object):
             if not hasattr(i, "__next__"):
                 i = iter(i)
         elif isinstance(r, requests.Response):
-            i = r.iter_content()
+            i = r.iter_content(chunk_size)
 
         # Fast forward past the DDS header
         # the pattern could span chunk boundaries though so make sure to check
@@ -733,10 +1223,27 @@ class SequenceProxy(object):
         def stream_start():
             yield last_chunk
 
-        stream = StreamReader(chain(stream_start(), i))
+        return chain(stream_start(), i)
 
+    def __iter__(self):
+        # download and unpack data
+        stream = StreamReader(self._data_chunks())
         return unpack_sequence(stream, self.template)
 
+    def iter_batches(self, rows=SEQUENCE_BATCH_ROWS):
+        """Download the data, yielding batches of up to `rows` records.
+
+        Each batch is a structured array with a field per column, in the
+        native byte order (or a plain array, for a single child of the
+        sequence). When every column is a scalar number the records are
+        unpacked in bulk, a whole chunk of the response at a time; otherwise
+        they are unpacked one by one, and strings and nested sequences are
+        stored as objects.
+        """
+        return unpack_sequence_batches(
+            self._data_chunks(CHUNK_SIZE), self.template, rows
+        )
+
     def __eq__(self, other):
         return ConstraintExpression("%s=%s" % (self.id, encode(other)))
 
@@ -756,23 +1263,55 @@ class SequenceProxy(object):
         return ConstraintExpression("%s<%s" % (self.id, encode(other)))
 
 
+def sequence_record_dtype(template):
+    """Return the layout of a record of `template` on the wire, or None.
+
+    Records have a fixed size when every column is a scalar number. Byte
+    columns are padded to 4 bytes, and Int16 and UInt16 are sent as 32-bit
+    integers; the padding is left out of the fields.
+    """
+    cols = list(template.children()) or [template]
+    names, formats, offsets = [], [], []
+    offset = 0
+    for col in cols:
+        if not isinstance(col, BaseType) or col.shape or col.dtype.char in "SU":
+            return None
+        response_dtype = DAP2_response_dtypemap(col.dtype)
+        names.append(col.name)
+        formats.append(response_dtype)
+        offsets.append(offset)
+        offset += response_dtype.itemsize + -response_dtype.itemsize % 4
+    return numpy.dtype(
+        {"names": names, "formats": formats, "offsets": offsets, "itemsize": offset}
+    )
+
+
+def sequence_batch_dtype(template):
+    """Return the dtype of the batches of `unpack_sequence_batches`."""
+    fields = []
+    for col in list(template.children()) or [template]:
+        if isinstance(col, BaseType) and col.dtype.char not in "SU":
+            fields.append((col.name, col.dtype.newbyteorder("="), col.shape))
+        else:
+            fields.append((col.name, object))
+    return numpy.dtype(fields)
+
+
 def unpack_sequence(stream, template):
     """Unpack data from a sequence, yielding records."""
     # is this a sequence or a base type?
     sequence = isinstance(template, SequenceType)
 
-    # if there are no children, we use the template as the only column
-    cols = list(template.children()) or [template]
-
-    # if there are no strings and no nested sequences we can unpack record by
-    # record easily
-    simple = all(isinstance(c, BaseType) and c.dtype.char not in "SU" for c in cols)
+    # if there are no strings, arrays or nested sequences we can unpack record
+    # by record easily
+    dtype = sequence_record_dtype(template)
 
-    if simple:
-        dtype = numpy.dtype([("", c.dtype, c.shape) for c in cols])
+    if dtype is not None:
+        out_dtype = sequence_batch_dtype(template)
         marker = stream.read(4)
         while marker == START_OF_SEQUENCE:
-            rec = numpy.frombuffer(stream.read(dtype.itemsize), dtype=dtype)[0]
+            rec = numpy.frombuffer(stream.read(dtype.itemsize), dtype=dtype)
+            rec = rec.astype(out_dtype)[0]
             if not sequence:
                 rec = rec[0]
             yield rec
@@ -789,6 +1328,65 @@ def unpack_sequence(stream, template):
             marker = stream.read(4)
 
 
+def unpack_sequence_batches(chunks, template, rows=SEQUENCE_BATCH_ROWS):
+    """Unpack a sequence from an iterable of bytes, yielding arrays of `rows` records.
+
+    When the records have a fixed size, the markers of all the complete
+    records in the buffer are checked at once, and the records in front of
+    the first END_OF_SEQUENCE are cast in a single call. Other sequences are
+    unpacked record by record with `unpack_sequence`.
+    """
+    dtype = sequence_record_dtype(template)
+    out_dtype = sequence_batch_dtype(template)
+    if isinstance(template, SequenceType):
+        column = None
+    else:
+        column = out_dtype.names[0]
+
+    if dtype is None:
+        records = unpack_sequence(StreamReader(iter(chunks)), template)
+        if column is not None:
+            records = ((record,) for record in records)
+        while True:
+            batch = list(islice(records, rows))
+            if not batch:
+                return
+            out = numpy.array(batch, dtype=out_dtype)
+            yield out if column is None else out[column]
+
+    stride = 4 + dtype.itemsize
+    start = numpy.frombuffer(START_OF_SEQUENCE, ">u4")[0]
+    buffer = bytearray()
+    pending, count = [], 0
+    done = False
+    for chunk in chunks:
+        buffer += chunk
+        n = len(buffer) // stride
+        markers = numpy.ndarray((n,), ">u4", buffer, 0, (stride,))
+        ends = numpy.flatnonzero(markers != start)
+        k = int(ends[0]) if ends.size else n
+        records = numpy.ndarray((k,), dtype, buffer, 4, (stride,))
+        block = records.astype(out_dtype)
+        del markers, records
+        marker = buffer[k * stride : k * stride + 4]
+        if len(marker) == 4 and marker != START_OF_SEQUENCE:
+            if marker != END_OF_SEQUENCE:
+                raise ServerError("Invalid marker in DAP2 sequence response.")
+            done = True
+        del buffer[: k * stride]
+        if block.size:
+            pending.append(block)
+            count += block.size
+        while count >= rows or (done and count):
+            batch = numpy.concatenate(pending)
+            out, rest = batch[:rows], batch[rows:]
+            pending, count = ([rest], rest.size) if rest.size else ([], 0)
+            yield out if column is None else out[column]
+        if done:
+            return
+    raise ServerError("Incomplete DAP2 sequence response.")
+
+
 def unpack_children(stream, template):
     """Unpack children from a structure, returning their data."""
     cols = list(template.children()) or [template]
@@ -819,7 +1417,7 @@ def convert_stream_to_list(stream, parser_dtype, shape, id):
             data = []
             for _ in range(n):
                 k = numpy.frombuffer(stream.read(4), DAP2_ARRAY_LENGTH_NUMPY_TYPE)[0]
-                data.append(stream.read(k))
+                data.append(bytes(stream.read(k)))
                 stream.read(-k % 4)
             out.append(
                 numpy.array([str(x.decode("ascii")) for x in data], "S").reshape(shape)
@@ -856,7 +1454,7 @@ def convert_stream_to_list(stream, parser_dtype, shape, id):
         # response_dtype.char should never be
         # 'U'
         k = numpy.frombuffer(stream.read(4), DAP2_ARRAY_LENGTH_NUMPY_TYPE)[0]
-        out.append(str(stream.read(k).decode("ascii")))
+        out.append(bytes(stream.read(k)).decode("ascii"))
         stream.read(-k % 4)
     # usual data
     else:
@@ -876,6 +1474,150 @@ def unpack_dap2_data(xdr_stream, dataset):
     return unpack_children(xdr_stream, dataset)
 
 
+class DAP2StreamDecoder:
+    """Incremental decoder of a DAP2 (`.dods`) response.
+
+    Bytes are passed to `feed` as they arrive. The DDS is collected up to the
+    `Data:` line and handed over, and the XDR payload of every array is then
+    copied straight into an array preallocated from the variable's shape,
+    which is converted to the native byte order in place once complete. Only
+    Int16 and UInt16, sent as 32-bit integers, need a cast. The response is
+    never held in memory as a whole, except when the dataset has sequences,
+    whose size is not known in advance: the payload is then buffered and
+    unpacked with `unpack_dap2_data` by `close`.
+
+    Parameters:
+    -----------
+        on_dds: callable(dds: bytes) -> DatasetType
+            called when the DDS is complete, returns the dataset it describes.
+        gzip: bool
+            the response is gzip compressed, and is decompressed as it comes.
+
+    Once closed, `dataset` is the dataset and `data` its data, nested as
+    returned by `unpack_dap2_data`.
+    """
+
+    def __init__(self, on_dds, gzip=False):
+        self.on_dds = on_dds
+        self.dataset = None
+        self.data = None
+        self._dds = bytearray()
+        self._inflate = zlib.decompressobj(wbits=31) if gzip else None
+        self._buffer = None
+        self._targets = None
+        self._target = None
+
+    def feed(self, data):
+        """Decode the next piece of the response."""
+        if self._inflate is not None:
+            data = self._inflate.decompress(data)
+        mv = memoryview(data)
+        if self.dataset is None:
+            mv = self._feed_dds(mv)
+        if self._buffer is not None:
+            self._buffer += mv
+            return
+        while mv and self._target is not None:
+            n = self._target.consume(mv)
+            mv = mv[n:]
+            if self._target.complete:
+                self._advance()
+
+    def close(self):
+        """Check that the response was complete, and finish decoding it."""
+        if self._inflate is not None:
+            self._inflate, inflate = None, self._inflate
+            self.feed(inflate.flush())
+        if self.dataset is None:
+            raise ServerError(bytes(self._dds).decode("utf-8", "replace"))
+        if self._buffer is not None:
+            self.data = unpack_dap2_data(BufferReader(self._buffer), self.dataset)
+        elif self._target is not None:
+            raise ServerError("Incomplete DAP2 response.")
+
+    def _feed_dds(self, mv):
+        start = max(0, len(self._dds) - len(DATA_MARKER) + 1)
+        self._dds += mv
+        i = self._dds.find(DATA_MARKER, start)
+        if i < 0:
+            return memoryview(b"")
+        rest = bytes(self._dds[i + len(DATA_MARKER) :])
+        self.dataset = self.on_dds(bytes(self._dds[:i]))
+        self._dds = None
+        if list(walk(self.dataset, SequenceType)):
+            self._buffer = bytearray()
+        else:
+            self._targets = self._unpack(self.dataset)
+            self._advance()
+        return memoryview(rest)
+
+    def _advance(self):
+        try:
+            self._target = next(self._targets)
+            while self._target.complete:
+                self._target = next(self._targets)
+        except StopIteration as stop:
+            self.data = stop.value
+            self._target = None
+
+    def _unpack(self, template):
+        """Yield the targets of the children of `template`, as `unpack_children`."""
+        out = []
+        for col in list(template.children()) or [template]:
+            if isinstance(col, StructureType):
+                out.append(tuple((yield from self._unpack(col))))
+            else:
+                out.append((yield from self._unpack_base(col)))
+        return out
+
+    def _unpack_base(self, var):
+        response_dtype = DAP2_response_dtypemap(var.dtype)
+        if response_dtype.char == "S":
+            return (yield from self._unpack_strings(var))
+        shape = ()
+        if var.shape:
+            header = _BytesTarget(8)  # the length, twice
+            yield header
+            n = int.from_bytes(header.data[:4], "big")
+            if n != numpy.prod(var.shape):
+                raise RuntimeError(
+                    (
+                        "variable {0} could not be properly "
+                        "retrieved. To avoid this "
+                        "error consider using open_url(..., "
+                        "output_grid=False)."
+                    ).format(var.id)
+                )
+            shape = var.shape
+        target = _ArrayTarget(shape, response_dtype)
+        yield target
+        if response_dtype.char == "B" and -target.data.size % 4:
+            # Unsigned Byte type is packed to multiples of 4 bytes:
+            yield _BytesTarget(-target.data.size % 4)
+        data = to_native(target.data)
+        if data.dtype.itemsize != var.dtype.itemsize:
+            data = data.astype(var.dtype.newbyteorder("="))
+        return data if shape else data[()]
+
+    def _unpack_strings(self, var):
+        count = 1
+        if var.shape:
+            header = _BytesTarget(4)
+            yield header
+            count = int.from_bytes(header.data, "big")
+        strings = []
+        for _ in range(count):
+            header = _BytesTarget(4)
+            yield header
+            k = int.from_bytes(header.data, "big")
+            chars = _BytesTarget(k + -k % 4)
+            yield chars
+            strings.append(bytes(chars.data[:k]).decode("ascii"))
+        if not var.shape:
+            return strings[0]
+        return numpy.array(strings, "S").reshape(var.shape)
+
+
 def find_pattern_in_string_iter(pattern, i):
     last_chunk = b""
     length = len(pattern)
@@ -930,13 +1672,10 @@ def get_count(variable):
 def decode_variable(buffer, start, variable, endian):
     dtype = variable.dtype
     if dtype.kind == "S":
-        DATA = []
-        stop = start
-        for i in range(int(numpy.prod(variable.shape))):
-            string, stop = decode_utf8_string_array(buffer, start=stop)
-            DATA.append(numpy.array(string).astype(dtype.kind))
-        data = numpy.array(DATA).reshape(variable.shape)
-        return data, stop
+        count = int(numpy.prod(variable.shape))
+        offsets, lengths, stop = scan_string_offsets(buffer, count, start)
+        chars = string_chars(buffer, offsets, lengths)
+        return decode_string_array(chars, lengths, variable.shape), stop
     else:
         stop = get_count(variable) + start
         dtype = dtype.newbyteorder(endian)
@@ -945,62 +1684,119 @@ def decode_variable(buffer, start, variable, endian):
         return DapDecodedArray(data), stop
 
 
-def decode_utf8_string_array(buffer, start=0):
-    offset = start
-    strings = []
-
-    # 1. Read 8-byte little-endian length
-    length_bytes = buffer[offset : offset + 8]
-    strlen = int.from_bytes(length_bytes, byteorder="little")
-    offset += 8
-
-    # 2. Read the UTF-8 string
-    str_bytes = buffer[offset : offset + strlen]
-    offset += strlen
+def scan_string_offsets(buffer, count, start=0):
+    """Locate `count` consecutive DAP4 strings in `buffer`.
 
-    # 3. Decode the bytes to Python string (UTF-8)
-    decoded_str = str_bytes.decode("utf-8")
-    strings.append(decoded_str)
+    Only the 8-byte length prefixes are read. Returns the offsets of the first
+    character of each string, their lengths in bytes, and the offset where
+    the last string ends.
+    """
+    offsets = []
+    lengths = []
+    pos, left = start, count
+    while left and pos + 8 <= len(buffer):
+        o, n, pos = _scan_available(buffer, pos, left)
+        offsets.append(o)
+        lengths.append(n)
+        left -= o.size
+    if left or pos > len(buffer):
+        raise ServerError("Incomplete DAP4 response.")
+    return _concatenate(offsets), _concatenate(lengths), pos
+
+
+def _concatenate(arrays):
+    return numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + arrays)
+
+
+def _scan_available(buffer, pos, count):
+    """Scan up to `count` strings whose length prefix is already in `buffer`.
+
+    Returns their offsets and lengths, and the offset where the last one ends,
+    which may lie beyond the end of `buffer`. Strings of equal length (e.g.
+    time stamps) have their prefixes at a fixed stride, and are checked all
+    at once.
+    """
+    size = len(buffer)
+    (n,) = _UINT64_LE.unpack_from(buffer, pos)
+    stride = n + 8
+    k = min(count, (size - pos - 8) // stride + 1)
+    if k > 1:
+        prefixes = numpy.ndarray(
+            (k,), dtype="<u8", buffer=buffer, offset=pos, strides=(stride,)
+        )
+        equal = bool((prefixes == n).all())
+        del prefixes  # release the buffer, which keeps growing
+        if equal:
+            offsets = pos + 8 + stride * numpy.arange(k, dtype=numpy.int64)
+            return offsets, numpy.full(k, n, dtype=numpy.int64), pos + k * stride
+    return _scan_loop(buffer, pos, count)
+
+
+def _scan_loop(buffer, pos, count):
+    unpack = _UINT64_LE.unpack_from
+    last = len(buffer) - 8
+    start = pos
+    lengths = []
+    append = lengths.append
+    for _ in range(count):
+        if pos > last:
+            break
+        (n,) = unpack(buffer, pos)
+        append(n)
+        pos += 8 + n
+    lengths = numpy.array(lengths, dtype=numpy.int64)
+    # every string starts after its own and all the previous prefixes
+    ends = numpy.cumsum(lengths)
+    offsets = start + 8 * numpy.arange(1, lengths.size + 1) + ends - lengths
+    return offsets, lengths, pos
 
-    return strings, offset
 
+def string_chars(buffer, offsets, lengths):
+    """Gather the characters of the strings at `offsets` into one uint8 array.
 
-def stream2bytearray(data):
+    The strings must be consecutive, each preceded by its 8-byte length prefix,
+    as returned by `scan_string_offsets`.
     """
-    Computes the buffer size of the (binary) data form dap response.
-    data is sent in chunks, with encoding in between. The encoding is
-    sent in packs of 4 bytes, which tells info about endianness, chunk type
-    and chunk size, and whether it is last chunk or not. Data inbetween chunks
-    is numeric (array) data in binary form that needs to be turn into native
-    numpy array data of size =  len(buffer). That last bit is done outside the
-    scope of this function.
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    if not int(lengths.sum()):
+        return numpy.empty(0, dtype=numpy.uint8)
+    start = int(offsets[0]) - 8
+    stop = int(offsets[-1] + lengths[-1])
+    raw = numpy.frombuffer(buffer, dtype=numpy.uint8)[start:stop]
+    # drop the length prefixes
+    keep = numpy.ones(raw.size, dtype=bool)
+    keep[(offsets - 8 - start)[:, None] + numpy.arange(8)] = False
+    return raw[keep]
+
+
+def decode_string_array(chars, lengths, shape, dtype=None):
+    """Build an array of strings from their concatenated UTF-8 bytes.
+
+    By default the result is a fixed width bytes array (`S<longest>`), filled
+    with a single masked assignment. With `dtype=object` the result holds
+    python `str` objects.
     """
-
-    # Precompute chunk positions
-    chunk_positions = []
-    offset = data.data.tell()  # current position in the stream
-    last = False
-    while not last:
-        # Read the chunk header
-        chunk_header = numpy.frombuffer(data.slice(offset=offset, n=4), dtype=">u4")[0]
-        chunk_size = chunk_header & 0x00FFFFFF
-        chunk_type = (chunk_header >> 24) & 0xFF
-        last, _, _ = decode_chunktype(chunk_type)
-        chunk_positions.append((offset + 4, chunk_size))
-        offset += 4 + chunk_size
-        if last:
-            break
-    # Process chunks serially (used to be parallelized- no penalty when serialized).
-    results = []
-    for offset, length in chunk_positions:
-        data.data.seek(offset)
-        results.append(data.data.read(length))
-
-    buffer = bytearray()
-    # Combine results
-    for chunk_data in results:
-        buffer.extend(chunk_data)
-    return buffer
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    count = lengths.size
+    if dtype is not None and numpy.dtype(dtype).kind == "O":
+        data = numpy.asarray(chars, dtype=numpy.uint8).tobytes()
+        bounds = numpy.concatenate(([0], numpy.cumsum(lengths))).tolist()
+        pairs = zip(bounds[:-1], bounds[1:])
+        if data.isascii():
+            # a single decode, then character offsets equal byte offsets
+            text = data.decode("ascii")
+            items = [text[a:b] for a, b in pairs]
+        else:
+            items = [data[a:b].decode("utf-8") for a, b in pairs]
+        out = numpy.empty(count, dtype=object)
+        out[:] = items
+        return out.reshape(shape)
+    width = max(int(lengths.max()) if count else 0, 1)
+    out = numpy.zeros(count, dtype="S%d" % width)
+    view = out.view(numpy.uint8).reshape(count, width)
+    view[numpy.arange(width) < lengths[:, None]] = chars
+    return out.reshape(shape)
 
 
 def get_endianness(chunk_header):
@@ -1010,6 +1806,609 @@ def get_endianness(chunk_header):
     return endian
 
 
+def to_native(data):
+    """Convert `data` to the native byte order, in place.
+
+    The bytes are swapped by casting blocks of the array onto a native view of
+    itself, so that numpy releases the GIL while it works. Memory-mapped
+    arrays are read-only and are returned unchanged.
+    """
+    if data.dtype.isnative or isinstance(data, numpy.memmap) or not data.size:
+        return data
+    flat = data.reshape(-1)
+    out = flat.view(flat.dtype.newbyteorder("="))
+    for i in range(0, flat.size, BYTESWAP_BLOCK):
+        out[i : i + BYTESWAP_BLOCK] = flat[i : i + BYTESWAP_BLOCK]
+    return out.reshape(data.shape)
+
+
+class CRC32:
+    """Running CRC32 of a variable, and the time spent computing it."""
+
+    def __init__(self):
+        self.value = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def update(self, data):
+        start = time.perf_counter()
+        self.value = zlib.crc32(data, self.value)
+        self.seconds += time.perf_counter() - start
+        self.nbytes += len(data)
+
+
+def check_crc32(variable, crc, checksum, endianness):
+    """Raise `ChecksumError` if `crc` differs from the checksum sent by the server."""
+    expected = int(numpy.frombuffer(bytes(checksum), dtype=endianness + "u4")[0])
+    if crc.value != expected:
+        raise ChecksumError(
+            "CRC32 checksum mismatch for variable %s: expected 0x%08x, got 0x%08x"
+            % (variable.id, expected, crc.value)
+        )
+
+
+class _ArrayTarget:
+    """Fixed size variable, copied straight into a preallocated array."""
+
+    def __init__(self, shape, dtype, crc=None):
+        self.data = numpy.empty(shape, dtype)
+        self.crc = crc
+        self._view = self.data.reshape(-1).view(numpy.uint8)
+        self._pos = 0
+
+    @property
+    def complete(self):
+        return self._pos == self._view.size
+
+    @property
+    def payload(self):
+        return self._view
+
+    def consume(self, mv):
+        n = min(len(mv), self._view.size - self._pos)
+        if n:
+            self._view[self._pos : self._pos + n] = numpy.frombuffer(
+                mv, numpy.uint8, count=n
+            )
+            self._pos += n
+            if self.crc is not None:
+                self.crc.update(mv[:n])
+        return n
+
+
+class _SlabTarget:
+    """Fixed size variable, passed on to `write` one slab of rows at a time.
+
+    Only one slab (`rows` along the first dimension) is held in memory.
+    """
+
+    def __init__(self, shape, dtype, rows, write, crc=None):
+        self.data = None
+        self.crc = crc
+        self._write = write
+        self._slab = numpy.empty((rows,) + tuple(shape[1:]), dtype)
+        self._view = self._slab.reshape(-1).view(numpy.uint8)
+        self._row_size = self._view.size // rows
+        self._size = int(numpy.prod(shape)) * dtype.itemsize
+        self._written = 0
+        self._pos = 0
+        self._row = 0
+
+    @property
+    def complete(self):
+        return self._written == self._size
+
+    def consume(self, mv):
+        n = min(len(mv), self._size - self._written, self._view.size - self._pos)
+        if n:
+            self._view[self._pos : self._pos + n] = numpy.frombuffer(
+                mv, numpy.uint8, count=n
+            )
+            if self.crc is not None:
+                self.crc.update(mv[:n])
+            self._pos += n
+            self._written += n
+        if self._pos == self._view.size or self.complete:
+            self._flush()
+        return n
+
+    def _flush(self):
+        rows = self._pos // self._row_size
+        if rows:
+            self._write((slice(self._row, self._row + rows),), self._slab[:rows])
+        self._row += rows
+        self._pos = 0
+
+
+class _BytesTarget:
+    """Small fixed size field, e.g. a checksum."""
+
+    def __init__(self, size):
+        self.data = bytearray()
+        self._size = size
+
+    @property
+    def complete(self):
+        return len(self.data) == self._size
+
+    def consume(self, mv):
+        n = min(len(mv), self._size - len(self.data))
+        self.data += mv[:n]
+        return n
+
+
+class _StringTarget:
+    """Variable length strings: each an 8-byte little-endian length + UTF-8 bytes.
+
+    Whole pieces are appended to a buffer and the length prefixes are scanned
+    in place, recording where each string starts. Once the last string is in,
+    `finish` gathers the characters into one array (`chars`) and releases the
+    buffer. As in libdap, the checksum only covers the characters.
+    """
+
+    def __init__(self, count, crc=None):
+        self.data = bytearray()
+        self.crc = crc
+        self.offsets = []
+        self.lengths = []
+        self.chars = None
+        self._left = count
+        self._next = 0
+        self._complete = not count
+
+    @property
+    def complete(self):
+        return self._complete
+
+    def consume(self, mv):
+        if self.complete:
+            return 0
+        self.data += mv
+        size = len(self.data)
+        pos, left = self._next, self._left
+        while left and pos + 8 <= size:
+            offsets, lengths, pos = _scan_available(self.data, pos, left)
+            self.offsets.append(offsets)
+            self.lengths.append(lengths)
+            left -= offsets.size
+        self._next, self._left = pos, left
+        if left or size < pos:
+            return len(mv)
+        # give back what belongs to the next variable
+        excess = size - pos
+        del self.data[pos:]
+        self._complete = True
+        return len(mv) - excess
+
+    def finish(self):
+        if self.chars is not None:
+            return
+        self.offsets = _concatenate(self.offsets)
+        self.lengths = _concatenate(self.lengths)
+        self.chars = string_chars(self.data, self.offsets, self.lengths)
+        if self.crc is not None:
+            self.crc.update(self.chars)
+        self.data = None
+
+    def strings(self, shape, dtype=None):
+        self.finish()
+        return decode_string_array(self.chars, self.lengths, shape, dtype)
+
+
+# posix keeps the pages of an unlinked file reachable by its memmaps; other
+# systems (Windows) refuse to remove a file that is still mapped
+UNLINK_MAPPED_FILES = os.name == "posix"
+
+
+class _SpoolMaps:
+    """Remove a temporary spool file once it is closed and no longer mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.maps = 0
+        self.closed = False
+        self._lock = threading.RLock()
+
+    def track(self, array):
+        with self._lock:
+            self.maps += 1
+        # the mmap is finalized after it is unmapped, unlike the memmap
+        weakref.finalize(array._mmap, self._release)
+        return array
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._remove()
+
+    def _release(self):
+        with self._lock:
+            self.maps -= 1
+            self._remove()
+
+    def _remove(self):
+        if self.closed and not self.maps:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class _SpoolTarget:
+    """Fixed size variable, appended to a (named) spool file."""
+
+    def __init__(self, spool, shape, dtype, crc=None, maps=None):
+        self.spool = spool
+        self.maps = maps
+        self.crc = crc
+        self.shape = shape
+        self.dtype = dtype
+        self.offset = spool.tell()
+        self._size = int(numpy.prod(shape)) * dtype.itemsize
+        self._written = 0
+
+    @property
+    def complete(self):
+        return self._written == self._size
+
+    @property
+    def payload(self):
+        return numpy.asarray(self.data).reshape(-1).view(numpy.uint8)
+
+    @property
+    def data(self):
+        if not self._size:
+            return numpy.empty(self.shape, self.dtype)
+        self.spool.flush()
+        data = numpy.memmap(
+            self.spool.name,
+            dtype=self.dtype,
+            mode="r",
+            offset=self.offset,
+            shape=self.shape,
+        )
+        return data if self.maps is None else self.maps.track(data)
+
+    def consume(self, mv):
+        n = min(len(mv), self._size - self._written)
+        self.spool.write(mv[:n])
+        self._written += n
+        if self.crc is not None:
+            self.crc.update(mv[:n])
+        return n
+
+
+class SegmentedMemmap:
+    """Read-only, memory-mapped array whose bytes are split in segments of a file.
+
+    A variable of a local `.dap` file usually spans several DAP4 chunks, with a
+    chunk header between each of them. Indexing reads only the rows (along the
+    first axis) needed from the mapped file, so that multi-GB variables can be
+    paged through.
+
+    Parameters:
+    -----------
+        filename: str
+            path to the file.
+        dtype: numpy.dtype
+        shape: tuple
+        segments: list[tuple[int, int]]
+            `(file offset, size)` of each consecutive piece of the variable.
+    """
+
+    def __init__(self, filename, dtype, shape, segments):
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple(shape)
+        self.segments = list(segments)
+        sizes = [size for _, size in self.segments]
+        self._starts = numpy.cumsum([0] + sizes)
+        self._raw = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+
+    def __repr__(self):
+        return "SegmentedMemmap(%s)" % ", ".join(
+            map(repr, [self.filename, self.dtype, self.shape, len(self.segments)])
+        )
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data.astype(dtype) if dtype else data
+
+    def _read(self, start, stop):
+        out = numpy.empty(stop - start, numpy.uint8)
+        i = max(int(numpy.searchsorted(self._starts, start, side="right")) - 1, 0)
+        pos = start
+        while pos < stop:
+            offset, size = self.segments[i]
+            lo = pos - self._starts[i]
+            n = min(size - lo, stop - pos)
+            out[pos - start : pos - start + n] = self._raw[
+                offset + lo : offset + lo + n
+            ]
+            pos += n
+            i += 1
+        return out
+
+    def _rows(self, start, stop):
+        row = self.dtype.itemsize * int(numpy.prod(self.shape[1:]))
+        raw = self._read(start * row, stop * row)
+        return raw.view(self.dtype).reshape((stop - start,) + self.shape[1:])
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if not self.shape:
+            return self._read(0, self.dtype.itemsize).view(self.dtype).reshape(())[
+                index
+            ]
+        n = self.shape[0]
+        first, rest = (index[0], index[1:]) if index else (slice(None), ())
+        if isinstance(first, (int, numpy.integer)):
+            i = int(first) + n if first < 0 else int(first)
+            if not 0 <= i < n:
+                raise IndexError(f"index {first} is out of bounds for size {n}")
+            return self._rows(i, i + 1)[(0,) + rest]
+        if isinstance(first, slice):
+            start, stop, step = first.indices(n)
+            if step > 0:
+                return self._rows(start, max(start, stop))[
+                    (slice(None, None, step),) + rest
+                ]
+        return self._rows(0, n)[index]
+
+
+class _ChunkTable:
+    """Offsets of the chunk payloads of a local `.dap` file."""
+
+    def __init__(self, f, chunks):
+        self.file = f
+        self.chunks = chunks
+        self.starts = numpy.cumsum([0] + [size for _, size in chunks])
+
+    def segments(self, start, n):
+        """Return `(file offset, size)` pieces of the payload `[start, start + n)`."""
+        out = []
+        i = max(int(numpy.searchsorted(self.starts, start, side="right")) - 1, 0)
+        while n > 0 and i < len(self.chunks):
+            offset, size = self.chunks[i]
+            lo = start - self.starts[i]
+            k = min(size - lo, n)
+            if k > 0:
+                out.append((offset + lo, int(k)))
+                start += k
+                n -= k
+            i += 1
+        if n > 0:
+            raise ServerError("Incomplete DAP4 response.")
+        return out
+
+    def read(self, start, n):
+        n = min(n, int(self.starts[-1]) - start)
+        out = bytearray()
+        for offset, size in self.segments(start, n) if n > 0 else []:
+            self.file.seek(offset)
+            out += self.file.read(size)
+        return bytes(out)
+
+
+class DAP4StreamDecoder:
+    """Incremental decoder of a chunked DAP4 (`.dap`) response.
+
+    Bytes are passed to `feed` as they arrive. The decoder strips the chunk
+    headers, hands over the DMR once its chunk is complete, and copies the
+    payload of every fixed size variable directly into a numpy array
+    preallocated from the variable's shape. The response is never held in
+    memory as a whole.
+
+    Parameters:
+    -----------
+        on_dmr: callable(dmr: bytes, endianness: str) -> list[BaseType]
+            called when the DMR is complete. Returns the variables in the
+            order in which they appear in the response.
+        on_variable: callable(variable: BaseType, data, checksum: bytes)
+            called each time a variable, and the checksum that follows it, is
+            decoded, in the order of the response and from the thread that
+            feeds the decoder. `data` has the byte order of the response,
+            unless `native` is set.
+        spool: binary file | None
+            named file opened for writing. When set, fixed size variables are
+            appended to it instead of being kept in memory, and `data` is a
+            read-only `numpy.memmap` view of the spool file.
+        spool_maps: _SpoolMaps | None
+            when set, every memmap of `spool` is tracked by it, so that the
+            file can be removed once the last one is released.
+        verify: bool
+            compute the CRC32 of every variable while it streams in, and raise
+            `ChecksumError` when it does not match the checksum that follows
+            the variable in the response.
+        native: bool
+            convert fixed size variables to the native byte order (except when
+            they are memory-mapped from `spool`).
+        executor: concurrent.futures.Executor | None
+            when set, each variable is finished (byte order conversion, string
+            decoding, checksum verification) on the executor as soon as its
+            bytes are in, while the next ones are still being received.
+        writer: object | None
+            when set, `writer.slab_rows(variable)` is asked for the number of
+            rows of each fixed size variable to buffer. Unless it returns
+            None, the variable is passed to `writer.write(variable, index,
+            slab)` slab by slab as it streams in, and `data` is None.
+    """
+
+    def __init__(
+        self,
+        on_dmr,
+        on_variable,
+        spool=None,
+        verify=False,
+        native=False,
+        executor=None,
+        writer=None,
+        spool_maps=None,
+    ):
+        self.on_dmr = on_dmr
+        self.writer = writer
+        self.on_variable = on_variable
+        self.spool = spool
+        self.spool_maps = spool_maps
+        self.verify = verify
+        self.native = native
+        self.executor = executor
+        self._pending = collections.deque()
+        self.verified_bytes = 0
+        self.verify_seconds = 0.0
+        self.endianness = None
+        self.done = False
+        self._header = bytearray()
+        self._remaining = 0
+        self._in_chunk = False
+        self._last = False
+        self._error = None
+        self._dmr = bytearray()
+        self._targets = iter(())
+        self._target = None
+
+    def feed(self, data):
+        """Decode the next piece of the response."""
+        mv = memoryview(data)
+        while mv and not self.done:
+            if not self._in_chunk:
+                n = 4 - len(self._header)
+                self._header += mv[:n]
+                mv = mv[n:]
+                if len(self._header) < 4:
+                    break
+                self._start_chunk(int.from_bytes(self._header, "big"))
+                self._header.clear()
+                if not self._remaining:
+                    self._end_chunk()
+                continue
+            n = min(self._remaining, len(mv))
+            piece, mv = mv[:n], mv[n:]
+            self._remaining -= n
+            if self._error is not None:
+                self._error += piece
+            elif self._dmr is not None:
+                self._dmr += piece
+            else:
+                self._consume(piece)
+            if not self._remaining:
+                self._end_chunk()
+
+    def close(self):
+        """Check that the response was complete, and deliver the last variables."""
+        if not self.done or self._target is not None:
+            raise ServerError("Incomplete DAP4 response.")
+        self._deliver(wait=True)
+
+    def _start_chunk(self, header):
+        self._in_chunk = True
+        self._remaining = header & 0x00FFFFFF
+        chunk_type = (header >> 24) & 0xFF
+        self._last, error, endian = decode_chunktype(chunk_type)
+        if self.endianness is None:
+            # the endianness of the first chunk applies to the whole response
+            self.endianness = endian
+        if error:
+            self._error = bytearray()
+
+    def _end_chunk(self):
+        self._in_chunk = False
+        if self._error is not None:
+            raise ServerError(bytes(self._error).decode("utf-8", "replace"))
+        if self._dmr is not None:
+            dmr, self._dmr = bytes(self._dmr), None
+            self._targets = self._iter_targets(self.on_dmr(dmr, self.endianness))
+            self._advance()
+        if self._last:
+            self.done = True
+
+    def _iter_targets(self, variables):
+        for variable in variables:
+            dtype = variable.dtype.newbyteorder(self.endianness)
+            crc = CRC32() if self.verify else None
+            # with an executor, fixed size variables are checked once complete
+            streamed_crc = crc if self.executor is None else None
+            rows = None
+            if self.writer is not None and variable.dtype.kind != "S":
+                rows = self.writer.slab_rows(variable)
+            if variable.dtype.kind == "S":
+                target = _StringTarget(int(numpy.prod(variable.shape)), crc)
+            elif rows:
+                write = functools.partial(self.writer.write, variable)
+                target = _SlabTarget(variable.shape, dtype, rows, write, crc)
+            elif self.spool is not None:
+                target = _SpoolTarget(
+                    self.spool, variable.shape, dtype, streamed_crc, self.spool_maps
+                )
+            else:
+                target = _ArrayTarget(variable.shape, dtype, streamed_crc)
+            yield target
+            checksum = _BytesTarget(CHECKSUM_SIZE)
+            yield checksum
+            args = (variable, target, crc, bytes(checksum.data))
+            if self.executor is None:
+                self._pending.append((variable, crc, args[3], self._finish(*args)))
+            else:
+                future = self.executor.submit(self._finish, *args)
+                self._pending.append((variable, crc, args[3], future))
+            self._deliver(wait=False)
+
+    def _finish(self, variable, target, crc, checksum):
+        if isinstance(target, _StringTarget):
+            data = target.strings(variable.shape)
+        else:
+            if crc is not None and target.crc is None:
+                crc.update(target.payload)
+            data = target.data
+            if self.native and data is not None:
+                data = to_native(data)
+        if crc is not None:
+            check_crc32(variable, crc, checksum, self.endianness)
+        return data
+
+    def _deliver(self, wait):
+        """Pass the finished variables to `on_variable`, in order."""
+        while self._pending:
+            variable, crc, checksum, data = self._pending[0]
+            if self.executor is not None:
+                if not (wait or data.done()):
+                    break
+                data = data.result()
+            self._pending.popleft()
+            if crc is not None:
+                self.verified_bytes += crc.nbytes
+                self.verify_seconds += crc.seconds
+            self.on_variable(variable, data, checksum)
+
+    def _advance(self):
+        self._target = next(self._targets, None)
+        while self._target is not None and self._target.complete:
+            self._target = next(self._targets, None)
+
+    def _consume(self, piece):
+        while piece and self._target is not None:
+            n = self._target.consume(piece)
+            piece = piece[n:]
+            if self._target.complete:
+                self._advance()
+
+
 class UNPACKDAP4DATA(object):
     """
     Unpacks DAP4 response, remote or local, which is split into chunks. The
@@ -1024,6 +2423,32 @@ class UNPACKDAP4DATA(object):
             pydap.net.GET if the dataset is remote (from a url), or a
             `io.BufferedReader` if the data is local within a filesystem.
             See `pydap.net.get.open_dap_file`
+        verify_checksums: bool
+            compute the CRC32 of each variable as it is decoded and raise
+            `ChecksumError` if it does not match the one in the response. The
+            bytes verified and the time spent are kept in `verified_bytes` and
+            `verify_seconds` (see also `checksum_throughput`).
+        native_byteorder: bool
+            convert the variables to the native byte order while decoding.
+            Memory-mapped variables keep the byte order of the response.
+        decode_workers: int | None
+            number of threads that finish decoding variables (byte order
+            conversion, strings, checksums) while the rest of the response is
+            being received. By default, variables are finished one after the
+            other in the calling thread.
+        encoding: dict | None
+            only with `output_path`. Per variable (by name or fully qualified
+            name) keyword arguments of `netCDF4.Dataset.createVariable`, e.g.
+            `{"sst": {"chunksizes": (1, 512, 512), "zlib": True,
+            "complevel": 4, "shuffle": True}}`. By default chunking and
+            compression follow the `_ChunkSizes`, `_DeflateLevel` and
+            `_Shuffle` attributes of the DMR, when present. Variables are
+            written as they are decoded, one slab (at most `SLAB_SIZE` bytes,
+            aligned with the chunks) at a time.
+        sink: dapclient.sinks.Sink | None
+            write the variables to `sink` as they are decoded instead of
+            keeping them in memory, e.g. `ZarrSink` or `NpySink`. Several
+            responses can be written into the same store concurrently.
     """
 
     def __init__(
@@ -1033,103 +2458,312 @@ class UNPACKDAP4DATA(object):
         user_charset="ascii",
         output_path: str | None = None,
         dmrVersion: str | None = None,
+        memmap: bool = False,
+        spool_path: str | None = None,
+        verify_checksums: bool = False,
+        native_byteorder: bool = False,
+        decode_workers: int | None = None,
+        encoding: dict | None = None,
+        sink=None,
     ):
         self.user_charset = user_charset
+        self.verify_checksums = verify_checksums
+        self.verified_bytes = 0
+        self.verify_seconds = 0.0
         self.checksums = checksums
         self.r = r
         self.output_path = Path(output_path) if output_path else output_path
+        self.encoding = encoding or {}
+        self.sink = sink
         self.nc = None
+        self.netcdf_path = None
+        self._ncvars = {}
         self._dims_cache: dict[tuple[str, tuple[int, ...]], list[str]] = {}
         self.dmrVersion = dmrVersion
-
-        try:
-            iterator = self.iter_body()
-            CHUNK_SIZE = 1048576
-            # remote dataset
-            with tempfile.TemporaryFile() as tmp:
-                # write the response to a temporary file
-                # so that we can read it in chunks
-                for chunk in iterator(chunk_size=CHUNK_SIZE):
-                    if chunk:  # filter out keep-alive chunks
-                        tmp.write(chunk)
-                tmp.seek(0)
-                self.raw = BytesReader(tmp)
-                self.dmr, self.endianness = self.safe_dmr_and_data()
-                dataset = dmr_to_dataset(self.dmr, dmrVersion=self.dmrVersion)
-                if self.output_path is not None:
-                    if not HAVE_NETCDF4:
-                        raise ImportError(
-                            "NetCDF4 is required for streaming output. "
-                            "Install with: pip install netCDF4"
-                        )
-                    self._init_netcdf_from_dmr(dataset)
-                self.dataset = self.unpack_dap4_data(dataset)
-        except TypeError:
-            if isinstance(r, webob_Response):
-                self.r = r
-                if self.r.content_encoding == "gzip":
-                    self.raw = BytesReader(
-                        gzip.GzipFile(fileobj=BytesIO(self.r.body)).read()
-                    )
-                else:
-                    self.raw = BytesReader(r.body)
-            elif isinstance(r, BufferedReader):
-                # r comes from reading a local file
-                self.r = webob_Response()  # make empty response
-                self.raw = BytesReader(r.read())
+        self.memmap = memmap and self.output_path is None and sink is None
+        self.spool_path = spool_path
+
+        if isinstance(r, BufferedReader):
+            # r comes from reading a local file
+            self.file = r
+            self.r = webob_Response()  # make empty response
+        self.dmr = None
+        self.endianness = None
+        self.dataset = None
+        self.checksum_dtype = None
+
+        if self.memmap and getattr(getattr(self, "file", None), "name", None):
+            # local file: map the variables in place
+            self._map_file()
+            self._log_verification()
+            return
+
+        spool = spool_maps = None
+        if self.memmap:
+            if spool_path is None:
+                spool = tempfile.NamedTemporaryFile(suffix=".dap", delete=False)
+                if not UNLINK_MAPPED_FILES:
+                    spool_maps = _SpoolMaps(spool.name)
             else:
-                raise TypeError("""
-                    Unrecognized file type object for unpacking dap4 binary data.
-                    Acceptable formats are `webob.response.Response` and
-                    `io.BufferedReader`
-                    """)
-            self.dmr, self.endianness = self.safe_dmr_and_data()
-            # need to split dmr from data
-            dataset = dmr_to_dataset(self.dmr)
-            self.dataset = self.unpack_dap4_data(dataset)
+                spool = open(spool_path, "wb")
+        executor = ThreadPoolExecutor(decode_workers) if decode_workers else None
+        decoder = DAP4StreamDecoder(
+            self._on_dmr,
+            self._on_variable,
+            spool=spool,
+            verify=verify_checksums,
+            native=native_byteorder,
+            executor=executor,
+            writer=self.writer,
+            spool_maps=spool_maps,
+        )
+        try:
+            for chunk in self.iter_body()(chunk_size=CHUNK_SIZE):
+                if chunk:  # filter out keep-alive chunks
+                    decoder.feed(chunk)
+            decoder.close()
+            self.verified_bytes = decoder.verified_bytes
+            self.verify_seconds = decoder.verify_seconds
+            self._log_verification()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            if self.nc is not None:
+                self.nc.close()
+            if sink is not None:
+                sink.close()
+            if spool is not None:
+                spool.close()
+                if spool_maps is not None:
+                    spool_maps.close()
+                elif spool_path is None:
+                    os.unlink(spool.name)
+
+    @property
+    def writer(self):
+        """Where the variables are written: `sink`, netCDF (`self`) or None."""
+        if self.sink is not None:
+            return self.sink
+        return self if self.output_path is not None else None
+
+    @property
+    def checksum_throughput(self):
+        """CRC32 verification throughput, in MB/s (None when nothing was verified)."""
+        if not self.verified_bytes or not self.verify_seconds:
+            return None
+        return self.verified_bytes / self.verify_seconds / 1e6
+
+    def _log_verification(self):
+        if self.verify_checksums:
+            logger.info(
+                "Verified CRC32 of %d bytes in %.4fs (%s MB/s)"
+                % (
+                    self.verified_bytes,
+                    self.verify_seconds,
+                    "%.1f" % self.checksum_throughput
+                    if self.checksum_throughput
+                    else "n/a",
+                )
+            )
 
     def iter_body(self):
         """
         enables iterate over a response, whether the response
-        if a requests.Response, requests_cache.Response, or
-        httpx.Respose
+        if a requests.Response, requests_cache.Response, httpx.Respose,
+        webob.Response or a local file.
         """
 
         if isinstance(self.r, requests.Response):
             return self.r.iter_content
         elif httpx is not None and isinstance(self.r, httpx.Response):
             return self.r.iter_bytes
+        elif hasattr(self, "file"):
+            return lambda chunk_size: iter(lambda: self.file.read(chunk_size), b"")
+        elif isinstance(self.r, webob_Response):
+            if self.r.content_encoding == "gzip":
+                body = gzip.GzipFile(fileobj=BytesIO(self.r.body))
+                return lambda chunk_size: iter(lambda: body.read(chunk_size), b"")
+            return lambda chunk_size: self.r.app_iter
+        else:
+            raise TypeError("""
+                Unrecognized file type object for unpacking dap4 binary data.
+                Acceptable formats are `requests.Response`, `httpx.Response`,
+                `webob.response.Response` and `io.BufferedReader`
+                """)
+
+    def decode_dmr(self, dmr):
+        """Decode the (binary) DMR, using the charset of the response."""
+        if isinstance(self.r, webob_Response):
+            return dmr.decode(get_charset(self.r, self.user_charset))
+        # figure out encoding defined in the xml header
+        match = re.search(rb'encoding=["\']([^"\']+)["\']', dmr)
+        if match:
+            encoding = match.group(1).decode("ascii")
         else:
-            raise TypeError("Unsupported response type")
+            encoding = self.user_charset
+        return dmr.decode(encoding)
+
+    def _on_dmr(self, dmr, endianness):
+        self.dmr = self.decode_dmr(dmr)
+        self.endianness = endianness
+        self.checksum_dtype = numpy.dtype(endianness + "u4")
+        dataset = dmr_to_dataset(self.dmr, dmrVersion=self.dmrVersion)
+        if self.sink is not None:
+            self.sink.open(dataset)
+        elif self.output_path is not None:
+            if not HAVE_NETCDF4:
+                raise ImportError(
+                    "NetCDF4 is required for streaming output. "
+                    "Install with: pip install netCDF4"
+                )
+            self._init_netcdf_from_dmr(dataset)
+        self.dataset = dataset
+        return list(walk(dataset, BaseType))
 
-    def safe_dmr_and_data(self):
-        """
-        Splits the dap response (.dap) into the dmr (metadata), and the raw
-        (binary) data. It also computes the endianness of the data.
+    def _map_file(self):
+        """Memory-map the variables of a local `.dap` file.
 
-        Returns:
-            dmr, data, endianness
+        Only the DMR and the chunk headers are read. Variables contained in a
+        single chunk are `numpy.memmap` views of the file, those that span
+        several chunks are `SegmentedMemmap`.
         """
-        # decode the first 4 bytes are CRLF
-        chunk_header = numpy.frombuffer(self.raw.read(4), dtype=">u4")[0]
-        dmr_length = chunk_header & 0x00FFFFFF
-        chunk_type = (chunk_header >> 24) & 0xFF
-        if isinstance(self.r, webob_Response):
-            dmr = self.raw.read(dmr_length).decode(
-                get_charset(self.r, self.user_charset)
-            )
-        else:
-            dmr = self.raw.read(dmr_length)
-            # figure out encoding defined in the xml header
-            match = re.search(rb'encoding=["\']([^"\']+)["\']', dmr)
-            if match:
-                encoding = match.group(1).decode("ascii")
+        f = self.file
+        f.seek(0)
+        header = int.from_bytes(f.read(4), "big")
+        size = header & 0x00FFFFFF
+        last, _, endianness = decode_chunktype((header >> 24) & 0xFF)
+        variables = self._on_dmr(f.read(size), endianness)
+
+        chunks = []
+        offset = 4 + size
+        while not last:
+            f.seek(offset)
+            header = f.read(4)
+            if len(header) < 4:
+                raise ServerError("Incomplete DAP4 response.")
+            header = int.from_bytes(header, "big")
+            size = header & 0x00FFFFFF
+            last, error, _ = decode_chunktype((header >> 24) & 0xFF)
+            if error:
+                raise ServerError(f.read(size).decode("utf-8", "replace"))
+            chunks.append((offset + 4, size))
+            offset += 4 + size
+        payload = _ChunkTable(f, chunks)
+
+        position = 0
+        for variable in variables:
+            dtype = variable.dtype.newbyteorder(endianness)
+            crc = CRC32() if self.verify_checksums else None
+            if dtype.kind == "S":
+                target = _StringTarget(int(numpy.prod(variable.shape)), crc)
+                while not target.complete:
+                    block = payload.read(position, BLOCKSIZE)
+                    if not block:
+                        raise ServerError("Incomplete DAP4 response.")
+                    position += target.consume(memoryview(block))
+                data = target.strings(variable.shape)
+            else:
+                nbytes = int(numpy.prod(variable.shape)) * dtype.itemsize
+                segments = payload.segments(position, nbytes)
+                if not nbytes:
+                    data = numpy.empty(variable.shape, dtype)
+                elif len(segments) == 1:
+                    data = numpy.memmap(
+                        f.name,
+                        dtype=dtype,
+                        mode="r",
+                        offset=segments[0][0],
+                        shape=variable.shape,
+                    )
+                else:
+                    data = SegmentedMemmap(f.name, dtype, variable.shape, segments)
+                if crc is not None:
+                    for offset, size in segments:
+                        f.seek(offset)
+                        while size > 0:
+                            block = f.read(min(size, CHUNK_SIZE))
+                            crc.update(block)
+                            size -= len(block)
+                position += nbytes
+            checksum = payload.read(position, CHECKSUM_SIZE)
+            position += CHECKSUM_SIZE
+            if crc is not None:
+                self.verified_bytes += crc.nbytes
+                self.verify_seconds += crc.seconds
+                check_crc32(variable, crc, checksum, endianness)
+            self._on_variable(variable, data, checksum)
+
+    def _ncvar(self, variable):
+        """The netCDF variable `variable` is written to."""
+        ncvar = self._ncvars.get(variable.id)
+        if ncvar is None:
+            name = variable.id.split("/")[-1]
+            if variable.parent is None or isinstance(variable.parent, DatasetType):
+                ncvar = self.nc.variables[name]
             else:
-                encoding = self.user_charset
-            dmr = dmr.decode(encoding)
-        # get endianness from first chunk
-        _, _, endianness = decode_chunktype(chunk_type)
-        return dmr, endianness
+                parent = unquote(variable.parent.id[1:])
+                ncvar = self.nc[parent].variables[name]
+            # raw packed data from pydap should be written raw
+            ncvar.set_auto_maskandscale(False)
+            self._ncvars[variable.id] = ncvar
+        return ncvar
+
+    def slab_rows(self, variable):
+        """Rows of `variable` to buffer before writing them to netCDF."""
+        if self.nc is None or not variable.shape or not variable.shape[0]:
+            return None
+        row = int(numpy.prod(variable.shape[1:])) * variable.dtype.itemsize
+        rows = max(1, SLAB_SIZE // max(row, 1))
+        chunking = self._ncvar(variable).chunking()
+        if chunking != "contiguous":
+            # whole chunks, so that compressed chunks are written only once
+            rows = max(chunking[0], rows // chunking[0] * chunking[0])
+        return min(rows, variable.shape[0])
+
+    def write(self, variable, index, data):
+        """Write a slab of `variable` to netCDF."""
+        self._ncvar(variable)[index] = data
+
+    def _on_variable(self, variable, data, checksum):
+        if self.writer is not None:
+            if data is not None:
+                self.writer.write(variable, (Ellipsis,), data)
+            variable._set_data(None)
+        elif data.dtype.kind == "S" or self.memmap:
+            variable._set_data(data)
+        else:
+            variable._set_data(DapDecodedArray(data))
+        if self.checksums:
+            variable.attributes["_DAP4_Checksum_CRC32"] = numpy.frombuffer(
+                checksum, dtype=self.checksum_dtype
+            )[0]
+
+    def _nc_encoding(self, var):
+        """Chunking and compression arguments for the netCDF variable of `var`."""
+        if var.dtype.kind == "S":
+            return {}
+        attrs = var.attributes
+        encoding = {}
+        if attrs.get("_ChunkSizes") is not None:
+            encoding["chunksizes"] = attrs["_ChunkSizes"]
+        level = attrs.get("_DeflateLevel")
+        if level is not None and int(level) > 0:
+            encoding.update(zlib=True, complevel=int(level))
+        shuffle = attrs.get("_Shuffle")
+        if shuffle is not None:
+            encoding["shuffle"] = str(shuffle).lower() in ("true", "1")
+        encoding.update(
+            self.encoding.get(var.id.lstrip("/"), self.encoding.get(var.name, {}))
+        )
+        chunks = encoding.pop("chunksizes", None)
+        if chunks is not None and var.shape and all(var.shape):
+            chunks = [int(c) for c in numpy.atleast_1d(chunks)]
+            if len(chunks) == len(var.shape):
+                # the response may be a subset smaller than the original chunks
+                encoding["chunksizes"] = tuple(
+                    max(1, min(c, s)) for c, s in zip(chunks, var.shape)
+                )
+        return encoding
 
     def _init_netcdf_from_dmr(self, dataset):
         """Create an empty netCDF4 file from a DMR description.
@@ -1144,6 +2778,8 @@ class UNPACKDAP4DATA(object):
             )
 
         FILL_KEYS = {"missing_value", "fmissing_value"}  # keep _FillValue
+        # applied as chunking and compression (see `_nc_encoding`)
+        STORAGE_KEYS = {"_ChunkSizes", "_DeflateLevel", "_Shuffle"}
 
         filename = unquote(dataset.name)
         if "nc4" in filename.split("."):
@@ -1154,7 +2790,8 @@ class UNPACKDAP4DATA(object):
         if not filename.endswith(".nc4"):
             filename = str(Path(filename).with_suffix("")) + ".nc4"
 
-        self.nc = Dataset(self.output_path / filename, "w")
+        self.netcdf_path = self.output_path / filename
+        self.nc = Dataset(self.netcdf_path, "w")
 
         # set attributes at dataset level
         for k, v in dataset.attributes.items():
@@ -1182,11 +2819,13 @@ class UNPACKDAP4DATA(object):
             }
             if len(_dims) != len(dataset[var].shape):
                 _dims = self._get_or_create_dims_for_var(var, dataset[var])
-            ncvar = self.nc.createVariable(**args, dimensions=_dims)
+            ncvar = self.nc.createVariable(
+                **args, dimensions=_dims, **self._nc_encoding(dataset[var])
+            )
 
             # copy attributes
             for k, v in dataset[var].attributes.items():
-                if k in {"Maps", "path"}:
+                if k in {"Maps", "path"} or k in STORAGE_KEYS:
                     continue
                 if k in FILL_KEYS:  # avoid writing multiple fill values
                     continue
@@ -1217,11 +2856,13 @@ class UNPACKDAP4DATA(object):
             # copy attributes
             if len(_dims) != len(dataset[var.id].shape):
                 _dims = self._get_or_create_dims_for_var(var, dataset[var.id])
-            ncvar = self.nc[parent].createVariable(**args, dimensions=_dims)
+            ncvar = self.nc[parent].createVariable(
+                **args, dimensions=_dims, **self._nc_encoding(var)
+            )
 
             # copy attributes
             for k, v in dataset[var.id].attributes.items():
-                if k in {"Maps", "path"}:
+                if k in {"Maps", "path"} or k in STORAGE_KEYS:
                     continue
                 if k in FILL_KEYS:  # avoid writing multiple fill values
                     continue
@@ -1314,44 +2955,3 @@ class UNPACKDAP4DATA(object):
 
         self._dims_cache[key] = phony
         return phony
-
-    def unpack_dap4_data(self, dataset):
-        """
-        Takes a pydap.DatasetType previously created, and populates its variables
-        (BaseType only) with data that is currently in binary form (within a dap
-        response).
-        """
-        checksum_dtype = numpy.dtype(self.endianness + "u4")
-        buffer = stream2bytearray(self.raw)
-        start = 0
-        for variable in walk(dataset, BaseType):
-            data, stop = decode_variable(
-                buffer,
-                start=start,
-                variable=variable,
-                endian=self.endianness,
-            )
-            if self.nc is not None:
-                name = variable.id.split("/")[-1]
-                if isinstance(variable.parent, DatasetType):
-                    ncvar = self.nc.variables[name]
-                else:
-                    parent = unquote(variable.parent.id[1:])
-                    ncvar = self.nc[parent].variables[name]
-                # raw packed data from pydap should be written raw
-                ncvar.set_auto_maskandscale(False)
-                ncvar[...] = data
-                variable._set_data(None)
-            else:
-                variable._set_data(data)
-            if self.checksums:
-                checksum = numpy.frombuffer(
-                    buffer[stop : stop + 4], dtype=checksum_dtype
-                )
-                variable.attributes["_DAP4_Checksum_CRC32"] = checksum[0]
-
-            # Jump over the 4 byte chunk_header
-            start = stop + 4
-        if self.nc is not None:
-            self.nc.close()
-        return dataset
@@ -53,6 +53,18 @@ START_OF_SEQUENCE = b"\x5a\x00\x00\x00"
 END_OF_SEQUENCE = b"\xa5\x00\x00\x00"
 STRING = "|S128"
 DEFAULT_TIMEOUT = 120  # 120 seconds = 2 minutes
+# records of a sequence returned at once by `iter_batches`
+SEQUENCE_BATCH_ROWS = 65536
+# slices of a loop read ahead by `BaseType.prefetch`
+PREFETCH_DEPTH = 4
+# longest batched DAP4 URL, under the limits of common servers and proxies
+BATCH_MAX_URL_LENGTH = 8000
+# concurrent requests of a batch split under the limits
+BATCH_WORKERS = 4
+# concurrent requests to the granules of `open_mfdataset`
+GRANULE_WORKERS = 8
+# bytes of map slices of remote DAP2 Grids kept by a dataset
+GRID_MAPS_CACHE_SIZE = 16 * 2**20
 
 NUMPY_TO_DAP2_TYPEMAP = {
     "d": "Float64",
@@ -427,24 +439,33 @@ class StreamReader(object):
             self.buf.extend(bytes_read)
 
         out = bytes(self.buf[:n])
-        self.buf = self.buf[n:]
+        del self.buf[:n]  # does not move the rest of the buffer
         return out
 
 
-class old_BytesReader(object):
-    """Class to allow reading a `bytes` object."""
+class BufferReader(object):
+    """Class to read a `bytes`-like object sequentially, without copying it.
+
+    `read` returns `memoryview` slices of the buffer and advances an offset,
+    so that unpacking a response costs time linear in its size.
+    """
 
     def __init__(self, data):
-        self.data = data
+        self.view = memoryview(data).cast("B")
+        self.pos = 0
 
-    def read(self, n):
-        """Read and return `n` bytes."""
-        out = self.data[:n]
-        self.data = self.data[n:]
-        return out
+    def read(self, n=-1):
+        """Read and return (a view of) `n` bytes, or all the remaining ones."""
+        start = self.pos
+        end = len(self.view) if n < 0 else min(start + n, len(self.view))
+        self.pos = end
+        return self.view[start:end]
 
     def peek(self, n):
-        return self.data[:n]
+        return self.view[self.pos : self.pos + n]
+
+    def tell(self):
+        return self.pos
 
 
 class BytesReader:
@@ -166,6 +166,7 @@ But this is discouraged as this will be deprecated soon. The ``.iterdata()`` is
 therefore highly recommended.
 """
 
+import contextlib
 import copy
 import operator
 import re
@@ -173,6 +174,7 @@ import threading
 import warnings
 from collections import OrderedDict
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from typing import Optional, Union
 
@@ -180,7 +182,21 @@ import numpy as np
 import requests
 import requests_cache
 
-from dapclient.lib import _quote, decode_np_strings, tree, unquote, walk
+from dapclient.cache import HyperslabCache
+from dapclient.lib import (
+    BATCH_MAX_URL_LENGTH,
+    BATCH_WORKERS,
+    GRID_MAPS_CACHE_SIZE,
+    PREFETCH_DEPTH,
+    SEQUENCE_BATCH_ROWS,
+    _quote,
+    combine_slices,
+    decode_np_strings,
+    fix_slice,
+    tree,
+    unquote,
+    walk,
+)
 from dapclient.net import GET
 
 __all__ = [
@@ -297,6 +313,24 @@ class DapType(object):
                 child.assign_dataset_recursive(dataset, child_path)
 
 
+def _is_dap2(var):
+    return type(var._data).__name__ == "BaseProxyDap2"
+
+
+def _batch_nbytes(var):
+    """Estimate the bytes of the pending slice of `var` in a DAP4 response."""
+    proxy = var._data
+    index = combine_slices(
+        proxy.slice, fix_slice(var._pending_batch_slice, proxy.shape)
+    )
+    size = 1
+    for s, n in zip(index, proxy.shape):
+        size *= len(range(*s.indices(n)))
+    # the length of strings is only known once they are read
+    itemsize = 64 if proxy.dtype.kind in "SUO" else proxy.dtype.itemsize
+    return size * itemsize
+
+
 class BatchPromise:
     def __init__(self):
         self._event = threading.Event()
@@ -318,6 +352,10 @@ class SelfClearingArray:
     def __init__(self, array):
         self._array = array
 
+    def peek(self):
+        """Return the array without clearing it (None once cleared)."""
+        return self._array
+
     def _consume(self):
         if self._array is None:
             raise RuntimeError("This array has already been cleared.")
@@ -376,6 +414,11 @@ class BatchFutureArray:
         return self
 
     def _wait(self):
+        dataset = self.basetype.dataset
+        if not self.promise.is_resolved() and getattr(dataset, "_batch_block", False):
+            raise RuntimeError(
+                "Batched data is only available after the `batch` block exits."
+            )
         return self.promise.wait_for_result(self.basetype.id)
 
     def __array__(self, dtype=None, copy=None):
@@ -387,6 +430,16 @@ class BatchFutureArray:
         return result
 
 
+class AsyncIndexer:
+    """Awaitable indexing of a `BaseType`, returned by `BaseType.aget`."""
+
+    def __init__(self, basetype):
+        self.basetype = basetype
+
+    def __getitem__(self, index):
+        return self.basetype._aget_item(index)
+
+
 class BaseType(DapType):
     """A thin wrapper over Numpy arrays."""
 
@@ -480,7 +533,7 @@ class BaseType(DapType):
         return self.itemsize * self.size
 
     def is_remote_dapdata(self):
-        return type(self._data).__name__ == "BaseProxyDap4"
+        return type(self._data).__name__ in ("BaseProxyDap2", "BaseProxyDap4")
 
     def __copy__(self):
         """A lightweight copy of the variable.
@@ -518,6 +571,7 @@ class BaseType(DapType):
         if (
             self.dataset
             and self.dataset.is_batch_mode()
+            and self.is_remote_dapdata()
             and self.id
             != "/" + str(self.dataset._session.headers.get("concat_dim", None))
         ):
@@ -531,7 +585,11 @@ class BaseType(DapType):
 
                 out._data = BaseProxyDap4(*self._original_data_args)
             else:
-                out._data = self._data
+                # DAP2: the projection is stored in the proxy
+                out._data = copy.copy(self._data)
+            if getattr(self.dataset, "_batch_block", False):
+                # inside `DatasetType.batch`: sent when the block exits
+                self.dataset.register_for_batch(out)
             return out
 
         out = copy.copy(self)
@@ -550,12 +608,58 @@ class BaseType(DapType):
                 pass  # Leave as-is for types that don't support __array__
         out.data = data
         if type(self._data).__name__ == "BaseProxyDap4":
-            if self._data.checksums:
+            if self._data.checksums and not self._data.checksum_missing:
                 # updates it if defined
                 out.attributes["_DAP4_Checksum_CRC32"] = self._data.checksums
             out.attributes.update({"Maps": self.Maps})
         return out
 
+    @property
+    def aget(self):
+        """Awaitable counterpart of `__getitem__`.
+
+        Remote data is downloaded without blocking the event loop, so that many
+        slices can be in flight at once::
+
+            >>> subset = await var.aget[0:10, :]  # doctest: +SKIP
+
+        """
+        return AsyncIndexer(self)
+
+    def prefetch(self, depth=PREFETCH_DEPTH, merge=True, workers=2):
+        """Read ahead the slices of a loop stepping along an axis.
+
+        Once the last slices of a remote DAP4 variable move along one axis by
+        a constant stride, the next `depth` slices are downloaded on a pool
+        of `workers` threads, as a single hyperslab when `merge` is True.
+        Returns the `Prefetcher`, which counts its hits. A `depth` of 0 stops
+        reading ahead.
+        """
+        if not hasattr(self._data, "prefetcher"):
+            raise TypeError("Only remote DAP4 variables can be prefetched.")
+        if self._data.prefetcher is not None:
+            self._data.prefetcher.close()
+            self._data.prefetcher = None
+        if depth:
+            from dapclient.handlers.dap import Prefetcher
+
+            self._data.prefetcher = Prefetcher(depth, merge, workers)
+        return self._data.prefetcher
+
+    async def _aget_item(self, index):
+        out = copy.copy(self)
+        if hasattr(self._data, "aget"):
+            variable = await self._data.aget(index)
+            out.data = variable._data
+            checksum = variable.attributes.get("_DAP4_Checksum_CRC32")
+            if checksum is not None:
+                out.attributes["_DAP4_Checksum_CRC32"] = checksum
+            if "Maps" in self.attributes:
+                out.attributes.update({"Maps": self.Maps})
+        else:
+            out.data = self._get_data_index(index)
+        return out
+
     def __len__(self):
         return len(self.data)
 
@@ -883,6 +987,9 @@ class DatasetType(StructureType):
         self._batch_timeout = 0.2
         self._batch_registry = set()
         self._batch_timer = None
+        self._batch_block = False
+        # map slices of remote DAP2 Grids, shared by the Grids of the dataset
+        self._grid_maps = HyperslabCache(maxsize=GRID_MAPS_CACHE_SIZE)
 
     @property
     def session(self):
@@ -1110,10 +1217,33 @@ class DatasetType(StructureType):
             )
             self._batch_timer.start()
 
-    def enable_batch_mode(self, timeout=0.25):
-        """Turn on batching with specified timeout window in seconds."""
+    def enable_batch_mode(
+        self,
+        timeout=0.25,
+        decode_workers=None,
+        native_byteorder=False,
+        max_url_length=BATCH_MAX_URL_LENGTH,
+        max_response_size=None,
+        workers=BATCH_WORKERS,
+    ):
+        """Turn on batching with specified timeout window in seconds.
+
+        `decode_workers` and `native_byteorder` are passed on to
+        `UNPACKDAP4DATA` when the batched response is decoded: variables are
+        then finished on a pool of threads, and converted to the native byte
+        order.
+
+        A batch is split into several requests, sent `workers` at a time,
+        when its URL would be longer than `max_url_length`, or its response
+        (estimated from the DMR) larger than `max_response_size` bytes.
+        """
         self._batch_mode = True
         self._batch_timeout = timeout
+        self._decode_workers = decode_workers
+        self._native_byteorder = native_byteorder
+        self._max_url_length = max_url_length
+        self._max_response_size = max_response_size
+        self._batch_workers = workers
         self._batch_registry = set()
         self._batch_timer = None
         self._batch_results = {}
@@ -1121,6 +1251,49 @@ class DatasetType(StructureType):
         self._checksums = True
         self._slices = None
 
+    @contextlib.contextmanager
+    def batch(self, decode_workers=None, native_byteorder=False):
+        """Download the variables sliced within the block in a single request.
+
+        Instead of waiting for the timer of `enable_batch_mode`, the combined
+        request is sent when the block exits (split as described there when
+        it is too large), and the variables sliced within the block hold
+        their data afterwards::
+
+            >>> with dataset.batch():  # doctest: +SKIP
+            ...     sst = dataset["sst"][0, :, :]
+            ...     time = dataset["time"][:]
+            >>> sst.data  # doctest: +SKIP
+
+        `decode_workers` and `native_byteorder` are as in `enable_batch_mode`,
+        when batch mode is not already enabled. The data of the variables is
+        not available within the block.
+        """
+        if self._batch_block:
+            raise RuntimeError("`batch` blocks cannot be nested.")
+        enabled = self.is_batch_mode()
+        if not enabled:
+            self.enable_batch_mode(
+                decode_workers=decode_workers, native_byteorder=native_byteorder
+            )
+        self._batch_block = True
+        if self._current_batch_promise is None:
+            self._current_batch_promise = BatchPromise()
+        promise = self._current_batch_promise
+        try:
+            yield self
+        except BaseException:
+            self._current_batch_promise = None
+            self._batch_registry.clear()
+            promise.set_results({})
+            raise
+        else:
+            self._resolve_batch(promise)
+        finally:
+            self._batch_block = False
+            if not enabled:
+                self._batch_mode = False
+
     def register_for_batch(self, var, checksums=True):
         """Register a key for batch processing."""
         self._checksums = checksums
@@ -1128,75 +1301,153 @@ class DatasetType(StructureType):
         self._batch_registry.add(var)
         var._is_registered_for_batch = True
 
-        if not self._batch_timer:
+        if self._batch_block:
+            # sent when the `batch` block exits
+            if self._current_batch_promise is None:
+                self._current_batch_promise = BatchPromise()
+        elif not self._batch_timer:
             # Start the timer if not already running
             self._start_batch_timer()
 
         var._batch_promise = self._current_batch_promise
 
-    def _resolve_batch(self, batch_promise):
+    def _batch_url(self, variables):
+        """Return the url of a request for `variables`."""
+        ce = self.construct_shared_dim_ce(variables)
+        if _is_dap2(variables[0]):
+            return variables[0]._data.projection_url(ce)
+        return f"{variables[0]._data.baseurl}.dap?dap4.ce={ce}&dap4.checksum=true"
+
+    def plan_batch(self, variables):
+        """Split batched `variables` into requests under the batch limits.
+
+        Returns a list of lists of variables. Variables are added to a request
+        in order until its URL or its estimated response would be too large;
+        a variable too large on its own gets a request of its own.
+        """
+        max_url_length = getattr(self, "_max_url_length", BATCH_MAX_URL_LENGTH)
+        max_size = getattr(self, "_max_response_size", None)
+        # before building the constraint expressions, which consumes the slices
+        sizes = [_batch_nbytes(var) for var in variables]
+        # each variable adds its constraint expression and a separator to the
+        # url; the part shared by all (base url, query parameters, slices of
+        # shared dimensions) is measured once, from the first two variables
+        lengths = [len(self._batch_url([var])) for var in variables]
+        shared = 0
+        if len(variables) > 1:
+            shared = lengths[0] + lengths[1] - len(self._batch_url(variables[:2]))
+        requests, group, nbytes, length = [], [], 0, 0
+        for var, size, single in zip(variables, sizes, lengths):
+            if group and (
+                (max_size and nbytes + size > max_size)
+                or length + single - shared > max_url_length
+            ):
+                requests.append(group)
+                group, nbytes = [], 0
+            length = length + single - shared if group else single
+            group.append(var)
+            nbytes += size
+        if group:
+            requests.append(group)
+        return requests
+
+    def _fetch_batch(self, url, proxy):
         from dapclient.handlers.dap import UNPACKDAP4DATA
 
+        if (
+            isinstance(self._session, requests_cache.CachedSession)
+            and "debug" not in self._session.cache.cache_name
+        ):
+            cache_kwargs = {"skip": True}
+        else:
+            cache_kwargs = {}
+
+        r = GET(
+            url,
+            session=self._session,
+            get_kwargs={"stream": True},
+            cache_kwargs=cache_kwargs,
+        )
+        if type(proxy).__name__ == "BaseProxyDap2":
+            try:
+                return proxy.unpack_dataset(r)
+            finally:
+                r.close()
+        return UNPACKDAP4DATA(
+            r,
+            checksums=True,
+            user_charset="ascii",
+            native_byteorder=getattr(self, "_native_byteorder", False),
+            decode_workers=getattr(self, "_decode_workers", None),
+        ).dataset
+
+    def _resolve_batch(self, batch_promise):
         # print(f"[Batch] Resolving promise: {id(batch_promise)}")
-        variables = [
-            var
-            for var in self._batch_registry
-            if getattr(var, "_pending_batch_slice", None) is not None
-            and not var._is_data_loaded()
-        ]
+        variables = sorted(
+            (
+                var
+                for var in self._batch_registry
+                if getattr(var, "_pending_batch_slice", None) is not None
+                and not var._is_data_loaded()
+            ),
+            key=lambda var: var.id,
+        )
 
         if not variables:
             self._batch_timer = None
+            if self._current_batch_promise is batch_promise:
+                self._current_batch_promise = None
+            batch_promise.set_results({})
             return
 
-        constraint_expressions = self.construct_shared_dim_ce(variables)
-
         base_url = variables[0]._data.baseurl if variables[0]._data else None
+        groups = self.plan_batch(variables) if base_url else []
+        constraint_expressions = [
+            self.construct_shared_dim_ce(group) for group in groups
+        ]
 
-        if not constraint_expressions or not base_url:
+        if not all(constraint_expressions) or not base_url:
             self._batch_registry.clear()
             self._batch_timer = None
+            if self._current_batch_promise is batch_promise:
+                self._current_batch_promise = None
+            batch_promise.set_results({})
             return
 
-        # Build the single dap4.ce query parameter
-        ce_string = "?dap4.ce=" + constraint_expressions
-        _dap_url = base_url + ".dap" + ce_string
+        urls = [self._batch_url(group) for group in groups]
         if not self._checksums:
             warnings.warn(
                 "Checksums are not optional in the current version, but will "
                 "be in the next version of dapclient. Setting `checksums=True`",
                 stacklevel=2,
             )
-        _dap_url += "&dap4.checksum=true"
-
-        # print("dap url:", _dap_url)
 
-        if (
-            isinstance(self._session, requests_cache.CachedSession)
-            and "debug" not in self._session.cache.cache_name
-        ):
-            cache_kwargs = {"skip": True}
+        proxies = [group[0]._data for group in groups]
+        if len(urls) == 1:
+            datasets = [self._fetch_batch(urls[0], proxies[0])]
         else:
-            cache_kwargs = {}
-
-        r = GET(
-            _dap_url,
-            session=self._session,
-            get_kwargs={"stream": True},
-            cache_kwargs=cache_kwargs,
-        )
-        parsed_dataset = UNPACKDAP4DATA(r, checksums=True, user_charset="ascii").dataset
+            workers = min(len(urls), getattr(self, "_batch_workers", BATCH_WORKERS))
+            with ThreadPoolExecutor(workers) as executor:
+                datasets = list(executor.map(self._fetch_batch, urls, proxies))
 
         # Collect results
         results_dict = {}
+        for group, parsed_dataset in zip(groups, datasets):
+            for var in group:
+                # DAP2 responses are named as in the DDS
+                key = var._data.id if _is_dap2(var) else var.id
+                results_dict[var.id] = np.asarray(parsed_dataset[key].data[:])
         for var in variables:
-            results_dict[var.id] = np.asarray(parsed_dataset[var.id].data[:])
+            var._data = results_dict[var.id]
             var._pending_batch_slice = None
             var._is_registered_for_batch = False
             self._batch_registry.discard(var)
             var._batch_promise = None
 
-        # Resolve the promise for all waiting arrays
+        # Resolve the promise for all waiting arrays, later registrations
+        # start a new batch
+        if self._current_batch_promise is batch_promise:
+            self._current_batch_promise = None
         batch_promise.set_results(results_dict)
 
         # Clean up
@@ -1259,6 +1510,10 @@ class DatasetType(StructureType):
         """
         if not variables:
             return None
+        if _is_dap2(variables[0]):
+            return ",".join(
+                var.build_ce() for var in variables if var.build_ce() is not None
+            )
         if not self._slices:
             ce_dims = [
                 _quote(var.build_ce().split("=")[-1])
@@ -1384,6 +1639,39 @@ class SequenceType(StructureType):
     def __iter__(self):
         return self.iterdata()
 
+    def iter_batches(self, rows=SEQUENCE_BATCH_ROWS):
+        """Yield the data in structured arrays of up to `rows` records.
+
+        Remote sequences are downloaded and unpacked one batch at a time, see
+        `SequenceProxy.iter_batches`.
+        """
+        if hasattr(self._data, "iter_batches"):
+            return self._data.iter_batches(rows)
+        data = np.asarray(self._data)
+        return (data[i : i + rows] for i in range(0, len(data), rows))
+
+    def to_arrow_batches(self, batch_rows=SEQUENCE_BATCH_ROWS):
+        """Yield the data as `pyarrow.RecordBatch` objects of up to `batch_rows` rows.
+
+        The batches are converted as they are downloaded, see `iter_batches`.
+        """
+        try:
+            from dapclient.arrow import record_batches
+        except ImportError:
+            raise NotImplementedError(".to_arrow_batches requires the pyarrow package.")
+        return record_batches(self, batch_rows)
+
+    def to_parquet(self, path, batch_rows=SEQUENCE_BATCH_ROWS, **kwargs):
+        """Stream the data into a Parquet file, one row group per batch.
+
+        Extra keyword arguments are passed to `pyarrow.parquet.ParquetWriter`.
+        """
+        try:
+            from dapclient.arrow import write_parquet
+        except ImportError:
+            raise NotImplementedError(".to_parquet requires the pyarrow package.")
+        return write_parquet(self, path, batch_rows, **kwargs)
+
     def __len__(self):
         return len(self._data)
 
@@ -1471,12 +1759,39 @@ class GridType(StructureType):
                 key = (key,)
 
             out = copy.copy(self)
+            if type(self.array.data).__name__ == "BaseProxyDap2":
+                self._getitem_dap2(out, key)
+                return out
             for var, slice_ in zip(out.children(), [key] + list(key)):
-                if type(self.data).__name__ == "BaseProxyDap4":
-                    pass
                 var.data = self[var.name].data[slice_]
             return out
 
+    def _getitem_dap2(self, out, key):
+        """Slice a remote DAP2 Grid and its maps with a single request.
+
+        The slices of the maps are kept by the dataset, in a `HyperslabCache`
+        bounded by `GRID_MAPS_CACHE_SIZE`: when all of them are held, e.g.
+        after another Grid with the same maps, only the array is requested.
+        """
+        proxy = self.array.data
+        index = combine_slices(proxy.slice, fix_slice(key, proxy.shape))
+        ranges = [range(*s.indices(n)) for s, n in zip(index, proxy.shape)]
+        cache = getattr(self.dataset, "_grid_maps", None)
+        if cache is None:
+            cache = HyperslabCache(maxsize=GRID_MAPS_CACHE_SIZE)
+        keys = list(zip(self.maps, ranges))
+        maps = [cache.get(name, (r,))[0] for name, r in keys]
+        if all(data is not None for data in maps):
+            out.array.data = proxy[key]
+            for (name, _), data in zip(keys, maps):
+                out[name].data = data
+            return
+        grid = proxy.grid(self.id, key)
+        for var in out.children():
+            var.data = grid[var.name].data
+        for name, r in keys:
+            cache.put(name, (r,), grid[name].data)
+
     @property
     def dtype(self):
         """Return the first children dtype."""
@@ -1,8 +1,15 @@
+import asyncio
+import json
+import os
 import re
 import ssl
+import tempfile
 import threading
+import time
 import warnings
+import weakref
 from typing import Any, Dict, Literal, Optional, Tuple, Union
+from xml.etree import ElementTree as ET
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -20,12 +27,37 @@ from webob.request import Request as webob_Request
 from dapclient import __version__
 from dapclient.lib import DEFAULT_TIMEOUT, _quote
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 _BEARER_RE = re.compile(r"^\s*Bearer\s+.+", re.IGNORECASE)
 
 Backend = Literal["sqlite", "filesystem", "memory"]
 
 _thread_local = threading.local()
 
+# Connection pooling. Every session handed out by `get_pooled_session` (and
+# thus by `GET`) is built once per thread and reused, so that repeated
+# hyperslab requests travel over already-open keep-alive connections. A
+# `requests.Session` is not thread-safe: the threads requesting data (e.g. of
+# a batch split, a `Prefetcher`, `open_mfdataset` or `asyncio.to_thread`) each
+# keep their own pooled sessions, as `get_session` does for `fetch_dim` and
+# `stream`.
+# `DEFAULT_POOL_CONNECTIONS` is the number of hosts with pooled connections,
+# `DEFAULT_POOL_MAXSIZE` the number of connections kept alive per host.
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 32
+
+# Maximum number of requests in flight at once per `httpx.AsyncClient`, used
+# by `aGET`. One client (and one semaphore) is kept per event loop and session.
+DEFAULT_ASYNC_CONCURRENCY = 256
+
+_async_clients: "weakref.WeakKeyDictionary[Any, Dict[tuple, tuple]]" = (
+    weakref.WeakKeyDictionary()
+)
+
 
 def GET(
     url,
@@ -86,6 +118,92 @@ def GET(
     return res
 
 
+async def aGET(
+    url,
+    session=None,
+    timeout=DEFAULT_TIMEOUT,
+    verify=True,
+    get_kwargs=None,
+):
+    """Asynchronously open a remote URL returning a `httpx.Response`.
+
+    Requests share one `httpx.AsyncClient` per event loop and session (see
+    `get_async_client`), and the number of requests in flight is bounded by
+    the semaphore of that client. The body of the response is fully read.
+
+    Parameters:
+    -----------
+        url: str
+            open a remote URL
+        session: requests.Session() | None
+            object (potentially) containing authentication headers and cookies,
+            which are copied into the async client.
+        timeout: int | None (default: 120)
+            timeout in seconds.
+        verify: bool (default: True)
+            verify SSL certificates
+        get_kwargs: dict | None
+            optional dict containing keyword arguments passed to
+            `httpx.AsyncClient.get`.
+
+    Returns:
+    --------
+        response: httpx.Response object
+    """
+    client, semaphore = get_async_client(session, verify=verify)
+    async with semaphore:
+        res = await client.get(url, timeout=timeout, **(get_kwargs or {}))
+    res.raise_for_status()
+    return res
+
+
+def get_async_client(
+    session: Optional[requests.Session] = None,
+    verify: bool | str = True,
+    max_concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+):
+    """Return the `(httpx.AsyncClient, asyncio.Semaphore)` pair for `session`.
+
+    The pair is created on first use within the running event loop, and
+    reused afterwards. `max_concurrency` bounds both the number of requests in
+    flight and the number of pooled connections, and only applies when the
+    client is first created.
+    """
+    if httpx is None:
+        raise ImportError(
+            "httpx is required for asynchronous requests. "
+            "Install with: pip install httpx"
+        )
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    key = (id(session) if session is not None else None, _auth_key(session), verify)
+    if key not in clients:
+        headers = {"User-Agent": "dapclient/" + f"{__version__}"}
+        cookies = None
+        if session is not None:
+            headers.update(session.headers)
+            cookies = dict(session.cookies)
+        client = httpx.AsyncClient(
+            headers=headers,
+            cookies=cookies,
+            verify=verify,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+        )
+        clients[key] = (client, asyncio.Semaphore(max_concurrency))
+    return clients[key]
+
+
+async def close_async_clients():
+    """Close all async clients created within the running event loop."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client, _ in clients.values():
+        await client.aclose()
+
+
 def get_response(req, application=None, verify=True):
     """Get response from request.
 
@@ -291,7 +409,11 @@ def create_session(
         retry_args.setdefault("allowed_methods", ["GET"])
 
     retries = Retry(**retry_args)
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(
+        max_retries=retries,
+        pool_connections=DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize=DEFAULT_POOL_MAXSIZE,
+    )
 
     # Mount the adapter to the session
     session.mount("http://", adapter)
@@ -318,17 +440,16 @@ def get_request(
     cache_kwargs: Dict[str, Any] | None = None,
     session_kwargs: Dict[str, Any] | None = None,
 ) -> requests.Response:
-    s = build_session(
-        base_session=base_session,
+    cache_kwargs = dict(cache_kwargs or {})
+    skip = cache_kwargs.pop("skip", None)
+    s = get_pooled_session(
+        base_session,
         backend_options=backend_options,
         cache_kwargs=cache_kwargs,
         session_kwargs=session_kwargs,
     )
     try:
         if isinstance(s, CachedSession):
-            skip = False
-            if cache_kwargs:
-                skip = cache_kwargs.pop("skip", None)
             if should_skip_cache(url, s) or skip:
                 with s.cache_disabled():
                     req = s.get(
@@ -400,6 +521,8 @@ def build_session(
     backend_options: Dict[str, Any] | None = None,
     cache_kwargs: Dict[str, Any] | None = None,
     session_kwargs: Dict[str, Any] | None = None,
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
 ) -> requests.Session:
     backend_options = backend_options or {}
     cache_kwargs = cache_kwargs or {}
@@ -432,7 +555,11 @@ def build_session(
         retry_args.setdefault("allowed_methods", ["GET"])
 
     retries = Retry(**retry_args)
-    adapter = HTTPAdapter(max_retries=retries, pool_connections=200, pool_maxsize=200)
+    adapter = HTTPAdapter(
+        max_retries=retries,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
 
     # Mount the adapter to the session
     s.mount("http://", adapter)
@@ -441,6 +568,117 @@ def build_session(
     return s
 
 
+def _auth_key(session: Optional[requests.Session]) -> Optional[str]:
+    """Return the part of a session that identifies who is making requests."""
+    if session is None:
+        return None
+    token = getattr(session, "headers", CaseInsensitiveDict()).get("Authorization")
+    auth = getattr(session, "auth", None)
+    return repr((token, auth)) if token or auth else None
+
+
+def session_pool_key(
+    base_session: Optional[requests.Session],
+    session_kwargs: Dict[str, Any] | None = None,
+    cache_kwargs: Dict[str, Any] | None = None,
+    backend_options: Dict[str, Any] | None = None,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+) -> tuple:
+    """Key of the pooled session derived from `base_session`.
+
+    Pooled sessions are keyed on the identity of the base session, its
+    authentication (bearer token or `auth`), for a `CachedSession` the cache
+    store it points to, and the arguments the session is built with.
+    """
+    identity = id(base_session) if base_session is not None else None
+    store = None
+    if isinstance(base_session, CachedSession):
+        store = cache_store_id(base_session)
+    extra = tuple(
+        repr(sorted((kwargs or {}).items()))
+        for kwargs in (session_kwargs, cache_kwargs, backend_options)
+    )
+    return (identity, _auth_key(base_session), store, pool_maxsize) + extra
+
+
+def _session_pool() -> Dict[tuple, tuple]:
+    """The pooled sessions of this thread, with a reference to their base."""
+    return _thread_local.__dict__.setdefault("pool", {})
+
+
+def _pooled_base(entry) -> Optional[requests.Session]:
+    ref, _ = entry
+    return None if ref is None else ref()
+
+
+def get_pooled_session(
+    base_session: Optional[requests.Session] = None,
+    *,
+    backend_options: Dict[str, Any] | None = None,
+    cache_kwargs: Dict[str, Any] | None = None,
+    session_kwargs: Dict[str, Any] | None = None,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+) -> requests.Session:
+    """Return a session of this thread's pool, building it on first use.
+
+    The returned session (and its keep-alive connections) is shared by every
+    request made from this thread with the same `base_session`. Entries of
+    base sessions that were garbage collected are closed when another session
+    is built.
+
+    Parameters:
+    -----------
+        base_session: requests.Session | requests_cache.CachedSession | None
+            session the pooled one is derived from. See `build_session`.
+        backend_options: dict | None
+        cache_kwargs: dict | None
+        session_kwargs: dict | None
+            arguments of `build_session`. Each combination gets its own
+            pooled session.
+        pool_maxsize: int (default: 32)
+            maximum number of connections kept alive per host.
+    """
+    key = session_pool_key(
+        base_session, session_kwargs, cache_kwargs, backend_options, pool_maxsize
+    )
+    pool = _session_pool()
+    entry = pool.get(key)
+    if entry is not None and _pooled_base(entry) is base_session:
+        s = entry[1]
+    else:
+        for stale in [k for k, e in pool.items() if k[0] and _pooled_base(e) is None]:
+            pool.pop(stale)[1].close()
+        s = build_session(
+            base_session=base_session,
+            backend_options=backend_options,
+            cache_kwargs=dict(cache_kwargs or {}),
+            session_kwargs=dict(session_kwargs or {}),
+            pool_maxsize=pool_maxsize,
+        )
+        ref = None if base_session is None else weakref.ref(base_session)
+        pool[key] = (ref, s)
+    if isinstance(base_session, CachedSession) and isinstance(s, CachedSession):
+        # the cache key function may be patched after the session was pooled,
+        # e.g. by `consolidate_metadata`.
+        if s.settings.key_fn is not base_session.settings.key_fn:
+            s.settings.key_fn = base_session.settings.key_fn
+    return s
+
+
+def evict_cached_response(session: Optional[requests.Session], url: str) -> None:
+    """Remove the cached response of `url`, e.g. when it is found corrupted."""
+    if isinstance(session, CachedSession):
+        session.cache.delete(urls=[url])
+
+
+def clear_session_pool() -> None:
+    """Close and forget the sessions of this thread, pooled or restored."""
+    sessions = [s for _, s in _thread_local.__dict__.pop("pool", {}).values()]
+    sessions += _thread_local.__dict__.pop("sessions", {}).values()
+    for s in sessions:
+        s.close()
+
+
 def _as_cache(obj: Union[CachedSession, BaseCache]) -> BaseCache:
     return obj.cache if hasattr(obj, "cache") else obj
 
@@ -529,15 +767,39 @@ def get_thread_session(session_state=None):
     return _thread_local.session
 
 
+def _session_state_key(session_state) -> tuple:
+    if not session_state:
+        return (None,)
+    headers = session_state.get("headers", {}) or {}
+    cookies = session_state.get("cookies", {}) or {}
+    return (
+        headers.get("Authorization"),
+        repr(sorted(dict(cookies).items())),
+        repr(session_state.get("auth")),
+        session_state.get("verify"),
+        session_state.get("backend"),
+        session_state.get("cache_name"),
+    )
+
+
 def get_session(session_state=None):
-    if session_state:
-        # you might want one restored session per thread too
-        if not hasattr(_thread_local, "session"):
-            _thread_local.session = restore_session(session_state)
-    else:
-        if not hasattr(_thread_local, "session"):
-            _thread_local.session = create_session()
-    return _thread_local.session
+    """Return the session of this thread matching `session_state`.
+
+    A `requests.Session` is not thread-safe, so each thread keeps its own,
+    one per state (same credentials and cache store). Within a thread, the
+    keep-alive connections of a session are reused across calls to
+    `fetch_dim` and `stream`.
+    """
+    key = _session_state_key(session_state)
+    sessions = _thread_local.__dict__.setdefault("sessions", {})
+    s = sessions.get(key)
+    if s is None:
+        if session_state:
+            s = restore_session(session_state)
+        else:
+            s = create_session()
+        sessions[key] = s
+    return s
 
 
 def restore_session(session_state):
@@ -578,10 +840,217 @@ def restore_session(session_state):
     retry_args.setdefault("allowed_methods", ["GET"])
 
     retries = Retry(**retry_args)
-    adapter = HTTPAdapter(max_retries=retries, pool_connections=200, pool_maxsize=200)
+    adapter = HTTPAdapter(
+        max_retries=retries,
+        pool_connections=DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize=DEFAULT_POOL_MAXSIZE,
+    )
 
     # Mount the adapter to the session
     s.mount("http://", adapter)
     s.mount("https://", adapter)
 
     return s
+
+
+# Server capabilities. What is learned about a server (by probing its `.ver`
+# response, or from its replies) is recorded per host in a JSON file, and
+# reused for `CAPABILITIES_TTL` seconds by every process, so that jobs opening
+# many URLs on the same host probe it once a day rather than once per call.
+CAPABILITIES_TTL = 86400
+CAPABILITIES_FIELDS = (
+    "server",  # e.g. "Hyrax", or None when the server is not recognized
+    "version",  # e.g. "1.17.1-550"
+    "dap4",  # the server answers DAP4 requests
+    "dmr_version",  # `dmrVersion` to request, see `hyrax_dmr_version`
+)
+
+
+def cache_home() -> str:
+    """Directory holding the persistent caches of dapclient."""
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(root, "dapclient")
+
+
+def capabilities_path() -> str:
+    """Default location of the server capabilities file."""
+    return os.path.join(cache_home(), "server_capabilities.json")
+
+
+def server_key(url: str) -> str:
+    """Return the host part (`scheme://netloc`) of `url`, keying its server."""
+    scheme, netloc = urlparse(url)[:2]
+    if scheme in ("dap2", "dap4"):
+        scheme = "https"
+    return f"{scheme}://{netloc.lower()}"
+
+
+class CapabilityRegistry:
+    """Capabilities of OPeNDAP servers, per host, persisted with a time to live.
+
+    Entries are dictionaries with the keys of `CAPABILITIES_FIELDS` (None when
+    unknown), and the time they were recorded. Expired entries are ignored.
+    The file is read again before every update and replaced atomically, so
+    that several processes can share it.
+
+    Parameters:
+    -----------
+        path: str | os.PathLike | None
+            JSON file holding the entries, see `capabilities_path`. When None,
+            entries are only kept in memory.
+        ttl: float
+            seconds after which an entry expires.
+    """
+
+    def __init__(self, path=None, ttl=CAPABILITIES_TTL):
+        self.path = None if path is None else os.fspath(path)
+        self.ttl = ttl
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(entries, dict):
+            self._entries.update(entries)
+
+    def _save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # the registry is only a cache
+            warnings.warn(f"Could not save server capabilities: {e}")
+
+    def get(self, url: str) -> Optional[dict]:
+        """Return the capabilities of the server of `url`, or None if unknown."""
+        key = server_key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry.get("time", 0) > self.ttl:
+                self._load()
+                entry = self._entries.get(key)
+        if entry is None or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return {field: entry.get(field) for field in CAPABILITIES_FIELDS}
+
+    def update(self, url: str, **capabilities) -> dict:
+        """Record capabilities of the server of `url`, and return all of them."""
+        unknown = set(capabilities) - set(CAPABILITIES_FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown server capabilities: {sorted(unknown)}")
+        key = server_key(url)
+        with self._lock:
+            self._load()
+            entry = dict.fromkeys(CAPABILITIES_FIELDS)
+            previous = self._entries.get(key)
+            if previous and time.time() - previous.get("time", 0) <= self.ttl:
+                entry.update(previous)
+            entry.update(capabilities, time=time.time())
+            self._entries[key] = entry
+            self._save()
+        return {field: entry[field] for field in CAPABILITIES_FIELDS}
+
+    def forget(self, url: Optional[str] = None) -> None:
+        """Drop the entry of the server of `url`, or all entries."""
+        with self._lock:
+            self._load()
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(server_key(url), None)
+            self._save()
+
+
+_capability_registry: Optional[CapabilityRegistry] = None
+_capability_registry_lock = threading.Lock()
+
+
+def get_capability_registry() -> CapabilityRegistry:
+    """Return the registry shared by the process, stored in `capabilities_path`."""
+    global _capability_registry
+    with _capability_registry_lock:
+        if _capability_registry is None:
+            _capability_registry = CapabilityRegistry(capabilities_path())
+    return _capability_registry
+
+
+def hyrax_dmr_version(version: Optional[str]) -> Optional[str]:
+    """Return the `dmrVersion` to request from a Hyrax server, if any.
+
+    Hyrax 1.17.1 past build 500 may advertise DMR version 1.0 while serving
+    2.0 (see https://github.com/pydap/pydap/issues/656).
+    """
+    try:
+        release, build = version.split("-")[:2]
+        parts = release.split(".")  # major release only
+        # e.g. turns 1.17.1 into float value of 1.171
+        number = float(".".join(parts[:-1]) + parts[-1])
+        if number == 1.171 and float(build) > 500:
+            return "2.0"
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+def probe_server(url: str, session=None, timeout=DEFAULT_TIMEOUT) -> Optional[dict]:
+    """Ask the server of `url` for its `.ver` response, and return its capabilities.
+
+    Returns None when the server could not be reached, so that nothing is
+    recorded about it.
+    """
+    session = session or get_pooled_session()
+    try:
+        r = session.get(url.split("?")[0] + ".ver", timeout=timeout)
+    except requests.exceptions.RequestException:
+        return None
+    if r.status_code >= 500:
+        return None
+    capabilities = dict.fromkeys(CAPABILITIES_FIELDS)
+    try:
+        root = ET.fromstring(r.content)
+    except ET.ParseError:
+        # server is not a Hyrax!
+        return capabilities
+    hyrax = root.find("Hyrax")
+    if hyrax is not None:
+        version = hyrax.attrib.get("version")
+        capabilities.update(
+            server="Hyrax",
+            version=version,
+            dap4=True,
+            dmr_version=hyrax_dmr_version(version),
+        )
+    return capabilities
+
+
+def server_capabilities(
+    url: str, session=None, registry=None, timeout=DEFAULT_TIMEOUT
+) -> dict:
+    """Return the capabilities of the server of `url`, probing it if unknown.
+
+    `registry` defaults to the one of `get_capability_registry`. Values are
+    None when unknown.
+    """
+    registry = registry or get_capability_registry()
+    capabilities = registry.get(url)
+    if capabilities is None:
+        capabilities = probe_server(url, session, timeout=timeout)
+        if capabilities is None:
+            return dict.fromkeys(CAPABILITIES_FIELDS)
+        capabilities = registry.update(url, **capabilities)
+    return capabilities
@@ -25,6 +25,7 @@ dmr_atomic_types = (
     "UInt64",
     "Float32",
     "Float64",
+    "String",
 )
 
 namespace = {"": "http://xml.opendap.org/ns/DAP/4.0#"}
@@ -126,8 +127,9 @@ def get_attributes(element):
     attribute_elements = element.findall("Attribute")
     for attribute_element in attribute_elements:
         name = attribute_element.get("name")
-        value = attribute_element.find("Value").text
-        attributes[name] = value
+        values = [value.text for value in attribute_element.findall("Value")]
+        # multi-valued attributes (e.g. `_ChunkSizes`) are kept as lists
+        attributes[name] = values[0] if len(values) == 1 else values or None
     return attributes
 
 
@@ -184,13 +186,18 @@ def has_map(element):
     return len(maps) > 0
 
 
-def dmr_to_dataset(dmr):
+def dmr_to_dataset(dmr, flat=True, dmrVersion=None):
     """Return a dataset object from a DMR representation.
 
     Parameters
     ----------
     dmr : str
         A string representing a DMR representation.
+    flat : bool
+        Accepted for compatibility with `DAPHandler`. Variables inside Groups
+        are always returned with their fully qualified names.
+    dmrVersion : str | None
+        Accepted for compatibility with `UNPACKDAP4DATA`.
     """
     # Parse the DMR. First dropping the namespace
     dmr = re.sub(' xmlns="[^"]+"', "", dmr, count=1)
@@ -207,33 +214,24 @@ def dmr_to_dataset(dmr):
     # Bootstrap variables
     for name, variable in variables.items():
         _extracted_from_dmr_to_dataset_23(name, variable)
-    # Add size entry for dimension variables
-    for name, size in named_dimensions.items():
-        if name not in variables:
-            # We might have dimensions that only have a declaration, so we need
-            # to add them to the variables
-            variables[name] = {
-                "name": name,
-                "size": size,
-                "dims": [name],
-                "dtype": "int",
-                "has_map": False,
-                "attributes": {},
-                "shape": (),
-            }
-
-    # Add shape element to variables
+    # Add shape element to variables. Dimensions that are only declared
+    # (without a variable) carry no data in a DAP4 response.
     for name, variable in variables.items():
         for dim in variable["dims"]:
-            variable["shape"] += (variables[dim]["size"],)
+            variable["shape"] += (named_dimensions[dim],)
 
     # Convert the ordered dictionary to dataset
     dataset_name = dom_et.attrib["name"]
     dataset = dapclient.model.DatasetType(dataset_name)
+    dataset.dimensions = {
+        name.lstrip("/"): size for name, size in named_dimensions.items()
+    }
     for name, variable in variables.items():
         data = DummyData(dtype=variable["dtype"], shape=variable["shape"])
         array = dapclient.model.BaseType(
-            name=variable["name"], data=data, dimensions=variable["dims"]
+            name=variable["name"],
+            data=data,
+            dims=["/" + dim.lstrip("/") for dim in variable["dims"]],
         )
         if variable["has_map"]:
             var = dapclient.model.GridType(name=variable["name"])
@@ -255,6 +253,9 @@ def _extracted_from_dmr_to_dataset_23(name, variable):
     variable["dtype"] = get_dtype(variable["element"])
     variable["dims"] = get_dim_names(variable["element"])
     variable["has_map"] = has_map(variable["element"])
+    variable["attributes"]["Maps"] = tuple(
+        element.get("name") for element in variable["element"].findall("Map")
+    )
     variable["shape"] = get_dim_sizes(variable["element"])
 
 
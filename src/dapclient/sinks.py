@@ -0,0 +1,528 @@
+"""Destinations for the variables of a streamed DAP4 response.
+
+`UNPACKDAP4DATA` (and so `stream` and `to_netcdf`) writes to netCDF4 by
+default. Any object with the methods of `Sink` can be passed as `sink=`
+instead; the variables are then handed to it as they are decoded, one slab at
+a time. Two sinks that need nothing beyond numpy are provided:
+
+* `ZarrSink` writes a directory in the Zarr v2 layout (readable by `zarr` and
+  `xarray.open_zarr`), one zlib compressed file per chunk.
+* `NpySink` writes one `.npy` file per variable (readable with `numpy.load`,
+  memory-mapped if needed).
+
+Several processes (or threads) may write into the same store at once, each
+with its own sink instance: files are replaced atomically, and the metadata
+and the chunks shared by two writers are updated under a lock file. With
+`concat_dim`, each response is appended to the store along that dimension,
+so that many granules build a single cube. The region of a granule is
+reserved when its DMR is decoded, in the order the granules arrive, unless an
+explicit `offset` is given.
+"""
+
+import contextlib
+import itertools
+import json
+import math
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import numpy
+
+from dapclient.handlers import dap
+from dapclient.lib import walk
+from dapclient.model import BaseType
+
+LOCK_TIMEOUT = 60
+CONCAT_KEY = "_dapclient_concat"
+SKIP_ATTRIBUTES = {"Maps", "path", "_FillValue", "_DAP4_Checksum_CRC32"}
+
+
+@contextlib.contextmanager
+def locked(path, timeout=LOCK_TIMEOUT):
+    """Hold the lock file `path + ".lock"`, across threads and processes."""
+    lock = str(path) + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not acquire the lock {lock}")
+            time.sleep(0.001)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.unlink(lock)
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` through a temporary file in the same directory."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def _json_default(obj):
+    if isinstance(obj, (numpy.generic, numpy.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", "replace")
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj):
+    return json.dumps(obj, indent=4, sort_keys=True, default=_json_default).encode()
+
+
+def _load_json(path, default=None):
+    try:
+        with open(path, "rb") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _dim_names(variable):
+    dims = [d.split("/")[-1] for d in (variable.dims or [])]
+    if len(dims) != len(variable.shape):
+        return [f"{variable.name}_dim{i}" for i in range(len(variable.shape))]
+    return dims
+
+
+def _path(root, variable_id, suffix=""):
+    parts = variable_id.lstrip("/").split("/")
+    return root.joinpath(*parts[:-1], parts[-1] + suffix)
+
+
+def _region(shape, index):
+    """Slices, in `shape`, of the slab `index` (`(...,)` or `(slice,)`)."""
+    region = [slice(0, n) for n in shape]
+    if index and index[0] is not Ellipsis:
+        region[0] = slice(*index[0].indices(shape[0])[:2])
+    return region
+
+
+class Sink(object):
+    """Destination of the variables decoded by `UNPACKDAP4DATA`.
+
+    `open` is called with the dataset built from the DMR, before any data.
+    Fixed size variables of which `slab_rows` returns a number are then
+    passed to `write` a slab of that many rows (along the first axis) at a
+    time, the others (and strings) in one piece. `close` is called once the
+    response is consumed, also after an error.
+
+    Parameters:
+    -----------
+        path: str | Path
+            directory of the store, created if needed.
+        concat_dim: str | None
+            name of the dimension along which responses are appended to an
+            existing store. Variables without this dimension are written as
+            they are, and expected to be the same in every response.
+        offset: int | None
+            index along `concat_dim` of the first element of this response.
+            By default the next free region of the store is reserved.
+    """
+
+    def __init__(self, path, concat_dim=None, offset=None):
+        self.path = Path(path)
+        self.concat_dim = concat_dim
+        self.offset = offset
+        self._arrays = {}
+
+    def open(self, dataset):
+        """Create (or extend) the arrays of `dataset` in the store."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with locked(self.path / ".store"):
+            self._open(dataset, self._reserve(dataset))
+
+    def slab_rows(self, variable):
+        """Rows of `variable` to buffer before writing them."""
+        if variable.id not in self._arrays:
+            return None
+        if not variable.shape or not variable.shape[0]:
+            return None
+        row = int(numpy.prod(variable.shape[1:])) * variable.dtype.itemsize
+        return min(variable.shape[0], max(1, dap.SLAB_SIZE // max(row, 1)))
+
+    def write(self, variable, index, data):
+        """Write the slab `index` of `variable`."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the sink."""
+        self._arrays = {}
+
+    def _open(self, dataset, offset):
+        raise NotImplementedError
+
+    def _reserve(self, dataset):
+        """Offset along `concat_dim` of this response, under the store lock."""
+        if self.concat_dim is None:
+            return 0
+        if self.concat_dim not in dataset.dimensions:
+            raise ValueError(
+                f"The dimension {self.concat_dim!r} to concatenate along is not "
+                f"in the response (dimensions: {list(dataset.dimensions)})"
+            )
+        size = int(dataset.dimensions[self.concat_dim])
+        path = self.path / ".dapclient"
+        state = _load_json(path, {})
+        length = state.get(CONCAT_KEY, {}).get(self.concat_dim, 0)
+        offset = length if self.offset is None else self.offset
+        state.setdefault(CONCAT_KEY, {})[self.concat_dim] = max(length, offset + size)
+        write_atomic(path, _dumps(state))
+        return offset
+
+    def _axis(self, variable):
+        """Axis of `concat_dim` in `variable`, if any."""
+        if self.concat_dim is None:
+            return None
+        dims = _dim_names(variable)
+        return dims.index(self.concat_dim) if self.concat_dim in dims else None
+
+    def _store_shape(self, variable, offset):
+        shape = list(variable.shape)
+        axis = self._axis(variable)
+        if axis is not None:
+            shape[axis] += offset
+        return shape
+
+
+class ZarrSink(Sink):
+    """Write the variables to a directory in the Zarr v2 layout.
+
+    Groups are subdirectories, the attributes of each variable are stored
+    in its `.zattrs` along with `_ARRAY_DIMENSIONS` (the convention of
+    xarray), and chunks are named `i.j.k` and compressed with zlib (the
+    `numcodecs` codec `{"id": "zlib"}`). Chunks follow `chunks` (per variable
+    name), or else the `_ChunkSizes` attribute of the variable, or else are
+    at most `SLAB_SIZE` bytes. The chunks of an existing array are kept.
+    `read` loads an array back without needing `zarr`.
+    """
+
+    def __init__(
+        self, path, concat_dim=None, offset=None, chunks=None, compression_level=4
+    ):
+        super().__init__(path, concat_dim, offset)
+        self.chunks = chunks or {}
+        self.compression_level = compression_level
+
+    def _chunks(self, variable):
+        chunks = self.chunks.get(variable.id.lstrip("/"), self.chunks.get(variable.name))
+        if chunks is None:
+            chunks = variable.attributes.get("_ChunkSizes")
+        shape = [max(1, n) for n in variable.shape]
+        if chunks is not None:
+            chunks = [int(c) for c in numpy.atleast_1d(chunks)]
+            if len(chunks) == len(shape):
+                return [max(1, c) for c in chunks]
+        chunks = list(shape)
+        if chunks:
+            row = int(numpy.prod(shape[1:])) * variable.dtype.itemsize
+            chunks[0] = max(1, min(shape[0], dap.SLAB_SIZE // max(row, 1)))
+        return chunks
+
+    def _open(self, dataset, offset):
+        root = self.path
+        if not (root / ".zgroup").exists():
+            write_atomic(root / ".zgroup", _dumps({"zarr_format": 2}))
+            write_atomic(root / ".zattrs", _dumps(dict(dataset.attributes)))
+        for variable in walk(dataset, BaseType):
+            directory = _path(root, variable.id)
+            for parent in reversed(directory.relative_to(root).parents[:-1]):
+                if not (root / parent / ".zgroup").exists():
+                    (root / parent).mkdir(exist_ok=True)
+                    write_atomic(root / parent / ".zgroup", _dumps({"zarr_format": 2}))
+            if variable.dtype.kind == "S" and not (directory / ".zarray").exists():
+                # the width of the strings is known once they are decoded
+                self._arrays[variable.id] = (directory, None, offset)
+                continue
+            meta = self._array(variable, directory, offset, variable.dtype)
+            self._arrays[variable.id] = (directory, meta, offset)
+
+    def _array(self, variable, directory, offset, dtype):
+        """Create the array of `variable`, or grow the existing one."""
+        shape = self._store_shape(variable, offset)
+        meta = _load_json(directory / ".zarray")
+        if meta is None:
+            directory.mkdir(exist_ok=True)
+            meta = self._metadata(variable, shape, self._chunks(variable), dtype)
+            attributes = {
+                k: v for k, v in variable.attributes.items() if k not in SKIP_ATTRIBUTES
+            }
+            attributes["_ARRAY_DIMENSIONS"] = _dim_names(variable)
+            write_atomic(directory / ".zattrs", _dumps(attributes))
+        else:
+            meta = self._grow(directory, meta, shape, variable)
+        write_atomic(directory / ".zarray", _dumps(meta))
+        return meta
+
+    def slab_rows(self, variable):
+        rows = super().slab_rows(variable)
+        meta = self._arrays[variable.id][1] if rows else None
+        if meta is None or not meta["chunks"]:
+            return rows
+        # whole chunks, so that chunks are compressed and written only once
+        chunk = meta["chunks"][0]
+        return min(variable.shape[0], max(chunk, rows // chunk * chunk))
+
+    def _metadata(self, variable, shape, chunks, dtype):
+        dtype = numpy.dtype(dtype)
+        if dtype.kind != "S":
+            dtype = dtype.newbyteorder("<")
+        fill_value = variable.attributes.get("_FillValue")
+        if isinstance(fill_value, list):
+            fill_value = fill_value[0]
+        if fill_value is not None and dtype.kind == "f":
+            fill_value = float(fill_value)
+            if not math.isfinite(fill_value):
+                # JSON has no literals for these
+                fill_value = {"nan": "NaN", "inf": "Infinity", "-inf": "-Infinity"}[
+                    str(fill_value)
+                ]
+        elif dtype.kind == "S":
+            fill_value = ""
+        compressor = None
+        if self.compression_level:
+            compressor = {"id": "zlib", "level": int(self.compression_level)}
+        return {
+            "zarr_format": 2,
+            "shape": shape,
+            "chunks": chunks,
+            "dtype": dtype.str,
+            "compressor": compressor,
+            "fill_value": fill_value,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": ".",
+        }
+
+    def _grow(self, directory, meta, shape, variable):
+        if len(meta["shape"]) != len(shape):
+            raise ValueError(
+                f"{variable.id} has shape {variable.shape}, which does not match "
+                f"the array of shape {meta['shape']} in {directory}"
+            )
+        axis = self._axis(variable)
+        for i, (old, new) in enumerate(zip(meta["shape"], shape)):
+            if i != axis and old != new:
+                raise ValueError(
+                    f"{variable.id} has shape {variable.shape}, which does not "
+                    f"match the array of shape {meta['shape']} in {directory}"
+                )
+        meta["shape"] = [max(old, new) for old, new in zip(meta["shape"], shape)]
+        return meta
+
+    def write(self, variable, index, data):
+        directory, meta, offset = self._arrays[variable.id]
+        if meta is None:
+            meta = self._string_array(variable, directory, offset, data.dtype)
+        dtype = numpy.dtype(meta["dtype"])
+        if dtype.kind == "S" and data.dtype.itemsize > dtype.itemsize:
+            raise ValueError(
+                f"The strings of {variable.id} are wider than those of the "
+                f"array in {directory} ({dtype})"
+            )
+        region = _region(variable.shape, index)
+        axis = self._axis(variable)
+        if axis is not None:
+            region[axis] = slice(region[axis].start + offset, region[axis].stop + offset)
+        data = numpy.asarray(data).astype(dtype, copy=False)
+        data = data.reshape([s.stop - s.start for s in region])
+        self._write_region(directory, meta, region, data)
+
+    def _string_array(self, variable, directory, offset, dtype):
+        with locked(self.path / ".store"):
+            meta = self._array(variable, directory, offset, dtype)
+        self._arrays[variable.id] = (directory, meta, offset)
+        return meta
+
+    def _write_region(self, directory, meta, region, data):
+        chunks = meta["chunks"]
+        if not chunks:
+            self._write_chunk(directory / "0", meta, (), (), data)
+            return
+        ranges = [
+            range(s.start // c, (s.stop - 1) // c + 1) if s.stop > s.start else range(0)
+            for s, c in zip(region, chunks)
+        ]
+        for key in itertools.product(*ranges):
+            inner, outer = [], []
+            for k, s, c in zip(key, region, chunks):
+                start, stop = max(s.start, k * c), min(s.stop, (k + 1) * c)
+                inner.append(slice(start - k * c, stop - k * c))
+                outer.append(slice(start - s.start, stop - s.start))
+            name = ".".join(str(k) for k in key)
+            self._write_chunk(directory / name, meta, tuple(inner), tuple(outer), data)
+
+    def _write_chunk(self, path, meta, inner, outer, data):
+        chunks = tuple(meta["chunks"])
+        dtype = numpy.dtype(meta["dtype"])
+        if all(s.stop - s.start == c for s, c in zip(inner, chunks)):
+            # the whole chunk is ours
+            write_atomic(path, self._encode(data[outer], meta))
+            return
+        # another writer may fill the rest of the chunk
+        with locked(path):
+            chunk = self._decode(path, meta, chunks, dtype)
+            chunk[inner] = data[outer]
+            write_atomic(path, self._encode(chunk, meta))
+
+    def _encode(self, chunk, meta):
+        raw = numpy.ascontiguousarray(chunk).tobytes()
+        if meta["compressor"] is None:
+            return raw
+        return zlib.compress(raw, meta["compressor"].get("level", 1))
+
+    def _decode(self, path, meta, chunks, dtype):
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            chunk = numpy.empty(chunks, dtype)
+            chunk[...] = self._fill_value(meta, dtype)
+            return chunk
+        if meta["compressor"] is not None:
+            raw = zlib.decompress(raw)
+        return numpy.frombuffer(raw, dtype).reshape(chunks).copy()
+
+    @staticmethod
+    def _fill_value(meta, dtype):
+        fill_value = meta["fill_value"]
+        if fill_value is None:
+            return numpy.zeros((), dtype)
+        if isinstance(fill_value, str) and dtype.kind == "f":
+            return float(fill_value.replace("Infinity", "inf"))
+        return fill_value
+
+    def read(self, name):
+        """Load the array `name` (e.g. `"sst"` or `"group/sst"`) of the store."""
+        directory = _path(self.path, name)
+        meta = _load_json(directory / ".zarray")
+        if meta is None:
+            raise KeyError(name)
+        dtype = numpy.dtype(meta["dtype"])
+        shape, chunks = meta["shape"], tuple(meta["chunks"])
+        data = numpy.empty(shape, dtype)
+        if not chunks:
+            data[...] = self._decode(directory / "0", meta, (), dtype)
+            return data
+        for key in itertools.product(
+            *[range(math.ceil(n / c)) for n, c in zip(shape, chunks)]
+        ):
+            chunk = self._decode(
+                directory / ".".join(str(k) for k in key), meta, chunks, dtype
+            )
+            index = tuple(
+                slice(k * c, min(n, (k + 1) * c)) for k, c, n in zip(key, chunks, shape)
+            )
+            data[index] = chunk[tuple(slice(0, s.stop - s.start) for s in index)]
+        return data
+
+
+class NpySink(Sink):
+    """Write each variable to a `.npy` file (`group/name.npy`) in a directory.
+
+    The files are created at their full size when the DMR is decoded, and the
+    slabs are written into them through memory maps, so that several writers
+    can fill different regions of the same file. Appending along
+    `concat_dim` rewrites the header in place (`numpy` leaves room in it for
+    the shape to grow), which requires `concat_dim` to be the first
+    dimension of the variables that have it. Strings are stored with the
+    width they are decoded with.
+    """
+
+    def _open(self, dataset, offset):
+        for variable in walk(dataset, BaseType):
+            path = _path(self.path, variable.id, ".npy")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            axis = self._axis(variable)
+            if axis not in (None, 0):
+                raise ValueError(
+                    f"{variable.id} can only be appended along its first "
+                    f"dimension in a .npy file, not along {self.concat_dim!r}"
+                )
+            shape = tuple(self._store_shape(variable, offset))
+            if variable.dtype.kind != "S":
+                dtype = variable.dtype.newbyteorder("<")
+                if path.exists():
+                    self._grow(path, variable, shape, dtype)
+                else:
+                    numpy.lib.format.open_memmap(
+                        path, mode="w+", dtype=dtype, shape=shape
+                    )
+            self._arrays[variable.id] = [path, offset, None]
+
+    def _grow(self, path, variable, shape, dtype):
+        with open(path, "r+b") as f:
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(f)
+            old_shape, fortran, old_dtype = header
+            start = f.tell()
+            if old_dtype != dtype or fortran or old_shape[1:] != shape[1:]:
+                raise ValueError(
+                    f"{variable.id} ({dtype}, {variable.shape}) does not match "
+                    f"the array ({old_dtype}, {old_shape}) in {path}"
+                )
+            if shape[0] <= old_shape[0]:
+                return
+            header = repr(
+                {
+                    "descr": numpy.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": shape,
+                }
+            )
+            prefix = 8 + (2 if version == (1, 0) else 4)
+            size = start - prefix
+            if len(header) + 1 > size:
+                raise ValueError(f"No room left to grow the header of {path}")
+            f.seek(prefix)
+            f.write(header.ljust(size - 1).encode("latin1") + b"\n")
+            f.truncate(start + int(numpy.prod(shape)) * dtype.itemsize)
+
+    def write(self, variable, index, data):
+        array = self._arrays[variable.id]
+        path, offset, memmap = array
+        if data.dtype.kind == "S":
+            with locked(self.path / ".store"):
+                shape = tuple(self._store_shape(variable, offset))
+                if path.exists():
+                    self._grow(path, variable, shape, data.dtype)
+                else:
+                    numpy.lib.format.open_memmap(
+                        path, mode="w+", dtype=data.dtype, shape=shape
+                    )
+        if memmap is None:
+            memmap = array[2] = numpy.load(path, mmap_mode="r+")
+        region = _region(variable.shape, index)
+        if self._axis(variable) is not None:
+            region[0] = slice(region[0].start + offset, region[0].stop + offset)
+        memmap[tuple(region)] = numpy.asarray(data).reshape(
+            [s.stop - s.start for s in region]
+        )
+
+    def close(self):
+        for _, _, memmap in self._arrays.values():
+            if memmap is not None:
+                memmap.flush()
+        super().close()
+
+    def read(self, name):
+        """Load the array `name` (e.g. `"sst"` or `"group/sst"`) of the store."""
+        return numpy.load(_path(self.path, name, ".npy"))
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import dapclient.net
+from dapclient.cache import HyperslabCache
+
+from .local_server import Dap2App, Dap4App
+
+
+@pytest.fixture(autouse=True)
+def capability_registry(tmp_path, monkeypatch):
+    """Keep the server capabilities learned by a test out of the user's cache."""
+    registry = dapclient.net.CapabilityRegistry(tmp_path / "server_capabilities.json")
+    monkeypatch.setattr(dapclient.net, "_capability_registry", registry)
+    return registry
+
+
+@pytest.fixture
+def hyperslab_cache():
+    """A cache of hyperslabs, for `open_url(..., hyperslab_cache=...)`."""
+    return HyperslabCache()
+
+
+@pytest.fixture
+def dap4_app():
+    """Build a `Dap4App` serving `v(t, x)`, of `nt` steps of `nx` floats, and
+    its axes. `variables` are added or replace these, and the other keywords
+    are passed to `Dap4App`."""
+
+    def make(nt=10, nx=20, variables=None, **kwargs):
+        values = {
+            "t": (("t",), np.arange(nt, dtype="i4")),
+            "x": (("x",), np.arange(float(nx))),
+            "v": (("t", "x"), np.arange(nt * nx, dtype="f4").reshape(nt, nx)),
+        }
+        values.update(variables or {})
+        return Dap4App(values, **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def dap2_app():
+    """Build a `Dap2App` serving the Grid `sst(x, y)`, a Grid of strings and
+    one of bytes; the keywords are passed to `Dap2App`."""
+
+    def make(**kwargs):
+        return Dap2App(
+            {
+                "x": (("x",), np.arange(5.0)),
+                "y": (("y",), np.arange(3, dtype="i2")),
+                "sst": (("x", "y"), np.arange(15, dtype=">f4").reshape(5, 3)),
+                "mask": (("x",), np.array([1, 0, 1, 1, 0], dtype="u1")),
+                "names": (("y",), np.array(["a", "bcd", "efghi"], dtype=object)),
+            },
+            **kwargs,
+        )
+
+    return make
@@ -0,0 +1,556 @@
+"""A small local DAP server used by the tests and the benchmarks.
+
+`Dap4App` is a WSGI stand-in for a remote OPeNDAP server. It serves a `.dmr`
+and a `.dap` response (honoring `dap4.ce` hyperslabs) for an in-memory
+collection of numpy arrays. `Dap2App` does the same with `.dds`, `.das` and
+`.dods` responses, and can serve the arrays as Grids. `LocalServer` runs any WSGI application on a
+background thread, keeps HTTP/1.1 connections alive, and counts the number
+of TCP connections opened by clients. `scale_dods` inflates a DAP2 `.dods`
+response into a sequence of many records.
+"""
+
+import gzip
+import re
+import socketserver
+import threading
+import zlib
+from urllib.parse import parse_qs, unquote
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+import numpy as np
+
+DAP4_TYPES = {
+    "i1": "Int8",
+    "u1": "Byte",
+    "i2": "Int16",
+    "u2": "UInt16",
+    "i4": "Int32",
+    "u4": "UInt32",
+    "i8": "Int64",
+    "u8": "UInt64",
+    "f4": "Float32",
+    "f8": "Float64",
+}
+
+DAP2_TYPES = {
+    "u1": "Byte",
+    "i2": "Int16",
+    "u2": "UInt16",
+    "i4": "Int32",
+    "u4": "UInt32",
+    "f4": "Float32",
+    "f8": "Float64",
+}
+
+START_OF_INSTANCE = b"\x5a\x00\x00\x00"
+END_OF_SEQUENCE = b"\xa5\x00\x00\x00"
+
+_HYPERSLAB_RE = re.compile(r"\[(\d+)(?::(\d+))?(?::(\d+))?\]")
+
+
+class _KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        handler = _KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if self.headers.get("Connection", "").lower() == "close":
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class _CountingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+
+class LocalServer:
+    """Serve a WSGI application on localhost from a background thread.
+
+    >>> with LocalServer(app) as server:  # doctest: +SKIP
+    ...     ds = open_url(server.url + "/data", protocol="dap4")
+    """
+
+    def __init__(self, application, host="127.0.0.1", port=0):
+        self.application = application
+        self.server = _CountingWSGIServer(
+            (host, port), _KeepAliveRequestHandler, bind_and_activate=True
+        )
+        self.server.set_app(self._count(application))
+        self.host, self.port = self.server.server_address[:2]
+        self.url = f"http://{self.host}:{self.port}"
+        self._thread = None
+
+    def _count(self, application):
+        def app(environ, start_response):
+            with self.server._lock:
+                self.server.requests += 1
+            return application(environ, start_response)
+
+        return app
+
+    @property
+    def connections(self):
+        """Number of TCP connections accepted so far."""
+        return self.server.connections
+
+    @property
+    def requests(self):
+        """Number of HTTP requests served so far."""
+        return self.server.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def parse_dap4_ce(ce):
+    """Return `{name: tuple of slices}` from a `dap4.ce` string."""
+    out = {}
+    for item in unquote(ce).split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        name = item.split("[", 1)[0].lstrip("/")
+        slices = []
+        for start, step, stop in _HYPERSLAB_RE.findall(item):
+            if stop == "":
+                # [start:stop] or [index]
+                stop = step or start
+                step = "1"
+            slices.append(slice(int(start), int(stop) + 1, int(step or 1)))
+        out[name] = tuple(slices)
+    return out
+
+
+class Dap4App:
+    """WSGI stand-in for a DAP4 server.
+
+    Parameters:
+    -----------
+        variables: dict
+            `{name: (dims, array)}` where `dims` is a tuple of dimension names.
+            Every dimension must also be present as a 1-D variable.
+        name: str
+            name of the dataset, and path under which it is served.
+        chunk_size: int
+            maximum number of bytes per DAP4 chunk in `.dap` responses.
+        little_endian: bool
+            encode the data as little endian (default) or big endian.
+        corrupt: int
+            number of `.dap` responses in which a data byte is flipped after
+            the checksums are computed.
+        attributes: dict | None
+            `{name: {attribute: value}}` added to the variables in the DMR.
+            Values may be lists.
+        hyrax: str | None
+            version of Hyrax (e.g. "1.17.1-550") announced in `.ver`
+            responses. When None, `.ver` requests are not found.
+    """
+
+    def __init__(
+        self,
+        variables,
+        name="data.nc",
+        chunk_size=2**16,
+        little_endian=True,
+        corrupt=0,
+        attributes=None,
+        hyrax=None,
+    ):
+        self.variables = variables
+        self.name = name
+        self.chunk_size = chunk_size
+        self.little_endian = little_endian
+        self.corrupt = corrupt
+        self.attributes = attributes or {}
+        self.hyrax = hyrax
+        self.dimensions = {}
+        for dims, array in variables.values():
+            for dim, size in zip(dims, np.shape(array)):
+                self.dimensions[dim] = size
+
+    def dmr(self, ce=None):
+        selected = parse_dap4_ce(ce) if ce else None
+        lines = [
+            '<?xml version="1.0" encoding="ISO-8859-1"?>',
+            '<Dataset xmlns="http://xml.opendap.org/ns/DAP/4.0#" '
+            f'dapVersion="4.0" dmrVersion="1.0" name="{self.name}">',
+        ]
+        shapes = {}
+        for var, (dims, array) in self.variables.items():
+            if selected is not None and var not in selected:
+                continue
+            slices = selected.get(var, ()) if selected else ()
+            shapes[var] = np.empty(np.shape(array), dtype="u1")[slices].shape
+        sizes = dict(self.dimensions)
+        for var, (dims, array) in self.variables.items():
+            if var in shapes:
+                sizes.update(zip(dims, shapes[var]))
+        for dim, size in sizes.items():
+            lines.append(f'    <Dimension name="{dim}" size="{size}"/>')
+        for var, (dims, array) in self.variables.items():
+            if var not in shapes:
+                continue
+            dtype = np.asarray(array).dtype
+            tag = "String" if dtype.kind in "SUO" else DAP4_TYPES[dtype.str[1:]]
+            lines.append(f'    <{tag} name="{var}">')
+            for dim in dims:
+                lines.append(f'        <Dim name="/{dim}"/>')
+            for attr, value in self.attributes.get(var, {}).items():
+                values = value if isinstance(value, (list, tuple)) else [value]
+                kind = type(values[0])
+                atype = {int: "Int32", float: "Float64"}.get(kind, "String")
+                lines.append(f'        <Attribute name="{attr}" type="{atype}">')
+                for item in values:
+                    lines.append(f"            <Value>{item}</Value>")
+                lines.append("        </Attribute>")
+            lines.append(f"    </{tag}>")
+        lines.append("</Dataset>")
+        return "\n".join(lines).encode("ascii")
+
+    def data(self, ce=None):
+        selected = parse_dap4_ce(ce) if ce else None
+        order = "<" if self.little_endian else ">"
+        body = bytearray()
+        for var, (dims, array) in self.variables.items():
+            if selected is not None and var not in selected:
+                continue
+            slices = selected.get(var, ()) if selected else ()
+            array = np.asarray(array)[slices]
+            if array.dtype.kind in "SUO":
+                # the checksum covers the characters, not the length prefixes
+                raw = bytearray()
+                crc = 0
+                for item in array.ravel():
+                    item = item.decode() if isinstance(item, bytes) else str(item)
+                    encoded = item.encode("utf-8")
+                    raw += len(encoded).to_bytes(8, "little") + encoded
+                    crc = zlib.crc32(encoded, crc)
+                raw = bytes(raw)
+            else:
+                raw = array.astype(array.dtype.newbyteorder(order)).tobytes()
+                crc = zlib.crc32(raw)
+            body += raw
+            body += np.array([crc], dtype=order + "u4").tobytes()
+        if self.corrupt and body:
+            self.corrupt -= 1
+            body[0] ^= 0xFF
+        return self.chunked(self.dmr(ce) + b"\r\n", bytes(body))
+
+    def chunked(self, dmr, body):
+        flag = 0x04 if self.little_endian else 0x00
+        chunks = []
+        pieces = [dmr] + [
+            body[i : i + self.chunk_size] for i in range(0, len(body), self.chunk_size)
+        ]
+        if not body:
+            pieces.append(b"")
+        for i, piece in enumerate(pieces):
+            chunk_type = flag | (0x01 if i == len(pieces) - 1 else 0x00)
+            header = (chunk_type << 24) | len(piece)
+            chunks.append(header.to_bytes(4, "big") + piece)
+        return b"".join(chunks)
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        ce = query.get("dap4.ce", [None])[0]
+        if path.endswith(".dmr"):
+            body = self.dmr(ce)
+            content_type = "application/vnd.opendap.dap4.dataset-metadata+xml"
+        elif path.endswith(".dap"):
+            body = self.data(ce)
+            content_type = "application/vnd.opendap.dap4.data"
+        elif path.endswith(".ver") and self.hyrax:
+            body = (
+                f'<?xml version="1.0" encoding="UTF-8"?>\n<HyraxInfo>\n'
+                f'    <Hyrax version="{self.hyrax}"/>\n</HyraxInfo>'
+            ).encode("utf-8")
+            content_type = "text/xml"
+        else:
+            start_response("404 Not Found", [("Content-Length", "0")])
+            return [b""]
+        start_response(
+            "200 OK",
+            [("Content-Type", content_type), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+
+def parse_dap2_ce(ce):
+    """Return `{name: tuple of slices}` from the projection of a DAP2 query."""
+    out = {}
+    projection = unquote(ce).split("&", 1)[0]
+    for item in projection.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name = item.split("[", 1)[0]
+        slices = []
+        for start, step, stop in _HYPERSLAB_RE.findall(item):
+            if stop == "":
+                stop = step or start
+                step = "1"
+            slices.append(slice(int(start), int(stop) + 1, int(step or 1)))
+        out[name] = tuple(slices)
+    return out
+
+
+def xdr(array):
+    """Encode a numpy array (or scalar) as in the XDR payload of `.dods`."""
+    array = np.asarray(array)
+    if array.dtype.kind in "SUO":
+        strings = [
+            item if isinstance(item, bytes) else str(item).encode("ascii")
+            for item in array.ravel()
+        ]
+        body = b"".join(
+            len(item).to_bytes(4, "big") + item + b"\0" * (-len(item) % 4)
+            for item in strings
+        )
+        return (len(strings).to_bytes(4, "big") if array.ndim else b"") + body
+    if array.dtype.char in "hH":
+        # 16-bit integers are sent as 32-bit
+        array = array.astype(array.dtype.kind + "4")
+    raw = array.astype(array.dtype.newbyteorder(">")).tobytes()
+    if array.dtype.char == "B":
+        raw += b"\0" * (-len(raw) % 4)
+    if array.ndim:
+        raw = 2 * array.size.to_bytes(4, "big") + raw
+    return raw
+
+
+class Dap2App:
+    """WSGI stand-in for a DAP2 server.
+
+    Parameters:
+    -----------
+        variables: dict
+            `{name: (dims, array)}` where `dims` is a tuple of dimension names.
+        name: str
+            name of the dataset, and path under which it is served.
+        grids: bool
+            serve the variables whose dimensions are all 1-D variables as Grids.
+        attributes: dict | None
+            `{name: {attribute: value}}` served in the DAS.
+        gzip: bool
+            compress the `.dods` responses.
+
+    Projections select whole variables (`sst[0:1:3][2]`), Grids (`g[0][1]`,
+    slicing the array and its maps) or members of a Grid (`g.g[0][1]`,
+    returned in a Structure). 1-D structured arrays are served as Sequences,
+    whose records can be sliced (`seq[0:1:9]`) and fields projected
+    (`seq.a,seq.b`). Selections are ignored.
+    """
+
+    def __init__(
+        self, variables, name="data", grids=False, attributes=None, gzip=False
+    ):
+        self.variables = variables
+        self.name = name
+        self.grids = grids
+        self.attributes = attributes or {}
+        self.gzip = gzip
+
+    def is_grid(self, var):
+        dims = self.variables[var][0]
+        return (
+            self.grids
+            and bool(dims)
+            and dims != (var,)
+            and all(
+                dim in self.variables and self.variables[dim][0] == (dim,)
+                for dim in dims
+            )
+        )
+
+    def _declaration(self, var, array, indent, dims=None):
+        dtype = np.asarray(array).dtype
+        tag = "String" if dtype.kind in "SUO" else DAP2_TYPES[dtype.str[1:]]
+        dims = self.variables[var][0] if dims is None else dims
+        shape = "".join(
+            f"[{dim} = {size}]" for dim, size in zip(dims, np.shape(array))
+        )
+        return f"{indent}{tag} {var}{shape};"
+
+    def _selected(self, ce):
+        """Yield `(name, members, slices)` for the projected variables."""
+        selected = parse_dap2_ce(ce) if ce else None
+        for var in self.variables:
+            if selected is None:
+                yield var, None, ()
+                continue
+            if var in selected:
+                yield var, None, selected[var]
+            members = [
+                (key.split(".", 1)[1], slices)
+                for key, slices in selected.items()
+                if key.startswith(var + ".")
+            ]
+            if members:
+                yield var, members, ()
+
+    def _parts(self, var, members, slices):
+        """Return `(structure, [(name, array)])` for a projected variable."""
+        dims, array = self.variables[var]
+        array = np.asarray(array)
+        if array.dtype.names:
+            fields = array.dtype.names
+            if members is not None:
+                fields = [member for member, _ in members]
+            return "Sequence", [(field, array[slices][field]) for field in fields]
+        if members is not None:
+            return "Structure", [
+                (member, np.asarray(self.variables[member][1])[member_slices])
+                for member, member_slices in members
+            ]
+        if not self.is_grid(var):
+            return None, [(var, array[slices])]
+        slices = slices + (slice(None),) * (len(dims) - len(slices))
+        maps = [
+            (dim, np.asarray(self.variables[dim][1])[s])
+            for dim, s in zip(dims, slices)
+        ]
+        return "Grid", [(var, array[slices])] + maps
+
+    def dds(self, ce=None):
+        lines = ["Dataset {"]
+        for var, members, slices in self._selected(ce):
+            structure, parts = self._parts(var, members, slices)
+            if structure is None:
+                lines.append(self._declaration(var, parts[0][1], "    "))
+                continue
+            lines.append(f"    {structure} {{")
+            if structure == "Grid":
+                lines.append("    Array:")
+                lines.append(self._declaration(*parts[0], "        "))
+                lines.append("    Maps:")
+                parts = parts[1:]
+            for name, array in parts:
+                dims = () if structure == "Sequence" else None
+                lines.append(self._declaration(name, array, "        ", dims))
+            lines.append(f"    }} {var};")
+        lines.append(f"}} {self.name};")
+        return "\n".join(lines).encode("ascii")
+
+    def das(self):
+        lines = ["Attributes {"]
+        for var in self.variables:
+            lines.append(f"    {var} {{")
+            for attr, value in self.attributes.get(var, {}).items():
+                values = value if isinstance(value, (list, tuple)) else [value]
+                kind = type(values[0])
+                atype = {int: "Int32", float: "Float64"}.get(kind, "String")
+                if atype == "String":
+                    values = [f'"{item}"' for item in values]
+                items = ", ".join(str(item) for item in values)
+                lines.append(f"        {atype} {attr} {items};")
+            lines.append("    }")
+        lines.append("}")
+        return "\n".join(lines).encode("ascii")
+
+    def dods(self, ce=None):
+        body = [self.dds(ce), b"\nData:\n"]
+        for var, members, slices in self._selected(ce):
+            structure, parts = self._parts(var, members, slices)
+            if structure == "Sequence":
+                columns = [array for _, array in parts]
+                for record in zip(*columns):
+                    body.append(START_OF_INSTANCE)
+                    body.extend(
+                        xdr(np.asarray(value, column.dtype))
+                        for value, column in zip(record, columns)
+                    )
+                body.append(END_OF_SEQUENCE)
+                continue
+            for _, array in parts:
+                body.append(xdr(array))
+        return b"".join(body)
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        ce = environ.get("QUERY_STRING", "")
+        headers = [("Content-Type", "application/octet-stream")]
+        if path.endswith(".dds"):
+            body = self.dds(ce)
+        elif path.endswith(".das"):
+            body = self.das()
+        elif path.endswith(".dods"):
+            body = self.dods(ce)
+            if self.gzip:
+                body = gzip.compress(body)
+                headers.append(("Content-Encoding", "gzip"))
+        else:
+            start_response("404 Not Found", [("Content-Length", "0")])
+            return [b""]
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
+        return [body]
+
+
+def scale_dods(dods, n):
+    """Turn a flat DAP2 `.dods` response into a sequence of `n` records.
+
+    The variables of the response become the fields of a sequence `records`,
+    and each record holds a copy of their values.
+    """
+    dds, data = dods.split(b"\nData:\n", 1)
+    header, body = dds.split(b"{\n", 1)
+    declarations, footer = body.rsplit(b"}", 1)
+    fields = [b"    " + line + b"\n" for line in declarations.splitlines() if line]
+    return b"".join(
+        [
+            header,
+            b"{\n    Sequence {\n",
+            *fields,
+            b"    } records;\n}",
+            footer,
+            b"\nData:\n",
+            (START_OF_INSTANCE + data) * n,
+            END_OF_SEQUENCE,
+        ]
+    )
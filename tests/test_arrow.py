@@ -0,0 +1,107 @@
+"""Tests for the export of sequences to Arrow and Parquet."""
+
+import copy
+import sys
+
+import numpy
+import pytest
+
+import dapclient.client
+from dapclient.handlers.dap import SequenceProxy
+from dapclient.parsers.dds import dds_to_dataset
+
+from .local_server import (
+    END_OF_SEQUENCE,
+    START_OF_INSTANCE,
+    Dap2App,
+    LocalServer,
+    xdr,
+)
+
+pyarrow = pytest.importorskip("pyarrow")
+pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+
+
+def _records(n):
+    records = numpy.zeros(
+        n, dtype=[("id", "i4"), ("depth", "f8"), ("qc", "u1"), ("platform", "O")]
+    )
+    records["id"] = numpy.arange(n)
+    records["depth"] = numpy.arange(n) / 2
+    records["qc"] = numpy.arange(n) % 4
+    records["platform"] = [f"argo-{i % 7}" for i in range(n)]
+    return records
+
+
+def test_to_arrow_batches():
+    records = _records(1000)
+    with LocalServer(Dap2App({"argo": ((), records)})) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        batches = list(dataset["argo"].to_arrow_batches(batch_rows=400))
+    assert [batch.num_rows for batch in batches] == [400, 400, 200]
+    table = pyarrow.Table.from_batches(batches)
+    assert table.schema == pyarrow.schema(
+        [
+            ("id", pyarrow.int32()),
+            ("depth", pyarrow.float64()),
+            ("qc", pyarrow.uint8()),
+            ("platform", pyarrow.string()),
+        ]
+    )
+    numpy.testing.assert_array_equal(table["depth"].to_numpy(), records["depth"])
+    assert table["platform"].to_pylist() == list(records["platform"])
+
+
+def test_to_parquet(tmp_path):
+    records = _records(1000)
+    path = tmp_path / "argo.parquet"
+    with LocalServer(Dap2App({"argo": ((), records)})) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        dataset["argo"]["id", "qc"].to_parquet(path, batch_rows=300)
+    assert pyarrow_parquet.ParquetFile(path).num_row_groups == 4
+    table = pyarrow_parquet.read_table(path)
+    assert table.column_names == ["id", "qc"]
+    numpy.testing.assert_array_equal(table["id"].to_numpy(), records["id"])
+
+
+def test_to_arrow_batches_nested():
+    dds = """Dataset {
+    Sequence {
+        Int32 id;
+        Sequence {
+            Float64 depth;
+            Int16 qc;
+        } profile;
+    } casts;
+} data;"""
+    body = b""
+    for i in range(3):
+        body += START_OF_INSTANCE + xdr(numpy.int32(i))
+        for j in range(i):
+            body += START_OF_INSTANCE + xdr(numpy.float64(j)) + xdr(numpy.int16(j))
+        body += END_OF_SEQUENCE
+    dods = dds.encode("ascii") + b"\nData:\n" + body + END_OF_SEQUENCE
+
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/octet-stream")])
+        return [dods]
+
+    sequence = dds_to_dataset(dds)["casts"]
+    sequence.data = SequenceProxy(
+        "http://localhost/data", copy.copy(sequence), application=application
+    )
+    (batch,) = sequence.to_arrow_batches()
+    assert batch.to_pylist() == [
+        {"id": 0, "profile": []},
+        {"id": 1, "profile": [{"depth": 0.0, "qc": 0}]},
+        {"id": 2, "profile": [{"depth": 0.0, "qc": 0}, {"depth": 1.0, "qc": 1}]},
+    ]
+
+
+def test_to_parquet_without_pyarrow(monkeypatch, tmp_path):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.delitem(sys.modules, "dapclient.arrow", raising=False)
+    dds = "Dataset {\n    Sequence {\n        Int32 a;\n    } s;\n} d;"
+    dataset = dds_to_dataset(dds)
+    with pytest.raises(NotImplementedError):
+        dataset["s"].to_parquet(tmp_path / "s.parquet")
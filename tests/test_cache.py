@@ -0,0 +1,208 @@
+"""Tests for the persistent cache of decoded arrays."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import dapclient.client
+from dapclient.cache import ArrayCache, HyperslabCache, metadata_hash
+
+from .local_server import Dap4App, LocalServer
+
+
+def _key(name, metadata="dmr"):
+    return ArrayCache.key("http://localhost/data.nc", name, (range(0, 10),), metadata)
+
+
+def test_array_cache(tmp_path):
+    cache = ArrayCache(tmp_path)
+    values = numpy.arange(10, dtype=">i2")
+    cache.put(_key("a"), values)
+    cache.put(_key("s"), numpy.array([b"ab", b"c"]))
+    cache.put(_key("o"), numpy.array(["ab", 1], dtype=object))
+
+    data = cache.get(_key("a"))
+    assert data.dtype == values.dtype
+    numpy.testing.assert_array_equal(data, values)
+    numpy.testing.assert_array_equal(cache.get(_key("s")), [b"ab", b"c"])
+    assert cache.get(_key("o")) is None
+    # the metadata is part of the key
+    assert cache.get(_key("a", metadata="changed")) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert len(list(tmp_path.glob("*/*.npy.gz"))) == 2
+
+    # another process sees the same arrays
+    numpy.testing.assert_array_equal(ArrayCache(tmp_path).get(_key("a")), values)
+
+
+def test_array_cache_eviction(tmp_path):
+    cache = ArrayCache(tmp_path)
+    values = numpy.random.default_rng(0).random(1000)
+    for i, name in enumerate("abc"):
+        cache.put(_key(name), values)
+        path = cache._file(_key(name))
+        os.utime(path, (i, i))
+    size = cache.nbytes // 3
+
+    # a hit makes "a" the most recently used
+    assert cache.get(_key("a")) is not None
+    cache.maxsize = 3 * size
+    cache.put(_key("d"), values)
+    assert cache.nbytes <= 3 * size
+    assert cache.get(_key("b")) is None
+    for name in "acd":
+        assert cache.get(_key(name)) is not None
+
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_array_cache_corrupted(tmp_path):
+    cache = ArrayCache(tmp_path)
+    cache.put(_key("a"), numpy.arange(10))
+    path = cache._file(_key("a"))
+    path.write_bytes(path.read_bytes()[:20])
+    assert cache.get(_key("a")) is None
+    assert not path.exists()
+
+
+def test_array_cache_concurrent(tmp_path):
+    values = numpy.arange(1000.0)
+
+    def write(i):
+        cache = ArrayCache(tmp_path)
+        cache.put(_key(str(i % 4)), values)
+        return cache.get(_key(str(i % 4)))
+
+    with ThreadPoolExecutor(8) as pool:
+        for data in pool.map(write, range(32)):
+            numpy.testing.assert_array_equal(data, values)
+    assert not list(tmp_path.glob("*/.tmp*"))
+
+
+def test_open_url_array_cache(tmp_path):
+    variables = {
+        "x": (("x",), numpy.arange(20.0)),
+        "v": (("x",), numpy.arange(20, dtype="f4")),
+    }
+    app = Dap4App(variables)
+    with LocalServer(app) as server:
+        url = server.url + "/data.nc"
+        dataset = dapclient.client.open_url(url, protocol="dap4", array_cache=tmp_path)
+        v = dataset["v"][2:8]
+        checksum = v.attributes["_DAP4_Checksum_CRC32"]
+        numpy.testing.assert_array_equal(numpy.asarray(v), range(2, 8))
+        requests = server.requests
+
+        dataset = dapclient.client.open_url(url, protocol="dap4", array_cache=tmp_path)
+        assert dataset["v"].data.dmr_hash == metadata_hash(app.dmr())
+        v = dataset["v"][2:8]
+        numpy.testing.assert_array_equal(numpy.asarray(v), range(2, 8))
+        # the checksum of the server is not cached
+        assert checksum and "_DAP4_Checksum_CRC32" not in v.attributes
+        # only the DMR was requested
+        assert server.requests == requests + 1
+        dataset["v"][2:9]
+        assert server.requests == requests + 2
+
+        # a dataset that changed on the server is downloaded again
+        app.attributes["v"] = {"units": "m"}
+        dataset = dapclient.client.open_url(url, protocol="dap4", array_cache=tmp_path)
+        dataset["v"][2:8]
+        assert server.requests == requests + 4
+
+
+def test_hyperslab_cache_superset(hyperslab_cache, dap4_app):
+    app = dap4_app()
+    values = app.variables["v"][1]
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data.nc", protocol="dap4", hyperslab_cache=hyperslab_cache
+        )
+        numpy.testing.assert_array_equal(numpy.asarray(dataset["v"][:]), values)
+        requests = server.requests
+        for index in [
+            (slice(2, 4),),
+            (1, slice(5, 10, 2)),
+            (slice(None, None, 3), -1),
+            (Ellipsis,),
+        ]:
+            numpy.testing.assert_array_equal(
+                numpy.asarray(dataset["v"][index]).reshape(values[index].shape),
+                values[index],
+            )
+        assert server.requests == requests
+        assert hyperslab_cache.hits == 4
+
+        # strided hyperslabs only hold slices on their grid
+        dataset["t"][0:10:2]
+        requests = server.requests
+        numpy.testing.assert_array_equal(numpy.asarray(dataset["t"][2:9:4]), [2, 6])
+        assert server.requests == requests
+        numpy.testing.assert_array_equal(numpy.asarray(dataset["t"][1:3]), [1, 2])
+        assert server.requests == requests + 1
+
+
+def test_hyperslab_cache_copies(dap4_app):
+    app = dap4_app()
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data.nc", protocol="dap4", hyperslab_cache=True
+        )
+        requests = server.requests
+        first = numpy.asarray(dataset["x"][:])
+        first[:] = -1
+        second = numpy.asarray(dataset["x"][:])
+        second[:] = -2
+        numpy.testing.assert_array_equal(numpy.asarray(dataset["x"][:5]), range(5))
+        assert server.requests == requests + 1
+
+
+def test_hyperslab_cache_checksums(hyperslab_cache, dap4_app):
+    app = dap4_app()
+    with LocalServer(app) as server:
+        url = server.url + "/data.nc"
+        dataset = dapclient.client.open_url(
+            url, protocol="dap4", checksums=True, hyperslab_cache=hyperslab_cache
+        )
+        full = dataset["v"][:]
+        checksum = full.attributes["_DAP4_Checksum_CRC32"]
+        requests = server.requests
+        # the same hyperslab keeps the checksum of the server
+        assert dataset["v"][:].attributes["_DAP4_Checksum_CRC32"] == checksum
+        # a subset has none
+        assert "_DAP4_Checksum_CRC32" not in dataset["v"][3:5, 2:7].attributes
+        assert server.requests == requests
+        # nor do downloads stop asking for checksums
+        assert "_DAP4_Checksum_CRC32" in dataset["t"][2:4].attributes
+
+        # another session, or a dataset that changed, is not served the cache
+        dataset = dapclient.client.open_url(
+            url, protocol="dap4", hyperslab_cache=hyperslab_cache
+        )
+        dataset["v"][3:5, 2:7]
+        app.attributes["v"] = {"units": "K"}
+        session = dataset["v"].data.session
+        dataset = dapclient.client.open_url(
+            url, protocol="dap4", session=session, hyperslab_cache=hyperslab_cache
+        )
+        dataset["v"][3:5, 2:7]
+        assert server.requests == requests + 5
+
+
+def test_hyperslab_cache_budget():
+    cache = HyperslabCache(maxsize=3 * 80)
+    ranges = (range(0, 10),)
+    for i in range(4):
+        cache.put(("url", f"v{i}"), ranges, numpy.zeros(10))
+    assert cache.nbytes == 3 * 80
+    assert cache.get(("url", "v0"), ranges) == (None, None)
+    # a hit keeps an entry alive
+    cache.get(("url", "v1"), (range(2, 4),))
+    cache.put(("url", "v4"), ranges, numpy.zeros(10))
+    assert cache.get(("url", "v1"), ranges)[0] is not None
+    assert cache.get(("url", "v2"), ranges)[0] is None
+    # too large to be cached at all
+    cache.put(("url", "big"), (range(0, 40),), numpy.zeros(40))
+    assert cache.get(("url", "big"), (range(0, 1),))[0] is None
@@ -1,7 +1,24 @@
+import os
+
 import numpy as np
 import pytest
 
-from dapclient.client import open_dods_url, open_url
+from requests import Request
+from requests_cache import CachedSession
+
+import dapclient.client
+from dapclient.client import (
+    CubeManifest,
+    DownloadManifest,
+    consolidate_metadata,
+    open_dods_url,
+    open_mfdataset,
+    open_url,
+)
+from dapclient.exceptions import ChecksumError
+from dapclient.handlers.dap import CHECKSUM_RETRIES, UNPACKDAP4DATA
+
+from .local_server import Dap4App, LocalServer
 
 
 @pytest.mark.client
@@ -337,3 +354,275 @@ def test_dods():
         dataset.attributes["NC_GLOBAL"]["history"]
         == "FERRET V4.30 (debug/no GUI) 15-Aug-96"
     )
+
+
+def _granules(n=3, nt=4, nx=None):
+    """A server of `n` granules of `nt` time steps, and the paths requested."""
+    apps = {}
+    for i, size in enumerate(nx or [5] * n):
+        time = np.arange(i * nt, (i + 1) * nt, dtype="i4")
+        x = np.arange(size)
+        apps[f"g{i}.nc"] = Dap4App(
+            {
+                "time": (("time",), time),
+                "x": (("x",), x.astype("f8")),
+                "v": (("time", "x"), (time[:, None] * 10 + x).astype("f4")),
+                "mask": (("x",), x.astype("i2") + i),
+            }
+        )
+    paths = []
+
+    def application(environ, start_response):
+        path = environ["PATH_INFO"]
+        paths.append(path)
+        return apps[path.rsplit("/", 1)[-1].rsplit(".", 1)[0]](environ, start_response)
+
+    return application, paths
+
+
+def test_open_mfdataset():
+    application, paths = _granules()
+    with LocalServer(application) as server:
+        urls = [server.url + f"/g{i}.nc" for i in range(3)]
+        dataset = open_mfdataset(urls, concat_dim="time")
+        assert dataset.dimensions == {"time": 12, "x": 5}
+        assert dataset["v"].shape == (12, 5)
+        assert dataset["time"].shape == (12,)
+        # variables without `concat_dim` are those of the first granule
+        assert dataset["mask"].shape == (5,)
+        assert len(paths) == 3
+
+        # one granule
+        del paths[:]
+        v = dataset["v"][5:7, 1:3]
+        np.testing.assert_array_equal(v.data, [[51, 52], [61, 62]])
+        assert paths == ["/g1.nc.dap"]
+
+        # the last two granules, with a step
+        del paths[:]
+        v = dataset["v"][6::3, 4]
+        np.testing.assert_array_equal(v.data, [[64], [94]])
+        assert sorted(paths) == ["/g1.nc.dap", "/g2.nc.dap"]
+
+        np.testing.assert_array_equal(np.asarray(dataset["time"][:]), range(12))
+        np.testing.assert_array_equal(dataset["mask"][:].data, range(5))
+        np.testing.assert_array_equal(dataset["v"][3:2].data.shape, (0, 5))
+
+
+def test_open_mfdataset_mismatch():
+    application, paths = _granules()
+    with LocalServer(application) as server:
+        urls = [server.url + f"/g{i}.nc" for i in range(3)]
+        with pytest.raises(ValueError):
+            open_mfdataset(urls, concat_dim="y")
+        with pytest.raises(TypeError):
+            open_mfdataset(urls[0], concat_dim="time")
+
+
+def test_cube_manifest(tmp_path):
+    application, paths = _granules()
+    with LocalServer(application) as server:
+        urls = [server.url + f"/g{i}.nc" for i in range(3)]
+        manifest = CubeManifest.from_urls(urls, "time")
+        # a DMR, the shared dimensions and the time steps of each granule
+        assert len(paths) == 5
+        np.testing.assert_array_equal(manifest.dimensions["x"], range(5))
+        path = manifest.write(tmp_path / "cube.json")
+
+        del paths[:]
+        dataset = open_mfdataset(manifest=path)
+        assert paths == []
+        assert dataset.dimensions == {"time": 12, "x": 5}
+        np.testing.assert_array_equal(dataset["time"][:].data, range(12))
+        np.testing.assert_array_equal(dataset["x"][:].data, range(5))
+        assert paths == []
+
+        v = dataset["v"][3:5, 0]
+        np.testing.assert_array_equal(v.data, [[30], [40]])
+        assert sorted(paths) == ["/g0.nc.dap", "/g1.nc.dap"]
+
+
+@pytest.mark.parametrize("batch", [True, False])
+def test_cube_manifest_consolidated_urls(tmp_path, batch):
+    application, paths = _granules()
+    with LocalServer(application) as server:
+        urls = [server.url + f"/g{i}.nc" for i in range(3)]
+        session = CachedSession(str(tmp_path / "cache"), backend="sqlite")
+        CubeManifest.from_urls(urls, "time", session, batch=batch)
+        # the shared dimensions, as requested by `consolidate_metadata`
+        url = server.url + "/g0.nc.dap?dap4.ce="
+        if batch:
+            url += "x%5B0%3A1%3A4%5D&dap4.checksum=true"
+        else:
+            url += "/x[0:1:4]&dap4.checksum=true"
+        assert session.cache.contains(url=url)
+
+
+def test_consolidate_metadata_append(tmp_path):
+    application, paths = _granules(nx=[5, 5, 5, 5, 6])
+    with LocalServer(application) as server:
+        urls = [server.url + f"/cube/g{i}.nc" for i in range(5)]
+        path = CubeManifest.from_urls(urls[:2], "time").write(tmp_path / "cube.json")
+        session = CachedSession(str(tmp_path / "cache"), backend="sqlite")
+
+        # only the new granules are requested, and the shared dimensions once
+        del paths[:]
+        consolidate_metadata(urls[:4], session, manifest=path, append=True)
+        assert sorted(paths) == [
+            "/cube/g0.nc.dap",
+            "/cube/g2.nc.dap",
+            "/cube/g2.nc.dmr",
+            "/cube/g3.nc.dap",
+            "/cube/g3.nc.dmr",
+        ]
+        # which a new granule shares
+        url = urls[3] + ".dap?dap4.ce=/x[0:1:4]&dap4.checksum=true"
+        assert session.cache.contains(request=Request("GET", url).prepare())
+        manifest = CubeManifest.read(path)
+        assert manifest.urls == urls[:4]
+        dataset = open_mfdataset(manifest=manifest)
+        np.testing.assert_array_equal(dataset["time"][:].data, range(16))
+        v = dataset["v"][13:15, 2]
+        np.testing.assert_array_equal(v.data, [[132], [142]])
+
+        # nothing new
+        del paths[:]
+        consolidate_metadata(urls[:4], session, manifest=path, append=True)
+        assert paths == []
+
+        # the dimensions of the last granule differ
+        with pytest.warns(UserWarning, match="dimensions"):
+            consolidate_metadata(urls[4:], session, manifest=path, append=True)
+        assert CubeManifest.read(path).urls == urls[:4]
+
+
+# `v(t, y, x)`, compressed in chunks of 10 steps
+CHUNKED = {
+    "nt": 100,
+    "nx": 40,
+    "variables": {
+        "y": (("y",), np.arange(50.0)),
+        "v": (("t", "y", "x"), np.arange(200000, dtype="f4").reshape(100, 50, 40) % 7),
+    },
+    "attributes": {
+        "v": {"_ChunkSizes": [10, 50, 40], "_DeflateLevel": 4, "_Shuffle": "true"}
+    },
+}
+
+
+def test_netcdf_encoding_from_dmr(tmp_path, monkeypatch, dap4_app):
+    netCDF4 = pytest.importorskip("netCDF4")
+    # buffer at most 2 chunks of `v`
+    monkeypatch.setattr("dapclient.handlers.dap.SLAB_SIZE", 2 * 10 * 50 * 40 * 4 + 1)
+    writes = []
+    write = UNPACKDAP4DATA.write
+
+    def spy(self, variable, index, data):
+        writes.append((variable.name, index[0]))
+        write(self, variable, index, data)
+
+    monkeypatch.setattr(UNPACKDAP4DATA, "write", spy)
+    app = dap4_app(**CHUNKED)
+    with LocalServer(app) as server:
+        dapclient.client.stream(server.url + "/data.nc", output_path=tmp_path)
+    with netCDF4.Dataset(tmp_path / "data.nc4") as nc:
+        assert nc["v"].chunking() == [10, 50, 40]
+        filters = nc["v"].filters()
+        assert filters["zlib"] and filters["shuffle"] and filters["complevel"] == 4
+        assert "_ChunkSizes" not in nc["v"].ncattrs()
+        np.testing.assert_array_equal(nc["v"][:], app.variables["v"][1])
+    slabs = [index for name, index in writes if name == "v"]
+    assert slabs == [slice(i, i + 20) for i in range(0, 100, 20)]
+
+
+def test_netcdf_encoding_override(tmp_path, dap4_app):
+    netCDF4 = pytest.importorskip("netCDF4")
+    app = dap4_app(**CHUNKED)
+    with LocalServer(app) as server:
+        dapclient.client.stream(
+            server.url + "/data.nc?dap4.ce=/v[0:1:4][0:1:49][0:1:39]",
+            output_path=tmp_path,
+            encoding={"v": {"complevel": 1, "shuffle": False}},
+        )
+    with netCDF4.Dataset(tmp_path / "data.nc4") as nc:
+        # chunks are clipped to the subset
+        assert nc["v"].chunking() == [5, 50, 40]
+        filters = nc["v"].filters()
+        assert filters["complevel"] == 1 and not filters["shuffle"]
+        np.testing.assert_array_equal(nc["v"][:], app.variables["v"][1][:5])
+
+
+def test_to_netcdf_manifest_resume(tmp_path, dap4_app):
+    pytest.importorskip("netCDF4")
+    servers = [LocalServer(dap4_app(nt=5, name=f"granule{i}.nc")) for i in range(3)]
+    for server in servers:
+        server.start()
+    try:
+        urls = [s.url + f"/granule{i}.nc" for i, s in enumerate(servers)]
+        dapclient.client.to_netcdf(urls, output_path=tmp_path)
+        manifest = dapclient.client.DownloadManifest(tmp_path)
+        entries = manifest.entries()
+        assert len(entries) == 3
+        for i, url in enumerate(urls):
+            entry = entries[url, ""]
+            assert entry["status"] == "complete"
+            assert entry["path"] == f"granule{i}.nc4"
+            assert entry["bytes"] == (tmp_path / entry["path"]).stat().st_size
+            assert entry["checksum"].startswith("sha256:")
+
+        # a file cut short is downloaded again, the others are skipped
+        with open(tmp_path / "granule1.nc4", "r+b") as f:
+            f.truncate(100)
+        before = [s.server.requests for s in servers]
+        with pytest.warns(UserWarning, match="granule1.nc4"):
+            dapclient.client.to_netcdf(urls, output_path=tmp_path, resume=True)
+        assert [s.server.requests - n for s, n in zip(servers, before)] == [0, 2, 0]
+        assert manifest.is_complete(manifest.entries()[urls[1], ""])
+
+        before = [s.server.requests for s in servers]
+        assert dapclient.client.to_netcdf(urls, output_path=tmp_path, resume=True) == []
+        assert [s.server.requests for s in servers] == before
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def test_download_manifest_is_complete(tmp_path):
+    manifest = DownloadManifest(tmp_path)
+    path = tmp_path / "granule.nc4"
+    path.write_bytes(b"granule")
+    entry = manifest.record("https://host/granule.nc", "", "complete", path=path)
+    assert manifest.is_complete(entry)
+    assert manifest.is_complete(entry, verify=True)
+
+    # only the checksum tells a file rewritten in place, with the same time
+    stat = path.stat()
+    path.write_bytes(b"GRANULE")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert manifest.is_complete(entry)
+    assert not manifest.is_complete(entry, verify=True)
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not manifest.is_complete(entry)
+    path.unlink()
+    assert not manifest.is_complete(entry)
+
+
+def test_stream_manifest_failure(tmp_path, dap4_app):
+    manifest = dapclient.client.DownloadManifest(tmp_path)
+    app = dap4_app(nt=5, name="granule0.nc")
+    with LocalServer(app) as server:
+        url = server.url + "/granule0.nc"
+        dapclient.client.stream(
+            url, output_path=tmp_path, keep_variables=["t"], manifest=manifest
+        )
+        app.corrupt = CHECKSUM_RETRIES + 1
+        with pytest.raises(ChecksumError):
+            dapclient.client.stream(
+                url, output_path=tmp_path, verify_checksums=True, manifest=manifest
+            )
+    entries = manifest.entries()
+    assert entries[url, "t"]["status"] == "complete"
+    failed = entries[url, ""]
+    assert failed["status"] == "failed"
+    assert failed["error"].startswith("ChecksumError")
@@ -7,6 +7,7 @@ import numpy as np
 
 from dapclient.exceptions import ConstraintExpressionError
 from dapclient.lib import (
+    BufferReader,
     _quote,
     combine_slices,
     encode,
@@ -265,3 +266,28 @@ class TestGetVar(unittest.TestCase):
         dataset["b"]["c"] = BaseType("c")
 
         self.assertEqual(get_var(dataset, "b.c"), dataset["b"]["c"])
+
+
+class TestBufferReader(unittest.TestCase):
+    """Test the ``BufferReader`` class."""
+
+    def test_read(self):
+        """Test that reads return views and advance the offset."""
+        data = b"0123456789"
+        reader = BufferReader(data)
+        out = reader.read(4)
+        self.assertIsInstance(out, memoryview)
+        self.assertEqual(out, b"0123")
+        self.assertEqual(reader.peek(2), b"45")
+        self.assertEqual(reader.tell(), 4)
+        self.assertEqual(bytes(reader.read(3)), b"456")
+        self.assertEqual(bytes(reader.read(10)), b"789")
+        self.assertEqual(bytes(reader.read(1)), b"")
+        self.assertEqual(reader.tell(), 10)
+
+    def test_read_rest(self):
+        """Test that a negative size reads everything left."""
+        reader = BufferReader(bytearray(b"abcdef"))
+        reader.read(2)
+        self.assertEqual(bytes(reader.read()), b"cdef")
+
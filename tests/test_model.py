@@ -6,6 +6,8 @@ import warnings
 import numpy as np
 import pytest
 
+import dapclient.client
+from dapclient.handlers.dap import BaseProxyDap2
 from dapclient.model import (
     BaseType,
     DapType,
@@ -15,6 +17,8 @@ from dapclient.model import (
     StructureType,
 )
 
+from .local_server import LocalServer
+
 warnings.simplefilter("always")
 
 
@@ -553,3 +557,238 @@ def test_GridType_maps(gridtype_example):
 def test_GridType_dimensions(gridtype_example):
     """Test ``dimensions`` property."""
     assert gridtype_example.dimensions == ("x", "y")
+
+
+def test_batch_decode_workers(dap4_app):
+    app = dap4_app(nx=2000, little_endian=False, chunk_size=4096)
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data.nc", protocol="dap4", batch=True
+        )
+        dataset.enable_batch_mode(decode_workers=2, native_byteorder=True)
+        v = dataset["v"][2:4].data
+        x = dataset["x"][:].data
+        v, x = np.asarray(v), np.asarray(x)
+        assert server.requests == 2  # dmr, and a single dap for both
+    assert v.dtype.isnative and x.dtype.isnative
+    np.testing.assert_array_equal(v, app.variables["v"][1][2:4])
+    np.testing.assert_array_equal(x, app.variables["x"][1])
+
+
+def test_prefetch_time_steps(dap4_app):
+    app = dap4_app()
+    values = app.variables["v"][1]
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data.nc", protocol="dap4")
+        prefetcher = dataset["v"].prefetch(depth=4)
+        requests = server.requests
+        for t in range(10):
+            np.testing.assert_array_equal(
+                np.asarray(dataset["v"][t, :]).reshape(20), values[t]
+            )
+        # 3 steps before the stride shows up, then [3:7] and [7:10]
+        assert server.requests == requests + 5
+        assert (prefetcher.hits, prefetcher.misses) == (7, 3)
+        assert prefetcher.hit_rate == 0.7
+
+        # reversed and strided, without merging
+        prefetcher = dataset["v"].prefetch(merge=False)
+        requests = server.requests
+        for x in range(19, 0, -3):
+            np.testing.assert_array_equal(
+                np.asarray(dataset["v"][2:5, x]).reshape(3), values[2:5, x]
+            )
+        assert (prefetcher.hits, prefetcher.misses) == (4, 3)
+        assert server.requests == requests + 7
+
+        # no stride, no reading ahead
+        prefetcher = dataset["v"].prefetch()
+        requests = server.requests
+        for x in [0, 5, 2, 8]:
+            dataset["v"][2:5, x]
+        assert server.requests == requests + 4
+        assert prefetcher.hit_rate == 0
+
+        assert dataset["v"].prefetch(depth=0) is None
+        assert dataset["v"].data.prefetcher is None
+
+
+def test_prefetch_local():
+    with pytest.raises(TypeError):
+        BaseType("a", np.arange(4)).prefetch()
+
+
+def test_batch_block(dap4_app):
+    app = dap4_app()
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data.nc", protocol="dap4")
+        with dataset.batch():
+            # slices of shared dimensions must agree within a response
+            v = dataset["v"][2:4, 5]
+            t = dataset["t"][2:4]
+            with pytest.raises(RuntimeError):
+                np.asarray(v.data)
+            assert server.requests == 1
+        assert server.requests == 2  # dmr, and a single dap for both
+        assert not dataset.is_batch_mode()
+        np.testing.assert_array_equal(v.data, app.variables["v"][1][2:4, 5:6])
+        np.testing.assert_array_equal(t.data, [2, 3])
+
+        # a second block is a new batch
+        with dataset.batch(native_byteorder=True):
+            x = dataset["x"][3:6]
+        assert server.requests == 3
+        np.testing.assert_array_equal(x.data, [3.0, 4.0, 5.0])
+
+        # nothing is sent when the block fails
+        with pytest.raises(ValueError):
+            with dataset.batch():
+                dataset["x"][:]
+                raise ValueError
+        with dataset.batch():
+            pass
+        assert server.requests == 3
+
+
+def test_batch_block_timer_mode(dap4_app):
+    app = dap4_app()
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data.nc", protocol="dap4", batch=True
+        )
+        with dataset.batch():
+            t = dataset["t"][:5]
+            x = dataset["x"][:5]
+        assert dataset.is_batch_mode()
+        assert server.requests == 2
+        np.testing.assert_array_equal(t.data, range(5))
+        np.testing.assert_array_equal(x.data, range(5))
+
+        # the timer still batches outside of blocks
+        v = dataset["v"][:, 3].data
+        t = dataset["t"][:].data
+        np.testing.assert_array_equal(np.asarray(t), range(10))
+        np.testing.assert_array_equal(
+            np.asarray(v), app.variables["v"][1][:, 3:4]
+        )
+        assert server.requests == 3
+
+
+def test_batch_split(dap4_app):
+    variables = {f"v{i:02d}": (("t",), np.arange(10.0) + i) for i in range(30)}
+    app = dap4_app(variables=variables)
+    with LocalServer(app) as server:
+        url = server.url + "/data.nc"
+        dataset = dapclient.client.open_url(url, protocol="dap4")
+        dataset.enable_batch_mode(max_url_length=200)
+        with dataset.batch():
+            sliced = [dataset[f"v{i:02d}"][2:5] for i in range(30)]
+        # ~20 characters per variable
+        assert 1 + 4 <= server.requests <= 1 + 6
+        for i, var in enumerate(sliced):
+            np.testing.assert_array_equal(var.data, np.arange(2.0, 5.0) + i)
+
+        # each request as long as the limit allows
+        dataset.enable_batch_mode(max_url_length=200)
+        variables = [dataset[f"v{i:02d}"][2:5] for i in range(30)]
+        groups = dataset.plan_batch(variables)
+        assert sum(groups, []) == variables
+        for group in groups:
+            assert len(dataset._batch_url(group)) <= 200
+        for group, following in zip(groups, groups[1:]):
+            assert len(dataset._batch_url(group + following[:1])) > 200
+        dataset.disable_batch_mode()
+
+        # 3 variables of 3 float64 per response
+        requests = server.requests
+        dataset.enable_batch_mode(max_response_size=72)
+        with dataset.batch():
+            sliced = [dataset[f"v{i:02d}"][2:5] for i in range(30)]
+        assert server.requests == requests + 10
+
+        # the futures of the timer mode
+        dataset.enable_batch_mode(timeout=0.5, max_response_size=5 * 80)
+        futures = [dataset[f"v{i:02d}"][:].data for i in range(30)]
+        values = [np.asarray(future) for future in futures]
+        assert server.requests == requests + 16
+        for i, value in enumerate(values):
+            np.testing.assert_array_equal(value, np.arange(10.0) + i)
+
+
+def test_dap2_batch(dap2_app):
+    app = dap2_app()
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        with dataset.batch():
+            sst = dataset["sst"][1:3, 0]
+            y = dataset["y"][:]
+            names = dataset["names"][1:]
+        assert server.requests == 3  # dds, das, and a single dods
+        np.testing.assert_array_equal(sst.data, [[3.0], [6.0]])
+        np.testing.assert_array_equal(y.data, [0, 1, 2])
+        np.testing.assert_array_equal(names.data, [b"bcd", b"efghi"])
+        # the variables of the dataset are untouched
+        np.testing.assert_array_equal(dataset["sst"].data.slice, (slice(None),) * 2)
+
+        dataset = dapclient.client.open_url(
+            server.url + "/data", protocol="dap2", batch=True
+        )
+        requests = server.requests
+        x = dataset["x"][::2].data
+        mask = dataset["mask"][:].data
+        np.testing.assert_array_equal(np.asarray(x), [0.0, 2.0, 4.0])
+        np.testing.assert_array_equal(np.asarray(mask), [1, 0, 1, 1, 0])
+        assert server.requests == requests + 1
+
+
+def test_dap2_batch_grids(dap2_app):
+    app = dap2_app(grids=True)
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        with dataset.batch():
+            sst = dataset["sst"]["sst"][1:3, 0]
+            x = dataset["x"][1:3]
+        assert server.requests == 3
+        np.testing.assert_array_equal(sst.data, [[3.0], [6.0]])
+        np.testing.assert_array_equal(x.data, [1.0, 2.0])
+
+
+def test_dap2_grid_single_request(monkeypatch, dap2_app):
+    grids = []
+    grid = BaseProxyDap2.grid
+
+    def spy(self, name, index):
+        grids.append(name)
+        return grid(self, name, index)
+
+    monkeypatch.setattr(BaseProxyDap2, "grid", spy)
+    app = dap2_app(grids=True)
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data", protocol="dap2", output_grid=True
+        )
+        requests = server.requests
+        sst = dataset["sst"][1:3, 0]
+        assert server.requests == requests + 1
+        np.testing.assert_array_equal(sst.array.data, [[3.0], [6.0]])
+        np.testing.assert_array_equal(sst["x"].data, [1.0, 2.0])
+        np.testing.assert_array_equal(sst["y"].data, [0])
+        sst["x"].data[:] = -1
+
+        # the map `x` is shared with `sst`: only the array is requested
+        mask = dataset["mask"][1:3]
+        assert server.requests == requests + 2
+        assert grids == ["sst"]
+        np.testing.assert_array_equal(mask.array.data, [0, 1])
+        np.testing.assert_array_equal(mask["x"].data, [1.0, 2.0])
+
+        # a slice of a map already held
+        mask = dataset["mask"][2:3]
+        assert server.requests == requests + 3
+        assert grids == ["sst"]
+        np.testing.assert_array_equal(mask["x"].data, [2.0])
+
+        names = dataset["names"][::2]
+        assert grids == ["sst", "names"]
+        np.testing.assert_array_equal(names.array.data, [b"a", b"efghi"])
+        np.testing.assert_array_equal(names["y"].data, [0, 2])
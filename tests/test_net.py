@@ -2,11 +2,33 @@
 Test the follow redirects and handling of more complex routing situations
 """
 
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
 import requests
 import requests_mock
 from webob.request import Request
 
-from dapclient.net import create_request
+import dapclient.client
+from dapclient.client import open_url
+from dapclient.net import (
+    DEFAULT_POOL_MAXSIZE,
+    GET,
+    CapabilityRegistry,
+    clear_session_pool,
+    create_request,
+    extract_session_state,
+    get_capability_registry,
+    get_pooled_session,
+    get_session,
+    hyrax_dmr_version,
+    server_capabilities,
+)
+
+from .local_server import Dap4App, LocalServer
 
 
 def test_redirect():
@@ -52,3 +74,155 @@ def test_redirect():
         assert len(m.request_history) == 2
         assert isinstance(req, Request)
         assert req.headers["Host"] == "www.test2.com:80"
+
+
+def test_pooled_session_is_reused():
+    """Requests with the same base session share a pooled session per thread."""
+    session = requests.Session()
+    pooled = get_pooled_session(session)
+    assert get_pooled_session(session) is pooled
+    assert get_pooled_session(requests.Session()) is not pooled
+    # nor those built with other settings
+    expiring = get_pooled_session(session, cache_kwargs={"expire_after": 60})
+    assert expiring is not pooled
+    assert get_pooled_session(session, cache_kwargs={"expire_after": 60}) is expiring
+    adapter = pooled.get_adapter("https://")
+    assert adapter._pool_maxsize == DEFAULT_POOL_MAXSIZE
+    with ThreadPoolExecutor(2) as pool:
+        others = list(pool.map(lambda _: get_pooled_session(session), range(2)))
+    assert pooled not in others
+    clear_session_pool()
+
+
+def test_pooled_session_keyed_on_auth():
+    session = requests.Session()
+    pooled = get_pooled_session(session)
+    session.headers["Authorization"] = "Bearer token"
+    other = get_pooled_session(session)
+    assert other is not pooled
+    assert other.headers["Authorization"] == "Bearer token"
+    clear_session_pool()
+
+
+def test_get_reuses_connections(dap4_app):
+    """Many small slices travel over a single keep-alive connection."""
+    clear_session_pool()
+    with LocalServer(dap4_app()) as server:
+        ds = open_url(server.url + "/data.nc", protocol="dap4")
+        for i in range(50):
+            data = np.asarray(ds["v"][i % 10, 0:5].data)
+            np.testing.assert_array_equal(data, [np.arange(5) + 20 * (i % 10)])
+        assert server.requests == 51
+        assert server.connections == 1
+    clear_session_pool()
+
+
+def test_get_session_from_state(dap4_app):
+    """Sessions restored from the same state are reused within a thread."""
+    clear_session_pool()
+    state = extract_session_state(requests.Session())
+    with LocalServer(dap4_app()) as server:
+        for _ in range(5):
+            session = get_session(state)
+            GET(server.url + "/data.nc.dmr", session=session).close()
+        assert get_session(state) is session
+        assert server.connections == 1
+    # other threads have their own session
+    with ThreadPoolExecutor(2) as pool:
+        others = list(pool.map(lambda _: get_session(state), range(2)))
+    assert session not in others
+    clear_session_pool()
+
+
+def test_capability_registry(tmp_path, monkeypatch):
+    path = tmp_path / "capabilities.json"
+    registry = CapabilityRegistry(path, ttl=60)
+    assert registry.get("https://example.com/data.nc") is None
+    registry.update("dap4://example.com/a.nc", server="Hyrax", dap4=True)
+    registry.update("https://example.com/b.nc", version="1.17.1-550")
+    capabilities = registry.get("https://EXAMPLE.com/c.nc")
+    assert capabilities["server"] == "Hyrax"
+    assert capabilities["version"] == "1.17.1-550"
+    assert capabilities["dmr_version"] is None
+    with pytest.raises(TypeError):
+        registry.update("https://example.com/", gzip=True)
+    # shared through the file
+    assert CapabilityRegistry(path).get("https://example.com/")["dap4"]
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert registry.get("https://example.com/c.nc") is None
+    assert CapabilityRegistry(path, ttl=120).get("https://example.com/")["dap4"]
+
+
+def test_hyrax_dmr_version():
+    assert hyrax_dmr_version("1.17.1-550") == "2.0"
+    assert hyrax_dmr_version("1.17.1-400") is None
+    assert hyrax_dmr_version("1.16.8-123") is None
+    assert hyrax_dmr_version(None) is None
+
+
+def test_server_capabilities_probed_once(capability_registry):
+    with LocalServer(Dap4App({}, hyrax="1.17.1-550")) as server:
+        for _ in range(3):
+            capabilities = server_capabilities(server.url + "/data.nc")
+            assert capabilities["server"] == "Hyrax"
+            assert capabilities["dmr_version"] == "2.0"
+            assert capabilities["dap4"]
+        # another process reads the same file
+        registry = CapabilityRegistry(capability_registry.path)
+        server_capabilities(server.url + "/other.nc", registry=registry)
+        assert server.requests == 1
+
+    with LocalServer(Dap4App({})) as server:
+        capabilities = server_capabilities(server.url + "/data.nc")
+        assert capabilities["server"] is None and not capabilities["dap4"]
+        server_capabilities(server.url + "/data.nc")
+        assert server.requests == 1
+
+
+def test_server_capabilities_unreachable(capability_registry):
+    with LocalServer(Dap4App({})) as server:
+        url = server.url + "/data.nc"
+    assert server_capabilities(url)["server"] is None
+    # nothing is recorded about a server that did not answer
+    assert capability_registry.get(url) is None
+
+
+def test_to_netcdf_probes_once(tmp_path, dap4_app):
+    pytest.importorskip("netCDF4")
+    with LocalServer(dap4_app(hyrax="1.17.1-550")) as server:
+        dapclient.client.to_netcdf(server.url + "/data.nc", output_path=tmp_path)
+        # `.ver`, then `.dap`
+        assert server.requests == 2
+        dapclient.client.to_netcdf(server.url + "/data.nc", output_path=tmp_path)
+        assert server.requests == 3
+
+
+def test_determine_protocol_from_capabilities(dap4_app):
+    app = dap4_app(hyrax="1.17.1-550")
+    paths = []
+
+    def application(environ, start_response):
+        paths.append(environ["PATH_INFO"])
+        return app(environ, start_response)
+
+    with LocalServer(application) as server:
+        # an unknown server is not probed, and stays DAP2
+        for _ in range(2):
+            with pytest.warns(UserWarning, match="DAP2"):
+                with pytest.raises(Exception):
+                    open_url(server.url + "/data.nc")
+        assert not [path for path in paths if path.endswith(".ver")]
+        assert get_capability_registry().get(server.url) is None
+
+        # known once probed, e.g. by `to_netcdf`
+        server_capabilities(server.url + "/data.nc")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            dataset = open_url(server.url + "/data.nc")
+        assert dataset["v"].shape == (10, 20)
+        # DAP2 constraint expressions keep the DAP2 protocol
+        with pytest.warns(UserWarning, match="DAP2"):
+            with pytest.raises(Exception):
+                open_url(server.url + "/data.nc?v[0:1:2][0]")
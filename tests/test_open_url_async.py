@@ -0,0 +1,117 @@
+"""Tests for the asyncio data path."""
+
+import asyncio
+
+import numpy as np
+import pytest
+import requests
+
+from dapclient.client import open_url_async
+from dapclient.net import (
+    CapabilityRegistry,
+    close_async_clients,
+    get_capability_registry,
+)
+
+from .local_server import Dap2App, Dap4App, LocalServer
+
+httpx = pytest.importorskip("httpx")
+
+
+SST = np.arange(200, dtype="f4").reshape(10, 20)
+
+
+@pytest.fixture
+def server():
+    app = Dap4App(
+        {
+            "time": (("time",), np.arange(10, dtype="i4")),
+            "lon": (("lon",), np.arange(20.0)),
+            "sst": (("time", "lon"), SST),
+        }
+    )
+    with LocalServer(app) as server:
+        yield server
+
+
+def test_open_url_async(server):
+    async def main():
+        dataset = await open_url_async(server.url + "/data.nc", protocol="dap4")
+        await close_async_clients()
+        return dataset
+
+    dataset = asyncio.run(main())
+    assert list(dataset.keys()) == ["time", "lon", "sst"]
+    assert dataset["sst"].shape == (10, 20)
+    assert dataset["sst"].dims == ["/time", "/lon"]
+
+
+def test_aget_concurrent(server):
+    async def main():
+        dataset = await open_url_async(
+            server.url + "/data.nc", protocol="dap4", max_concurrency=8
+        )
+        results = await asyncio.gather(
+            *[dataset["sst"].aget[i : i + 1, 2:6] for i in range(10)]
+        )
+        await close_async_clients()
+        return results
+
+    results = asyncio.run(main())
+    for i, var in enumerate(results):
+        np.testing.assert_array_equal(np.asarray(var.data), SST[i : i + 1, 2:6])
+    assert server.requests == 11
+    # bounded by the semaphore, and reused across requests
+    assert server.connections <= 8
+
+
+def test_blocking_getitem_still_works(server):
+    async def main():
+        dataset = await open_url_async(server.url + "/data.nc", protocol="dap4")
+        await close_async_clients()
+        return dataset
+
+    dataset = asyncio.run(main())
+    np.testing.assert_array_equal(np.asarray(dataset["lon"][0:3]), [0.0, 1.0, 2.0])
+
+
+def test_open_url_async_application():
+    """A local application is called from worker threads."""
+    app = Dap2App({"x": (("x",), np.arange(5.0))}, attributes={"x": {"units": "m"}})
+
+    async def main():
+        return await open_url_async("http://localhost/data", application=app)
+
+    dataset = asyncio.run(main())
+    assert dataset["x"].attributes["units"] == "m"
+    np.testing.assert_array_equal(np.asarray(dataset["x"][1:3]), [1.0, 2.0])
+
+
+def test_open_url_async_http(server, monkeypatch):
+    """The protocol of an `http` url is found off the event loop."""
+
+    def off_the_loop(func):
+        def wrapper(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return func(*args, **kwargs)
+            raise AssertionError(f"{func.__qualname__} blocks the event loop")
+
+        return wrapper
+
+    get_capability_registry().update(server.url, dap4=True)
+    monkeypatch.setattr(CapabilityRegistry, "get", off_the_loop(CapabilityRegistry.get))
+    monkeypatch.setattr(
+        requests.adapters.HTTPAdapter,
+        "send",
+        off_the_loop(requests.adapters.HTTPAdapter.send),
+    )
+
+    async def main():
+        dataset = await open_url_async(server.url + "/data.nc")
+        await close_async_clients()
+        return dataset
+
+    dataset = asyncio.run(main())
+    assert dataset["sst"].dims == ["/time", "/lon"]
@@ -1,8 +1,33 @@
+import gc
+import gzip
 import os
 
 import numpy
+import pytest
+import webob.response
 
 import dapclient.client
+from dapclient.exceptions import ChecksumError, ServerError
+from dapclient.handlers.dap import (
+    CHECKSUM_RETRIES,
+    UNPACKDAP4DATA,
+    BaseProxyDap2,
+    DAP2StreamDecoder,
+    DAP4StreamDecoder,
+    SegmentedMemmap,
+    decode_string_array,
+    decode_variable,
+    unpack_dap2_data,
+    unpack_sequence,
+    unpack_sequence_batches,
+)
+from dapclient.lib import BufferReader, StreamReader, walk
+from dapclient.model import BaseType
+from dapclient.net import GET
+from dapclient.parsers.dds import dds_to_dataset
+from dapclient.parsers.dmr import dmr_to_dataset
+
+from .local_server import Dap2App, Dap4App, LocalServer, scale_dods
 
 
 def load_dap(file_path):
@@ -46,3 +71,520 @@ def test_my1qnd1():
 
     # test_my1qnd1()
     # test_coads()
+
+
+def _decode(body, piece):
+    out = {}
+
+    def on_dmr(dmr, endianness):
+        dataset = dmr_to_dataset(dmr.decode("latin-1"))
+        return list(walk(dataset, BaseType))
+
+    def on_variable(variable, data, checksum):
+        out[variable.id] = (numpy.asarray(data), bytes(checksum))
+
+    decoder = DAP4StreamDecoder(on_dmr, on_variable)
+    for i in range(0, len(body), piece):
+        decoder.feed(body[i : i + piece])
+    decoder.close()
+    return out
+
+
+def test_stream_decoder_piece_sizes():
+    """The decoded variables do not depend on how the response is split."""
+    abs_path = os.path.join(os.path.dirname(__file__), "data/daps")
+    for fname in os.listdir(abs_path):
+        with open(os.path.join(abs_path, fname), "rb") as f:
+            body = f.read()
+        expected = _decode(body, len(body))
+        for piece in (1, 3, 4096):
+            result = _decode(body, piece)
+            assert list(result) == list(expected)
+            for key, (data, checksum) in expected.items():
+                numpy.testing.assert_array_equal(result[key][0], data)
+                assert result[key][1] == checksum
+
+
+def test_stream_decoder_truncated():
+    with open(
+        os.path.join(os.path.dirname(__file__), "data/daps/coads_climatology.nc.dap"),
+        "rb",
+    ) as f:
+        body = f.read()
+    with pytest.raises(ServerError):
+        _decode(body[:-10], 1024)
+
+
+def test_stream_decoder_error_chunk():
+    message = b"<Error>oops</Error>"
+    # little endian, error and last chunk flags set
+    body = ((0x07 << 24) | len(message)).to_bytes(4, "big") + message
+    decoder = DAP4StreamDecoder(None, None)
+    with pytest.raises(ServerError, match="oops"):
+        decoder.feed(body)
+
+
+def test_unpack_streamed_response_to_netcdf(tmp_path):
+    netCDF4 = pytest.importorskip("netCDF4")
+    values = numpy.arange(1000, dtype="f4").reshape(10, 100)
+    app = Dap4App(
+        {
+            "x": (("x",), numpy.arange(100.0)),
+            "t": (("t",), numpy.arange(10, dtype="i4")),
+            "v": (("t", "x"), values),
+        },
+        chunk_size=333,
+    )
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        UNPACKDAP4DATA(r, output_path=tmp_path)
+    with netCDF4.Dataset(tmp_path / "data.nc4") as nc:
+        numpy.testing.assert_array_equal(nc["v"][:], values)
+
+
+def test_open_dap_file_memmap():
+    abs_path = os.path.join(os.path.dirname(__file__), "data/daps")
+    for fname in os.listdir(abs_path):
+        path = os.path.join(abs_path, fname)
+        expected = dapclient.client.open_dap_file(path)
+        result = dapclient.client.open_dap_file(path, memmap=True)
+        for a, b in zip(walk(expected, BaseType), walk(result, BaseType)):
+            assert a.id == b.id
+            numpy.testing.assert_array_equal(
+                numpy.asarray(b.data), numpy.asarray(a.data)
+            )
+            assert b.attributes["_DAP4_Checksum_CRC32"] == (
+                a.attributes["_DAP4_Checksum_CRC32"]
+            )
+
+
+def test_segmented_memmap_indexing(tmp_path):
+    values = numpy.arange(60, dtype="<f4").reshape(5, 4, 3)
+    raw = values.tobytes()
+    # split the payload in uneven segments, separated by 4-byte gaps
+    cuts = [0, 7, 50, 51, 200, len(raw)]
+    body = b""
+    segments = []
+    for lo, hi in zip(cuts[:-1], cuts[1:]):
+        body += b"\x00" * 4
+        segments.append((len(body), hi - lo))
+        body += raw[lo:hi]
+    path = tmp_path / "segments.bin"
+    path.write_bytes(body)
+
+    array = SegmentedMemmap(str(path), values.dtype, values.shape, segments)
+    for index in [
+        Ellipsis,
+        0,
+        -1,
+        (slice(1, 4), 2),
+        (slice(None, None, 2), slice(1, 3), 0),
+        (slice(4, 0, -1),),
+        (Ellipsis, 1),
+    ]:
+        numpy.testing.assert_array_equal(array[index], values[index])
+    numpy.testing.assert_array_equal(numpy.asarray(array), values)
+    with pytest.raises(IndexError):
+        array[5]
+
+
+def test_unpack_memmap_remote():
+    values = numpy.arange(1000, dtype="f4").reshape(10, 100)
+    app = Dap4App(
+        {
+            "x": (("x",), numpy.arange(100.0)),
+            "t": (("t",), numpy.arange(10, dtype="i4")),
+            "v": (("t", "x"), values),
+        },
+        chunk_size=333,
+    )
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        dataset = UNPACKDAP4DATA(r, memmap=True).dataset
+    assert isinstance(dataset["v"].data, numpy.memmap)
+    numpy.testing.assert_array_equal(dataset["v"].data[2:4], values[2:4])
+    numpy.testing.assert_array_equal(dataset["x"].data, numpy.arange(100.0))
+
+
+def test_unpack_memmap_spool_removed(monkeypatch, tmp_path):
+    # as on Windows: the spool is kept until its memmaps are released
+    monkeypatch.setattr(dapclient.handlers.dap, "UNLINK_MAPPED_FILES", False)
+    monkeypatch.setattr(dapclient.handlers.dap.tempfile, "tempdir", str(tmp_path))
+    values = numpy.arange(1000, dtype="f4").reshape(10, 100)
+    app = Dap4App(
+        {
+            "x": (("x",), numpy.arange(100.0)),
+            "t": (("t",), numpy.arange(10, dtype="i4")),
+            "v": (("t", "x"), values),
+        }
+    )
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        dataset = UNPACKDAP4DATA(r, memmap=True).dataset
+    view = dataset["v"].data[2:4]
+    (spool,) = tmp_path.iterdir()
+    del dataset
+    gc.collect()  # the variables refer to their parent dataset
+    assert spool.exists()
+    numpy.testing.assert_array_equal(view, values[2:4])
+    del view
+    assert not spool.exists()
+
+
+def test_verify_checksums_local_files():
+    abs_path = os.path.join(os.path.dirname(__file__), "data/daps")
+    for fname in os.listdir(abs_path):
+        path = os.path.join(abs_path, fname)
+        with open(path, "rb") as f:
+            unpacked = UNPACKDAP4DATA(f, verify_checksums=True)
+        assert unpacked.verified_bytes > 0
+        assert unpacked.checksum_throughput > 0
+        # memory-mapped files are verified too
+        dapclient.client.open_dap_file(path, memmap=True, verify_checksums=True)
+
+
+def test_verify_checksums_mismatch(tmp_path):
+    path = os.path.join(
+        os.path.dirname(__file__), "data/daps/coads_climatology.nc.dap"
+    )
+    with open(path, "rb") as f:
+        body = bytearray(f.read())
+    body[-10] ^= 0xFF  # a byte of the data of the last variable
+    corrupted = tmp_path / "corrupted.dap"
+    corrupted.write_bytes(body)
+    # not verified by default
+    dapclient.client.open_dap_file(corrupted)
+    for memmap in (False, True):
+        with pytest.raises(ChecksumError):
+            dapclient.client.open_dap_file(
+                corrupted, memmap=memmap, verify_checksums=True
+            )
+
+
+def test_verify_checksums_retry():
+    values = numpy.arange(200, dtype="f4").reshape(10, 20)
+    app = Dap4App(
+        {
+            "t": (("t",), numpy.arange(10, dtype="i4")),
+            "x": (("x",), numpy.arange(20.0)),
+            "v": (("t", "x"), values),
+        },
+        corrupt=1,
+    )
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(
+            server.url + "/data.nc", protocol="dap4", verify_checksums=True
+        )
+        numpy.testing.assert_array_equal(numpy.asarray(dataset["v"][2:4]), values[2:4])
+        assert server.requests == 3  # dmr, corrupted dap, dap
+
+        app.corrupt = CHECKSUM_RETRIES + 1
+        with pytest.raises(ChecksumError):
+            dataset["v"][0:1]
+
+
+def test_stream_verify_checksums_retry(tmp_path):
+    netCDF4 = pytest.importorskip("netCDF4")
+    values = numpy.arange(200, dtype="f4").reshape(10, 20)
+    app = Dap4App(
+        {
+            "t": (("t",), numpy.arange(10, dtype="i4")),
+            "x": (("x",), numpy.arange(20.0)),
+            "v": (("t", "x"), values),
+        },
+        corrupt=1,
+    )
+    with LocalServer(app) as server:
+        dapclient.client.stream(
+            server.url + "/data.nc", output_path=tmp_path, verify_checksums=True
+        )
+        assert server.requests == 2
+    with netCDF4.Dataset(tmp_path / "data.nc4") as nc:
+        numpy.testing.assert_array_equal(nc["v"][:], values)
+
+
+STRINGS = numpy.array(["a", "", "bb", "ccc\u00e9", "dddd" * 20, "e"], dtype=object)
+
+
+def _string_body():
+    return b"".join(
+        len(item.encode()).to_bytes(8, "little") + item.encode() for item in STRINGS
+    )
+
+
+def test_decode_string_variable():
+    variable = BaseType("names", dtype=numpy.dtype("S"), shape=(2, 3))
+    body = b"xx" + _string_body() + b"yy"
+    data, stop = decode_variable(body, 2, variable, "<")
+    assert stop == len(body) - 2
+    assert data.shape == (2, 3)
+    expected = [item.encode() for item in STRINGS]
+    assert data.ravel().tolist() == expected
+
+
+def test_decode_string_array_object():
+    encoded = [item.encode() for item in STRINGS]
+    chars = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+    lengths = [len(item) for item in encoded]
+    data = decode_string_array(chars, lengths, (6,), dtype=object)
+    assert data.dtype == object
+    assert data.tolist() == STRINGS.tolist()
+    ascii_only = decode_string_array(chars[:3], lengths[:3], (3,), dtype=object)
+    assert ascii_only.tolist() == ["a", "", "bb"]
+
+
+def test_stream_strings_verify_checksums():
+    app = Dap4App(
+        {
+            "n": (("n",), numpy.arange(6, dtype="i4")),
+            "names": (("n",), STRINGS),
+            "v": (("n",), numpy.arange(6.0)),
+        },
+        chunk_size=7,
+    )
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        dataset = UNPACKDAP4DATA(r, verify_checksums=True).dataset
+    assert dataset["names"].data.tolist() == [item.encode() for item in STRINGS]
+    numpy.testing.assert_array_equal(dataset["v"].data[:], numpy.arange(6.0))
+    body = app.data()
+    for piece in (1, 5, len(body)):
+        result = _decode(body, piece)
+        assert result["names"][0].tolist() == [item.encode() for item in STRINGS]
+
+
+def test_stream_equal_length_strings():
+    times = numpy.array(["2024-01-%02d" % i for i in range(1, 29)], dtype=object)
+    app = Dap4App(
+        {
+            "time": (("time",), times),
+            "v": (("time",), numpy.arange(28, dtype="i2")),
+        },
+        chunk_size=100,
+    )
+    body = app.data()
+    for piece in (1, 13, len(body)):
+        result = _decode(body, piece)
+        assert result["time"][0].tolist() == [item.encode() for item in times]
+        numpy.testing.assert_array_equal(result["v"][0], numpy.arange(28))
+
+
+# big endian, in many chunks
+BIG_ENDIAN = {
+    "nx": 2000,
+    "variables": {
+        "names": (("t",), numpy.array(["t%d" % i for i in range(10)], object)),
+    },
+    "little_endian": False,
+    "chunk_size": 4096,
+}
+
+
+@pytest.mark.parametrize("decode_workers", [None, 4])
+def test_unpack_native_byteorder(decode_workers, dap4_app):
+    app = dap4_app(**BIG_ENDIAN)
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        dataset = UNPACKDAP4DATA(
+            r,
+            verify_checksums=True,
+            native_byteorder=True,
+            decode_workers=decode_workers,
+        ).dataset
+    for name, (dims, values) in app.variables.items():
+        data = numpy.asarray(dataset[name].data[:])
+        if values.dtype.kind == "O":
+            assert data.tolist() == [item.encode() for item in values]
+        else:
+            assert data.dtype.isnative
+            numpy.testing.assert_array_equal(data, values)
+
+
+def test_unpack_decode_workers_checksum_error(dap4_app):
+    app = dap4_app(corrupt=1, **BIG_ENDIAN)
+    with LocalServer(app) as server:
+        r = GET(server.url + "/data.nc.dap", get_kwargs={"stream": True})
+        with pytest.raises(ChecksumError):
+            UNPACKDAP4DATA(r, verify_checksums=True, decode_workers=2)
+
+
+TEST_01 = os.path.join(os.path.dirname(__file__), "data/test.01.dods")
+TEST_01_VALUES = (
+    0,
+    1,
+    0,
+    0,
+    0,
+    0.0,
+    1000.0,
+    "This is a data test string (pass 0).",
+    "http://www.dods.org",
+)
+
+
+def test_unpack_dap2_proxy():
+    with open(TEST_01, "rb") as f:
+        r = webob.response.Response(body=f.read())
+    proxy = BaseProxyDap2("http://localhost:8001/test.01", "s", numpy.dtype("S"), ())
+    assert proxy.unpack(r).data == TEST_01_VALUES[7]
+
+
+def test_unpack_dap2_sequence_records():
+    with open(TEST_01, "rb") as f:
+        dods = scale_dods(f.read(), 500)
+    dds, data = dods.split(b"\nData:\n", 1)
+    dataset = dds_to_dataset(dds.decode("ascii"))
+    (records,) = unpack_dap2_data(BufferReader(data), dataset)
+    assert len(records.stream) == 500
+    assert all(tuple(record) == TEST_01_VALUES for record in records.stream)
+
+
+
+def _decode_dods(dods, size, **kwargs):
+    decoder = DAP2StreamDecoder(lambda dds: dds_to_dataset(dds.decode()), **kwargs)
+    for i in range(0, len(dods), size):
+        decoder.feed(dods[i : i + size])
+    decoder.close()
+    return decoder
+
+
+@pytest.mark.parametrize("size", [1, 7, 2**20])
+def test_dap2_stream_decoder_piece_sizes(size, dap2_app):
+    app = dap2_app()
+    decoder = _decode_dods(app.dods(), size)
+    x, y, sst, mask, names = decoder.data
+    assert sst.dtype == numpy.dtype("=f4")
+    numpy.testing.assert_array_equal(sst, app.variables["sst"][1])
+    # Int16 is sent as 32-bit integers
+    assert y.dtype == numpy.dtype("=i2")
+    numpy.testing.assert_array_equal(y, [0, 1, 2])
+    numpy.testing.assert_array_equal(mask, [1, 0, 1, 1, 0])
+    numpy.testing.assert_array_equal(names, [b"a", b"bcd", b"efghi"])
+
+
+def test_dap2_stream_decoder_grids_and_scalars(dap2_app):
+    decoder = _decode_dods(dap2_app(grids=True).dods("sst[1:1:2][0]"), 3)
+    ((sst, x, y),) = decoder.data
+    numpy.testing.assert_array_equal(sst, [[3.0], [6.0]])
+    numpy.testing.assert_array_equal(x, [1.0, 2.0])
+    numpy.testing.assert_array_equal(y, [0])
+
+    with open(TEST_01, "rb") as f:
+        assert tuple(_decode_dods(f.read(), 5).data) == TEST_01_VALUES
+
+
+def test_dap2_stream_decoder_gzip(dap2_app):
+    app = dap2_app()
+    decoder = _decode_dods(gzip.compress(app.dods()), 100, gzip=True)
+    numpy.testing.assert_array_equal(decoder.data[2], app.variables["sst"][1])
+
+
+def test_dap2_stream_decoder_sequence():
+    with open(TEST_01, "rb") as f:
+        decoder = _decode_dods(scale_dods(f.read(), 20), 64)
+    (records,) = decoder.data
+    assert [tuple(record) for record in records.stream] == [TEST_01_VALUES] * 20
+
+
+def test_dap2_stream_decoder_incomplete(dap2_app):
+    dods = dap2_app().dods()
+    with pytest.raises(ServerError):
+        _decode_dods(dods[:-3], 64)
+    with pytest.raises(ServerError):
+        _decode_dods(b"Error {\n    code = 404;\n};\n", 64)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_open_url_dap2_streamed(compress, dap2_app):
+    app = dap2_app(grids=True, gzip=compress)
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        sst = dataset["sst"]["sst"][1:4, 1:]
+        numpy.testing.assert_array_equal(sst.data, app.variables["sst"][1][1:4, 1:])
+        assert sst.data.dtype.isnative
+        numpy.testing.assert_array_equal(dataset["y"][:].data, [0, 1, 2])
+
+
+def _records(n):
+    records = numpy.zeros(
+        n, dtype=[("id", "i4"), ("depth", "f8"), ("qc", "u1"), ("temp", "i2")]
+    )
+    records["id"] = numpy.arange(n)
+    records["depth"] = numpy.arange(n) / 2
+    records["qc"] = numpy.arange(n) % 256
+    records["temp"] = -(numpy.arange(n) % 300)
+    return records
+
+
+def _sequence(records, ce=None):
+    dods = Dap2App({"argo": ((), records)}).dods(ce)
+    dds, data = dods.split(b"\nData:\n", 1)
+    return dds_to_dataset(dds.decode("ascii"))["argo"], data
+
+
+def _pieces(data, size):
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize("size", [7, 1000, 2**20])
+def test_unpack_sequence_batches(size):
+    records = _records(1000)
+    template, data = _sequence(records)
+    batches = list(unpack_sequence_batches(_pieces(data, size), template, rows=300))
+    assert [len(batch) for batch in batches] == [300, 300, 300, 100]
+    batch = numpy.concatenate(batches)
+    assert batch.dtype == records.dtype
+    numpy.testing.assert_array_equal(batch, records)
+
+    # the record by record path agrees
+    stream = StreamReader(_pieces(data, size))
+    assert [tuple(record) for record in unpack_sequence(stream, template)] == [
+        tuple(record) for record in records
+    ]
+
+
+def test_unpack_sequence_batches_column():
+    records = _records(10)
+    template, data = _sequence(records, "argo.temp")
+    (batch,) = unpack_sequence_batches([data], template["temp"])
+    assert batch.dtype == numpy.dtype("=i2")
+    numpy.testing.assert_array_equal(batch, records["temp"])
+
+
+def test_unpack_sequence_batches_strings():
+    records = numpy.zeros(5, dtype=[("id", "i4"), ("name", "O")])
+    records["id"] = numpy.arange(5)
+    records["name"] = ["a", "bc", "def", "", "ghij"]
+    template, data = _sequence(records)
+    batches = list(unpack_sequence_batches(_pieces(data, 3), template, rows=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    batch = numpy.concatenate(batches)
+    numpy.testing.assert_array_equal(batch["id"], records["id"])
+    assert list(batch["name"]) == list(records["name"])
+
+
+def test_unpack_sequence_batches_invalid():
+    template, data = _sequence(_records(10))
+    with pytest.raises(ServerError):
+        list(unpack_sequence_batches([data[:-4]], template))
+    data = bytearray(data)
+    data[5 * 24] = 0
+    with pytest.raises(ServerError):
+        list(unpack_sequence_batches([bytes(data)], template))
+
+
+def test_sequence_iter_batches():
+    records = _records(1000)
+    app = Dap2App({"argo": ((), records)})
+    with LocalServer(app) as server:
+        dataset = dapclient.client.open_url(server.url + "/data", protocol="dap2")
+        sequence = dataset["argo"]
+        batches = list(sequence["id", "temp"].iter_batches(rows=400))
+        assert [len(batch) for batch in batches] == [400, 400, 200]
+        assert batches[0].dtype.names == ("id", "temp")
+        numpy.testing.assert_array_equal(
+            numpy.concatenate(batches)["temp"], records["temp"]
+        )
+        # selecting columns leaves the sequence untouched
+        (batch,) = sequence[10:20].iter_batches()
+        numpy.testing.assert_array_equal(batch, records[10:20])
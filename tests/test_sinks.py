@@ -0,0 +1,164 @@
+"""Tests for the Zarr and .npy sinks of streamed DAP4 responses."""
+
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pytest
+from webob.response import Response
+
+import dapclient.client
+from dapclient.handlers.dap import UNPACKDAP4DATA
+from dapclient.sinks import NpySink, ZarrSink
+
+from .local_server import Dap4App, LocalServer
+
+
+def _granule(start, size=4):
+    time = numpy.arange(start, start + size, dtype="i4")
+    values = numpy.add.outer(time * 100, numpy.arange(12.0)).reshape(size, 3, 4)
+    return Dap4App(
+        {
+            "time": (("time",), time),
+            "y": (("y",), numpy.arange(3.0)),
+            "x": (("x",), numpy.arange(4.0)),
+            "sst": (("time", "y", "x"), values.astype("f4")),
+        },
+        attributes={"sst": {"units": "K", "_FillValue": -999.0}},
+    )
+
+
+def _write(app, sink):
+    return UNPACKDAP4DATA(Response(body=app.data()), sink=sink)
+
+
+def test_zarr_sink(tmp_path):
+    app = _granule(0, size=10)
+    unpacked = _write(app, ZarrSink(tmp_path, chunks={"sst": (4, 3, 4)}))
+    assert unpacked.dataset["sst"].data is None
+
+    meta = json.loads((tmp_path / "sst" / ".zarray").read_text())
+    assert meta["shape"] == [10, 3, 4]
+    assert meta["chunks"] == [4, 3, 4]
+    assert meta["dtype"] == "<f4"
+    assert meta["fill_value"] == -999.0
+    assert meta["compressor"] == {"id": "zlib", "level": 4}
+    attrs = json.loads((tmp_path / "sst" / ".zattrs").read_text())
+    assert attrs["_ARRAY_DIMENSIONS"] == ["time", "y", "x"]
+    assert attrs["units"] == "K"
+    assert (tmp_path / ".zgroup").exists()
+
+    # edge chunks are stored at full size
+    chunk = zlib.decompress((tmp_path / "sst" / "2.0.0").read_bytes())
+    assert len(chunk) == 4 * 3 * 4 * 4
+    sink = ZarrSink(tmp_path)
+    for name in ["time", "y", "x", "sst"]:
+        numpy.testing.assert_array_equal(sink.read(name), app.variables[name][1])
+
+
+def test_zarr_sink_slabs(tmp_path, monkeypatch):
+    # slabs of whole chunks: 2 chunks of 2 rows
+    monkeypatch.setattr("dapclient.handlers.dap.SLAB_SIZE", 5 * 3 * 4 * 4)
+    writes = []
+    write = ZarrSink.write
+
+    def spy(self, variable, index, data):
+        writes.append((variable.name, index[0]))
+        write(self, variable, index, data)
+
+    monkeypatch.setattr(ZarrSink, "write", spy)
+    app = _granule(0, size=10)
+    _write(app, ZarrSink(tmp_path, chunks={"sst": (2, 3, 4)}))
+    slabs = [index for name, index in writes if name == "sst"]
+    assert slabs == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    numpy.testing.assert_array_equal(
+        ZarrSink(tmp_path).read("sst"), app.variables["sst"][1]
+    )
+
+
+def test_zarr_sink_concurrent_append(tmp_path):
+    granules = [_granule(start) for start in range(0, 40, 4)]
+
+    def write(app):
+        _write(app, ZarrSink(tmp_path, concat_dim="time"))
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(write, granules))
+
+    sink = ZarrSink(tmp_path)
+    time = sink.read("time")
+    order = numpy.argsort(time)
+    numpy.testing.assert_array_equal(time[order], numpy.arange(40))
+    expected = numpy.concatenate([app.variables["sst"][1] for app in granules])
+    numpy.testing.assert_array_equal(sink.read("sst")[order], expected)
+    # variables without `time` are written once
+    numpy.testing.assert_array_equal(sink.read("x"), numpy.arange(4.0))
+
+
+def test_zarr_sink_shared_chunks(tmp_path):
+    # granules of 4 steps at their offset, into chunks of 3 steps
+    granules = [_granule(start) for start in range(0, 24, 4)]
+
+    def write(app):
+        offset = int(app.variables["time"][1][0])
+        sink = ZarrSink(
+            tmp_path, concat_dim="time", offset=offset, chunks={"sst": (3, 3, 4)}
+        )
+        _write(app, sink)
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(write, granules[::-1]))
+
+    sink = ZarrSink(tmp_path)
+    numpy.testing.assert_array_equal(sink.read("time"), numpy.arange(24))
+    expected = numpy.concatenate([app.variables["sst"][1] for app in granules])
+    numpy.testing.assert_array_equal(sink.read("sst"), expected)
+
+
+def test_zarr_sink_mismatch(tmp_path):
+    _write(_granule(0), ZarrSink(tmp_path, concat_dim="time"))
+    app = Dap4App({"time": (("time",), numpy.arange(4)), "x": (("x",), numpy.ones(5))})
+    with pytest.raises(ValueError):
+        _write(app, ZarrSink(tmp_path, concat_dim="time"))
+    with pytest.raises(ValueError):
+        _write(_granule(0), ZarrSink(tmp_path, concat_dim="depth"))
+
+
+def test_npy_sink_concurrent_append(tmp_path):
+    granules = [_granule(start) for start in range(0, 40, 4)]
+
+    def write(app):
+        _write(app, NpySink(tmp_path, concat_dim="time"))
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(write, granules))
+
+    time = numpy.load(tmp_path / "time.npy")
+    order = numpy.argsort(time)
+    numpy.testing.assert_array_equal(time[order], numpy.arange(40))
+    expected = numpy.concatenate([app.variables["sst"][1] for app in granules])
+    sst = NpySink(tmp_path).read("sst")
+    assert sst.dtype == numpy.dtype("<f4")
+    numpy.testing.assert_array_equal(sst[order], expected)
+
+
+def test_npy_sink_strings(tmp_path):
+    names = numpy.array(["a", "bcd", "ef"], dtype=object)
+    app = Dap4App({"n": (("n",), numpy.arange(3)), "names": (("n",), names)})
+    _write(app, NpySink(tmp_path))
+    numpy.testing.assert_array_equal(
+        numpy.load(tmp_path / "names.npy"), names.astype("S")
+    )
+
+
+def test_stream_sink(tmp_path):
+    app = _granule(0, size=10)
+    with LocalServer(app) as server:
+        dapclient.client.stream(
+            server.url + "/data.nc", sink=ZarrSink(tmp_path / "cube.zarr")
+        )
+    numpy.testing.assert_array_equal(
+        ZarrSink(tmp_path / "cube.zarr").read("sst"), app.variables["sst"][1]
+    )
+    assert not list(tmp_path.glob("*.nc4"))